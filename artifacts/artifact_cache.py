@@ -0,0 +1,172 @@
+#! /usr/bin/env python3
+
+"""
+Local cache of pulled artifacts, shared by all plans run on the agent.
+
+Cached copies are keyed by the repository path of an artifact and the
+version of the remote file (ETag and size for S3, size and mtime for SSH),
+so an artifact is downloaded again only when it changes. On a hit, the
+cached copy is hardlinked (or reflinked/copied, if the target is on another
+filesystem) to the target path. Least recently used copies are evicted when
+the cache grows beyond its maximum size.
+"""
+__copyright__ = "Copyright (C) 2026 ACK CYFRONET AGH"
+__license__ = "This software is released under the MIT license cited in " \
+              "LICENSE.txt"
+
+import errno
+import hashlib
+import json
+import os
+import subprocess
+import uuid
+from os.path import expanduser
+from typing import List
+
+
+CACHE_DIR_VAR = 'BAMBOOS_ARTIFACT_CACHE'
+DEFAULT_CACHE_DIR = os.path.join(expanduser('~'), '.cache', 'bamboos', 'artifacts')
+DEFAULT_MAX_SIZE_GB = 20
+
+_cache_settings = {
+    'enabled': True,
+    'dir': os.environ.get(CACHE_DIR_VAR, DEFAULT_CACHE_DIR),
+    'max_size': DEFAULT_MAX_SIZE_GB * 1024 ** 3
+}
+
+
+def add_cache_args(parser) -> None:
+    """
+    Adds arguments configuring the artifact cache to given argument parser.
+    """
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Always download artifacts, bypassing the local artifact cache')
+
+    parser.add_argument(
+        '--cache-dir',
+        help='Directory of the local artifact cache',
+        default=_cache_settings['dir'])
+
+    parser.add_argument(
+        '--cache-max-size',
+        type=float,
+        help='Maximum total size (in GB) of the local artifact cache',
+        default=DEFAULT_MAX_SIZE_GB)
+
+
+def set_cache_settings(enabled: bool, cache_dir: str, max_size_gb: float) -> None:
+    _cache_settings['enabled'] = enabled
+    _cache_settings['dir'] = cache_dir
+    _cache_settings['max_size'] = int(max_size_gb * 1024 ** 3)
+
+
+def fetch(repo: str, src_path: str, source: dict, dst_path: str) -> bool:
+    """
+    Places cached copy of given version of an artifact at dst_path. Returns
+    False if it is not cached.
+
+    :repo: identifier of the artifacts repository (e.g. hostname or bucket).
+    :src_path: path of the artifact in the repository.
+    :source: description of remote artifact version (e.g. its ETag and size).
+    """
+    if not _cache_settings['enabled']:
+        return False
+
+    cached_path = _cached_path(repo, src_path, source)
+    try:
+        _link(cached_path, dst_path)
+    except FileNotFoundError:
+        return False
+
+    # mtime of a cached copy marks its last use
+    os.utime(cached_path)
+    print("Using cached artifact {} (version {})".format(src_path, source))
+    return True
+
+
+def store(repo: str, src_path: str, source: dict, downloaded_path: str) -> None:
+    """
+    Adds downloaded artifact to the cache, evicting least recently used
+    copies if the cache grows too big.
+    """
+    if not _cache_settings['enabled']:
+        return
+
+    os.makedirs(_cache_settings['dir'], exist_ok=True)
+    try:
+        _link(downloaded_path, _cached_path(repo, src_path, source))
+    except (OSError, subprocess.CalledProcessError) as e:
+        print("Could not cache artifact {}: {}".format(src_path, e))
+        return
+
+    evict(_cache_settings['max_size'])
+
+
+def cached_copies(src_path: str) -> List[str]:
+    """
+    Returns paths of cached copies (of any version) of artifact with given
+    path in the repository, most recently used first.
+    """
+    if not _cache_settings['enabled'] or not os.path.isdir(_cache_settings['dir']):
+        return []
+
+    suffix = '_' + os.path.basename(src_path)
+    with os.scandir(_cache_settings['dir']) as it:
+        copies = [(entry.stat().st_mtime, entry.path) for entry in it
+                  if entry.is_file() and entry.name.endswith(suffix)]
+    return [path for _, path in sorted(copies, reverse=True)]
+
+
+def evict(max_size: int) -> None:
+    """
+    Removes least recently used cached copies until their total size does
+    not exceed max_size bytes.
+    """
+    entries = []
+    with os.scandir(_cache_settings['dir']) as it:
+        for entry in it:
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+
+def _cached_path(repo: str, src_path: str, source: dict) -> str:
+    key = json.dumps([repo, src_path, source], sort_keys=True)
+    name = hashlib.sha1(key.encode()).hexdigest()
+    return os.path.join(_cache_settings['dir'], name + '_' + os.path.basename(src_path))
+
+
+def _link(src: str, dst: str) -> None:
+    """
+    Atomically replaces dst with a hardlink of src, falling back to a reflink
+    (or a copy, where reflinks are not supported) across filesystems. Raises
+    FileNotFoundError, leaving dst untouched, if src does not exist.
+    """
+    if not os.path.isfile(src):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), src)
+
+    tmp_path = os.path.join(os.path.dirname(os.path.abspath(dst)),
+                            '.{}.tmp{}'.format(os.path.basename(dst), uuid.uuid4().hex))
+    try:
+        try:
+            os.link(src, tmp_path)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            subprocess.check_call(['cp', '--reflink=auto', src, tmp_path])
+        os.replace(tmp_path, dst)
+    finally:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,320 @@
+#! /usr/bin/env python3
+
+"""
+Chunked artifacts - artifacts stored as content-defined chunks shared by all
+artifacts in the repo, so that artifacts of feature branches (which usually
+differ from the develop ones by a small fraction) are mostly deduplicated.
+
+Chunks are stored by their sha256 under CHUNKS_DIR, and an artifact is
+described by a manifest (stored at its repo path with MANIFEST_EXT appended)
+listing its chunks. Push uploads only chunks missing in the repo and pull
+downloads only chunks that cannot be found in local files (the previous
+version of the pulled artifact and its copies in the artifact cache).
+
+Chunk boundaries are placed after occurrences of ANCHOR whose preceding
+ANCHOR_WINDOW bytes hash to a multiple of ANCHOR_DIVISOR. As they depend
+only on local content, an insertion or deletion changes only chunks around
+it. Note that deduplication is effective only for artifacts compressed in a
+way that keeps changes local, e.g. with `gzip --rsyncable` or
+`zstd --rsyncable`.
+"""
+__copyright__ = "Copyright (C) 2026 ACK CYFRONET AGH"
+__license__ = "This software is released under the MIT license cited in " \
+              "LICENSE.txt"
+
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Tuple
+
+import artifact_cache
+import artifact_utils
+
+
+CHUNKS_DIR = os.path.join(artifact_utils.ARTIFACTS_DIR, 'chunks')
+MANIFEST_EXT = '.chunks.json'
+
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+# With random (compressed) content, ANCHOR occurs every 64 KB and every
+# ANCHOR_DIVISOR-th occurrence is a boundary, which gives chunks of ~1 MB
+ANCHOR = b'\x5a\xc3'
+ANCHOR_WINDOW = 32
+ANCHOR_DIVISOR = 16
+READ_SIZE = 16 * 1024 * 1024
+# Number of cached copies of an artifact used as a source of chunks on pull
+MAX_SEEDS = 3
+# Chunks reused by a push are touched if they were last modified earlier
+# than that (in seconds), and chunks modified within CHUNK_GRACE_PERIOD are
+# never removed by retention (see remove_old_artifacts.py), so that chunks
+# of a push in progress are not removed before its manifest is written.
+CHUNK_TOUCH_AGE = 24 * 3600
+CHUNK_GRACE_PERIOD = 2 * CHUNK_TOUCH_AGE
+
+
+def s3_store(client, bucket: str) -> dict:
+    return {'type': 's3', 'repo': bucket, 'client': client, 'bucket': bucket}
+
+
+def sftp_store(ssh) -> dict:
+    """
+    Returns store using SFTP over given SSH connection. Every thread uses its
+    own SFTP channel, closed by close_store.
+    """
+    return {'type': 'sftp', 'repo': ssh.get_transport().getpeername()[0], 'ssh': ssh,
+            'local': threading.local(), 'channels': [], 'dirs': set(),
+            'lock': threading.Lock()}
+
+
+def close_store(store: dict) -> None:
+    for sftp in store.get('channels', []):
+        sftp.close()
+
+
+def push(store: dict, local_path: str, repo_path: str) -> None:
+    """
+    Pushes local artifact to repo as a chunked artifact, uploading only
+    chunks missing in the repo.
+    """
+    start = time.time()
+    digest, chunks = chunk_file(local_path)
+    unique = {}
+    for chunk_digest, offset, size in chunks:
+        unique.setdefault(chunk_digest, (offset, size))
+
+    with ThreadPoolExecutor(max_workers=artifact_utils.transfer_concurrency()) as executor:
+        modified = dict(zip(unique, executor.map(
+            lambda d: _modified(store, chunk_key(d)), unique)))
+        missing = [d for d in unique if modified[d] is None]
+        stale = [d for d in unique if modified[d] is not None and
+                 modified[d] < time.time() - CHUNK_TOUCH_AGE]
+        list(executor.map(lambda d: _touch(store, chunk_key(d)), stale))
+
+        fd = os.open(local_path, os.O_RDONLY)
+        try:
+            def upload(chunk_digest: str) -> None:
+                offset, size = unique[chunk_digest]
+                _put(store, chunk_key(chunk_digest), os.pread(fd, size, offset))
+
+            list(executor.map(upload, missing))
+        finally:
+            os.close(fd)
+
+    manifest = {'size': os.path.getsize(local_path), 'sha256': digest,
+                'chunks': [[chunk_digest, size] for chunk_digest, _, size in chunks]}
+    _put(store, repo_path + MANIFEST_EXT, json.dumps(manifest).encode())
+
+    uploaded = sum(unique[d][1] for d in missing)
+    print('Uploaded {} of {} chunks of {}, {:.1f} MB of {:.1f} MB saved by deduplication'.format(
+        len(missing), len(unique), local_path, (manifest['size'] - uploaded) / (1024 * 1024),
+        manifest['size'] / (1024 * 1024)))
+    artifact_utils.report_throughput('Uploaded', local_path, uploaded, time.time() - start)
+
+
+def pull(store: dict, repo_path: str, dst_path: str) -> str:
+    """
+    Pulls chunked artifact from repo to dst_path, downloading only chunks that
+    are not found in local files. Returns sha256 of the artifact.
+    """
+    manifest = json.loads(_get(store, repo_path + MANIFEST_EXT).decode())
+    source = {'sha256': manifest['sha256'], 'size': manifest['size']}
+    offsets = {}
+    position = 0
+    for chunk_digest, size in manifest['chunks']:
+        offsets.setdefault(chunk_digest, []).append(position)
+        position += size
+    sizes = dict(manifest['chunks'])
+
+    # a cache miss leaves dst_path intact, so its previous version can be
+    # used as a seed then
+    if artifact_cache.fetch(store['repo'], repo_path, source, dst_path):
+        return manifest['sha256']
+
+    start = time.time()
+    local = {}
+    if os.path.isfile(dst_path):
+        local.update(_local_chunks(dst_path, offsets))
+    for seed in artifact_cache.cached_copies(repo_path)[:MAX_SEEDS]:
+        for chunk_digest, location in _local_chunks(seed, offsets).items():
+            local.setdefault(chunk_digest, location)
+
+    partial = artifact_utils.partial_path(dst_path)
+    with open(partial, 'wb') as f:
+        f.truncate(manifest['size'])
+    fd = os.open(partial, os.O_WRONLY)
+    try:
+        for chunk_digest, (seed, offset) in local.items():
+            with open(seed, 'rb') as f:
+                data = os.pread(f.fileno(), sizes[chunk_digest], offset)
+            for position in offsets[chunk_digest]:
+                os.pwrite(fd, data, position)
+
+        def download(chunk_digest: str) -> None:
+            data = _get(store, chunk_key(chunk_digest))
+            if hashlib.sha256(data).hexdigest() != chunk_digest:
+                raise RuntimeError('Chunk {} of {} is corrupted'.format(chunk_digest, repo_path))
+            for position in offsets[chunk_digest]:
+                os.pwrite(fd, data, position)
+
+        missing = [d for d in offsets if d not in local]
+        with ThreadPoolExecutor(max_workers=artifact_utils.transfer_concurrency()) as executor:
+            list(executor.map(download, missing))
+    finally:
+        os.close(fd)
+
+    if artifact_utils.file_sha256(partial) != manifest['sha256']:
+        os.remove(partial)
+        raise RuntimeError('Pulled artifact {} does not match its manifest checksum'.format(
+            repo_path))
+    artifact_utils.complete_partial(dst_path)
+    downloaded = sum(sizes[d] for d in missing)
+    print('Downloaded {} of {} chunks of {}, {:.1f} MB of {:.1f} MB found locally'.format(
+        len(missing), len(offsets), repo_path, (manifest['size'] - downloaded) / (1024 * 1024),
+        manifest['size'] / (1024 * 1024)))
+    artifact_utils.report_throughput('Downloaded', repo_path, downloaded, time.time() - start)
+    artifact_cache.store(store['repo'], repo_path, source, dst_path)
+    return manifest['sha256']
+
+
+def chunk_key(digest: str) -> str:
+    return os.path.join(CHUNKS_DIR, digest[:2], digest)
+
+
+def chunk_file(path: str) -> Tuple[str, List[Tuple[str, int, int]]]:
+    """
+    Returns sha256 of given file and a list of (sha256, offset, size) of its
+    chunks.
+    """
+    digest = hashlib.sha256()
+    chunks = []
+    for data, offset in _file_chunks(path):
+        digest.update(data)
+        chunks.append((hashlib.sha256(data).hexdigest(), offset, len(data)))
+    return digest.hexdigest(), chunks
+
+
+def _local_chunks(path: str, offsets: dict) -> dict:
+    """
+    Returns {sha256: (path, offset)} of chunks of local file at path that
+    are among given ones.
+    """
+    return {chunk_digest: (path, offset) for chunk_digest, offset, _ in
+            reversed(chunk_file(path)[1]) if chunk_digest in offsets}
+
+
+def _file_chunks(path: str) -> Iterator[Tuple[bytes, int]]:
+    buf = b''
+    buf_offset = 0
+    eof = False
+    with open(path, 'rb') as f:
+        while not eof:
+            data = f.read(READ_SIZE)
+            eof = not data
+            buf += data
+            start = 0
+            while True:
+                end = _chunk_end(buf, start, eof)
+                if end is None:
+                    break
+                yield buf[start:end], buf_offset + start
+                start = end
+            buf = buf[start:]
+            buf_offset += start
+
+
+def _chunk_end(buf: bytes, start: int, eof: bool):
+    """
+    Returns end of the chunk starting at start, or None if more data is
+    needed to find it.
+    """
+    limit = min(start + MAX_CHUNK_SIZE, len(buf))
+    anchor = buf.find(ANCHOR, start + max(MIN_CHUNK_SIZE, ANCHOR_WINDOW), limit)
+    while anchor != -1:
+        if zlib.crc32(buf[anchor - ANCHOR_WINDOW:anchor]) % ANCHOR_DIVISOR == 0:
+            return anchor + len(ANCHOR)
+        anchor = buf.find(ANCHOR, anchor + 1, limit)
+
+    if len(buf) - start >= MAX_CHUNK_SIZE:
+        return start + MAX_CHUNK_SIZE
+    elif eof and len(buf) > start:
+        return len(buf)
+    return None
+
+
+def _modified(store: dict, key: str):
+    """
+    Returns modification time (a timestamp) of object with given key, or
+    None if it does not exist.
+    """
+    if store['type'] == 's3':
+        client = store['client']
+        try:
+            return client.head_object(Bucket=store['bucket'], Key=key)['LastModified'].timestamp()
+        except client.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    try:
+        return _sftp(store).stat(key).st_mtime
+    except IOError:
+        return None
+
+
+def _touch(store: dict, key: str) -> None:
+    if store['type'] == 's3':
+        # copying an object onto itself requires replacing its metadata
+        store['client'].copy_object(Bucket=store['bucket'], Key=key,
+                                    CopySource={'Bucket': store['bucket'], 'Key': key},
+                                    MetadataDirective='REPLACE')
+    else:
+        _sftp(store).utime(key, None)
+
+
+def _get(store: dict, key: str) -> bytes:
+    if store['type'] == 's3':
+        return store['client'].get_object(Bucket=store['bucket'], Key=key)['Body'].read()
+
+    with _sftp(store).open(key, 'rb') as f:
+        return f.read()
+
+
+def _put(store: dict, key: str, data: bytes) -> None:
+    if store['type'] == 's3':
+        store['client'].put_object(Bucket=store['bucket'], Key=key, Body=data)
+        return
+
+    sftp = _sftp(store)
+    _sftp_makedirs(store, sftp, os.path.dirname(key))
+    tmp_key = '{}{}.{}'.format(key, artifact_utils.PARTIAL_EXT, threading.get_ident())
+    sftp.putfo(io.BytesIO(data), tmp_key)
+    sftp.posix_rename(tmp_key, key)
+
+
+def _sftp(store: dict):
+    local = store['local']
+    if not hasattr(local, 'sftp'):
+        local.sftp = store['ssh'].open_sftp()
+        with store['lock']:
+            store['channels'].append(local.sftp)
+    return local.sftp
+
+
+def _sftp_makedirs(store: dict, sftp, path: str) -> None:
+    if not path or path in store['dirs']:
+        return
+    try:
+        sftp.stat(path)
+    except IOError:
+        _sftp_makedirs(store, sftp, os.path.dirname(path))
+        try:
+            sftp.mkdir(path)
+        except IOError:
+            # created meanwhile by another thread or agent
+            pass
+    store['dirs'].add(path)
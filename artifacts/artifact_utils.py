@@ -9,15 +9,39 @@ __copyright__ = "Copyright (C) 2016-2022 ACK CYFRONET AGH"
 __license__ = "This software is released under the MIT license cited in " \
               "LICENSE.txt"
 
+import hashlib
+import itertools
+import json
 import os
+import shutil
+import subprocess
 import sys
+import tempfile
+import time
+from typing import Iterable, List, Optional, Tuple
 
 
 ARTIFACTS_DIR = 'artifacts'
 ARTIFACTS_EXT = '.tar.gz'
+ZSTD_ARTIFACTS_EXT = '.tar.zst'
+# Supported artifact formats, in order of preference when pulling
+ARTIFACTS_EXTS = [ZSTD_ARTIFACTS_EXT, ARTIFACTS_EXT]
+PARTIAL_EXT = '.partial'
+# sha256 of an artifact is kept in its S3 object metadata under
+# CHECKSUM_METADATA_KEY, or next to it in a file with CHECKSUM_EXT over SSH
+CHECKSUM_EXT = '.sha256'
+CHECKSUM_METADATA_KEY = 'sha256'
 
+DEFAULT_PART_SIZE_MB = 64
+DEFAULT_CONCURRENCY = 8
 
-def build_local_path(file_path: str, artifact_name: str, plan: str):
+_transfer_settings = {
+    'part_size': DEFAULT_PART_SIZE_MB * 1024 * 1024,
+    'concurrency': DEFAULT_CONCURRENCY
+}
+
+
+def build_local_path(file_path: str, artifact_name: str, plan: str, ext: str = ARTIFACTS_EXT):
     """
     Build the path on the client machine from which an artifact will be uploaded to the repo
     or to which an artifact will be downloaded from the repo.
@@ -25,6 +49,7 @@ def build_local_path(file_path: str, artifact_name: str, plan: str):
     :file_path: path to the '+ARTIFACTS_EXT+' file to be pushed or pulled as an artifact.
     :artifact_name: name of the artifact in the repo.
     :plan: name of current bamboo plan.
+    :ext: extension of the default build artifact (one of ARTIFACTS_EXTS).
     """
     
     if file_path:
@@ -32,12 +57,12 @@ def build_local_path(file_path: str, artifact_name: str, plan: str):
     elif artifact_name:
         local_path = artifact_name
     else:
-        local_path = default_build_artifact_name(plan)
+        local_path = default_build_artifact_name(plan, ext)
         print("Neither source file nor artifact name was specified, using default local path:", local_path)  
     return local_path
 
 
-def build_repo_path(artifact_name: str, plan: str, branch: str) -> str:
+def build_repo_path(artifact_name: str, plan: str, branch: str, ext: str = ARTIFACTS_EXT) -> str:
     """
     The path in the artifacts repo to which an artifact is uploaded from the client
     or from which an artifact is downloaded to the client.
@@ -45,21 +70,254 @@ def build_repo_path(artifact_name: str, plan: str, branch: str) -> str:
     :artifact_name: name of the artifact in the repo.
     :plan: name of current bamboo plan.
     :branch: name of current git branch.
+    :ext: extension of the default build artifact (one of ARTIFACTS_EXTS).
     """
     if artifact_name:
-        if not artifact_name.endswith(ARTIFACTS_EXT):
-            print('The artifact name must have the extension \'{}\''.format(ARTIFACTS_EXT), file=sys.stderr)
+        if not artifact_ext(artifact_name):
+            print('The artifact name must have one of the extensions: {}'.format(
+                ', '.join(ARTIFACTS_EXTS)), file=sys.stderr)
             sys.exit(1)
         return os.path.join(ARTIFACTS_DIR, plan, branch, artifact_name)
     else:
         print("Artifact name was not specified, will be treated as a default build artifact")
         # the default build artifact name in the repo is an empty string
-        return os.path.join(ARTIFACTS_DIR, plan, branch, default_build_artifact_name(plan))
+        return os.path.join(ARTIFACTS_DIR, plan, branch, default_build_artifact_name(plan, ext))
 
     
-def default_build_artifact_name(plan: str) -> str:
+def default_build_artifact_name(plan: str, ext: str = ARTIFACTS_EXT) -> str:
     """
     The default artifact is based on the plan in which dashes are replaced with underscores
     :plan: name of the plan
+    :ext: extension of the artifact (one of ARTIFACTS_EXTS).
+    """
+    return plan.replace('-', '_') + ext
+
+
+def artifact_ext(path: str) -> Optional[str]:
+    """
+    Returns extension (one of ARTIFACTS_EXTS) of given artifact path, or
+    None if it has none of them.
+    """
+    for ext in ARTIFACTS_EXTS:
+        if path.endswith(ext):
+            return ext
+    return None
+
+
+def with_artifact_ext(artifact_name: Optional[str], ext: str) -> Optional[str]:
+    """
+    Returns artifact name with its extension replaced with given one (None,
+    denoting the default build artifact, is returned as is).
+    """
+    if not artifact_name or not artifact_ext(artifact_name):
+        return artifact_name
+    return artifact_name[:-len(artifact_ext(artifact_name))] + ext
+
+
+def pull_candidates(artifact_name: Optional[str]) -> List[Tuple[Optional[str], str]]:
+    """
+    Returns (artifact name, extension) pairs of artifacts to be tried in turn
+    when pulling given artifact - the requested one first (for the default
+    build artifact, in the preferred format) and then the same artifact in
+    other formats, as it may have been pushed in any of them.
+    """
+    if artifact_name and artifact_ext(artifact_name):
+        exts = [artifact_ext(artifact_name)] + \
+               [ext for ext in ARTIFACTS_EXTS if ext != artifact_ext(artifact_name)]
+    else:
+        exts = ARTIFACTS_EXTS
+    return [(with_artifact_ext(artifact_name, ext), ext) for ext in exts]
+
+
+def decompress_program(header: bytes) -> str:
+    """
+    Returns program (to be used by tar) decompressing an artifact starting
+    with given bytes. Multi-threaded programs are used when available.
+    """
+    if header.startswith(b'\x28\xb5\x2f\xfd'):
+        return 'zstd -d -T0'
+    elif shutil.which('pigz'):
+        return 'pigz -d'
+    return 'gzip -d'
+
+
+def add_transfer_args(parser) -> None:
+    """
+    Adds arguments tuning artifact transfers to given argument parser.
+    """
+    parser.add_argument(
+        '--part-size',
+        type=int,
+        help='Size (in MB) of parts in which artifacts are transferred',
+        default=DEFAULT_PART_SIZE_MB)
+
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        help='Number of parts of an artifact transferred concurrently',
+        default=DEFAULT_CONCURRENCY)
+
+
+def set_transfer_settings(part_size_mb: int, concurrency: int) -> None:
+    """
+    Sets part size (in MB) and concurrency used by all subsequent transfers.
+    """
+    _transfer_settings['part_size'] = part_size_mb * 1024 * 1024
+    _transfer_settings['concurrency'] = concurrency
+
+
+def transfer_part_size() -> int:
+    return _transfer_settings['part_size']
+
+
+def transfer_concurrency() -> int:
+    return _transfer_settings['concurrency']
+
+
+def report_throughput(action: str, path: str, size: int, elapsed: float) -> None:
+    """
+    Prints size and throughput of a finished transfer.
+
+    :action: name of the transfer, e.g. 'Downloaded'.
+    :path: path of the transferred artifact.
+    :size: number of bytes transferred.
+    :elapsed: time of the transfer in seconds.
+    """
+    size_mb = size / (1024 * 1024)
+    print('{} {} ({:.1f} MB) in {:.1f} s ({:.1f} MB/s)'.format(
+        action, path, size_mb, elapsed, size_mb / max(elapsed, 0.001)))
+
+
+def file_sha256(path: str) -> str:
+    """
+    Returns hex sha256 of given file, computed in a single streaming pass.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def report_skipped_upload(path: str, size: int) -> None:
+    print('Artifact {} is identical to the one in the repo, skipping upload '
+          '({:.1f} MB saved)'.format(path, size / (1024 * 1024)))
+
+
+def partial_path(dst_path: str) -> str:
+    """
+    Path to which an artifact is downloaded before it is complete.
+    """
+    return dst_path + PARTIAL_EXT
+
+
+def load_partial_state(dst_path: str, source: dict) -> Optional[dict]:
+    """
+    Returns progress saved for partial download of an artifact to dst_path,
+    or None if there is none or it concerns a different version of the
+    artifact.
+
+    :source: description of remote artifact version (e.g. its ETag and size).
+    """
+    try:
+        with open(_partial_state_path(dst_path), 'r') as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if state.get('source') != source or not os.path.exists(partial_path(dst_path)):
+        return None
+    return state.get('progress')
+
+
+def save_partial_state(dst_path: str, source: dict, progress: dict) -> None:
+    with open(_partial_state_path(dst_path), 'w') as f:
+        json.dump({'source': source, 'progress': progress}, f)
+
+
+def complete_partial(dst_path: str) -> None:
+    """
+    Moves completely downloaded artifact from its partial path to dst_path.
+    """
+    os.replace(partial_path(dst_path), dst_path)
+    if os.path.exists(_partial_state_path(dst_path)):
+        os.remove(_partial_state_path(dst_path))
+
+
+def _partial_state_path(dst_path: str) -> str:
+    return partial_path(dst_path) + '.json'
+
+
+def extract_stream(chunks: Iterable[bytes], target_dir: str, src_path: str,
+                   expected: dict) -> None:
+    """
+    Extracts artifact from a stream of its bytes, while they are being
+    downloaded, verifying its checksums on the fly. Its format is detected
+    from the first bytes. The artifact is
+    extracted to a temporary directory first and its content is merged into
+    target_dir (like tar does) only if the checksums match.
+
+    :src_path: path of the artifact in the repo.
+    :expected: expected hex digests of the artifact by hashlib algorithm
+        name (e.g. 'sha256'), none of which may be known.
+    """
+    target_dir = os.path.abspath(target_dir)
+    os.makedirs(target_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(target_dir),
+                               prefix='.{}.'.format(os.path.basename(target_dir)))
+    digests = {algorithm: hashlib.new(algorithm) for algorithm in expected}
+    size = 0
+    start = time.time()
+    try:
+        chunks = iter(chunks)
+        first_chunk = next(chunks, b'')
+        tar = subprocess.Popen(['tar', '-x', '-I', decompress_program(first_chunk),
+                                '-f', '-', '-C', tmp_dir],
+                               stdin=subprocess.PIPE)
+        try:
+            for chunk in itertools.chain([first_chunk], chunks):
+                for digest in digests.values():
+                    digest.update(chunk)
+                size += len(chunk)
+                tar.stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+        finally:
+            try:
+                tar.stdin.close()
+            except BrokenPipeError:
+                pass
+            tar.wait()
+        if tar.returncode != 0:
+            raise RuntimeError('Extracting artifact {} failed'.format(src_path))
+
+        for algorithm, value in expected.items():
+            if digests[algorithm].hexdigest() != value:
+                raise RuntimeError('{} checksum of artifact {} does not match'.format(
+                    algorithm, src_path))
+        if not expected:
+            print('No checksum of artifact {} available, skipping verification'.format(
+                src_path))
+
+        _merge_tree(tmp_dir, target_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    report_throughput('Downloaded and extracted', src_path, size, time.time() - start)
+
+
+def _merge_tree(src_dir: str, dst_dir: str) -> None:
+    """
+    Moves content of src_dir into dst_dir, replacing existing files but
+    keeping other content of existing directories.
     """
-    return plan.replace('-', '_') + ARTIFACTS_EXT
+    for name in os.listdir(src_dir):
+        src = os.path.join(src_dir, name)
+        dst = os.path.join(dst_dir, name)
+        src_is_dir = os.path.isdir(src) and not os.path.islink(src)
+        if src_is_dir and os.path.isdir(dst) and not os.path.islink(dst):
+            _merge_tree(src, dst)
+            continue
+        if src_is_dir and os.path.lexists(dst):
+            os.remove(dst)
+        os.replace(src, dst)
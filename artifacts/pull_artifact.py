@@ -15,6 +15,11 @@ Artifacts with custom names are placed in a directory depending on
 the plan's repo and branch, for example:
 `op-worker/feature/VFS-1234-my-branch/custom-artifact.tar.gz`
 
+Artifacts are gzip (`.tar.gz`) or zstd (`.tar.zst`) compressed tarballs.
+A default build artifact is pulled in the zstd format if it exists in
+the repo and in the gzip one otherwise. The same goes for named artifacts,
+with the requested format tried first.
+
 Run the script with -h flag to learn about script's running options.
 """
 __author__ = "Jakub Kudzia, Darin Nikolow"
@@ -24,11 +29,18 @@ __license__ = "This software is released under the MIT license cited in " \
 
 import argparse
 from paramiko import SSHClient, AutoAddPolicy
-from scp import SCPClient
+import math
+import os
 import signal
 import sys
+import threading
+import time
 import boto3
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from typing import Callable, Optional, Any, Tuple
+import artifact_cache
+import artifact_chunks
 import artifact_utils
 from artifact_utils import *
 
@@ -79,6 +91,12 @@ def parse_args():
         default=None,
         required=False)
     
+    parser.add_argument(
+        '--extract-to',
+        help='Extract the artifact to given directory while it is being downloaded, '
+             'instead of saving it',
+        default=None)
+
     parser.add_argument(
         '--s3-url',
         help='The S3 endpoint URL',
@@ -95,17 +113,22 @@ def parse_args():
              'branch is not found',
         default=DEVELOP_BRANCH)
 
+    artifact_utils.add_transfer_args(parser)
+    artifact_cache.add_cache_args(parser)
+
     return parser.parse_args()
 
 
 def download_specific_or_default(ssh: SSHClient, plan: str, branch: str, artifact: str,
                                  target_file_path: str, hostname: str, port: int, username: str,
-                                 fallback_branch: str = DEVELOP_BRANCH) -> None:
+                                 fallback_branch: str = DEVELOP_BRANCH,
+                                 extract_to: Optional[str] = None) -> None:
     download_artifact_safe(
         ssh, plan, branch, artifact, target_file_path, hostname, port, username,
         exc_handler=download_default_artifact,
         exc_handler_args=(ssh, plan, fallback_branch, artifact, target_file_path, hostname, port,
-                          username),
+                          username, extract_to),
+        extract_to=extract_to,
         exc_log="Artifact of plan {0}, specific for branch {1} not found, "
                 "pulling artifact from branch {2}.".format(plan, branch,
                                                            fallback_branch))
@@ -113,28 +136,35 @@ def download_specific_or_default(ssh: SSHClient, plan: str, branch: str, artifac
     
 def s3_download_specific_or_default(s3: boto3.resources, bucket: str, plan: str, branch: str,
                                     artifact: str, target_file_path: str,
-                                    fallback_branch: str = DEVELOP_BRANCH) -> None:
+                                    fallback_branch: str = DEVELOP_BRANCH,
+                                    extract_to: Optional[str] = None) -> None:
     s3_download_artifact_safe(
         s3, bucket, plan, branch, artifact, target_file_path,
         exc_handler=s3_download_default_artifact,
-        exc_handler_args=(s3, bucket, plan, fallback_branch, artifact, target_file_path),
+        exc_handler_args=(s3, bucket, plan, fallback_branch, artifact, target_file_path,
+                          extract_to),
+        extract_to=extract_to,
         exc_log="Artifact of plan {0}, specific for branch {1} not found, "
                 "pulling artifact from branch {2}.".format(plan, branch,
                                                            fallback_branch))
 
     
 def download_default_artifact(ssh: SSHClient, plan: str, branch: str, artifact: str,
-                              target_file_path: str, hostname: str, port: int, username: str) -> None:
+                              target_file_path: str, hostname: str, port: int, username: str,
+                              extract_to: Optional[str] = None) -> None:
     download_artifact_safe(
         ssh, plan, branch, artifact, target_file_path, hostname, port, username,
+        extract_to=extract_to,
         exc_log="Pulling artifact of plan {}, from branch {} failed."
                 .format(plan, branch))
 
     
 def s3_download_default_artifact(s3: boto3.resources, bucket: str,
-                                 plan: str, branch: str, artifact: str, target_file_path: str) -> None:
+                                 plan: str, branch: str, artifact: str, target_file_path: str,
+                                 extract_to: Optional[str] = None) -> None:
     s3_download_artifact_safe(
         s3, bucket, plan, branch, artifact, target_file_path,
+        extract_to=extract_to,
         exc_log="Pulling artifact of plan {}, from branch {} failed."
                 .format(plan, branch))
 
@@ -143,7 +173,8 @@ def download_artifact_safe(ssh: SSHClient, plan: str, branch: str, artifact: str
                            target_file_path: str, hostname: str, port: int, username: str,
                            exc_handler: Optional[Callable[..., Any]] = None,
                            exc_handler_args: Tuple[Any, ...] = (),
-                           exc_log: str = '') -> None:
+                           exc_log: str = '',
+                           extract_to: Optional[str] = None) -> None:
     """
     Downloads artifact from repo. Locks file while it's being downloaded.
     If exception is thrown during download, exc_log is printed and
@@ -157,7 +188,7 @@ def download_artifact_safe(ssh: SSHClient, plan: str, branch: str, artifact: str
     signal.signal(signal.SIGINT, signal_handler)
 
     try:
-        download_artifact(ssh, plan, branch, artifact, target_file_path)
+        download_artifact(ssh, plan, branch, artifact, target_file_path, extract_to)
     except Exception as ex:
         print(exc_log)
         if exc_handler:
@@ -172,7 +203,8 @@ def s3_download_artifact_safe(s3: boto3.resources, bucket: str,
                               target_file_path: str,
                               exc_handler: Optional[Callable[..., Any]] = None,
                               exc_handler_args: Tuple[Any, ...] = (),
-                              exc_log: str = '') -> None:
+                              exc_log: str = '',
+                              extract_to: Optional[str] = None) -> None:
     """
     Downloads artifact from repo. Locks file while it's being downloaded.
     If exception is thrown during download, exc_log is printed and
@@ -185,7 +217,7 @@ def s3_download_artifact_safe(s3: boto3.resources, bucket: str,
     signal.signal(signal.SIGINT, signal_handler)
 
     try:        
-        s3_download_artifact(s3, bucket, plan, branch, artifact, target_file_path)
+        s3_download_artifact(s3, bucket, plan, branch, artifact, target_file_path, extract_to)
     except Exception as ex:
         print(exc_log)
         if exc_handler:
@@ -195,25 +227,264 @@ def s3_download_artifact_safe(s3: boto3.resources, bucket: str,
             sys.exit(1)
 
 
-def download_artifact(ssh: SSHClient, plan: str, branch: str, artifact_name: str, target_file_path: str) -> None:
-    dst_path = artifact_utils.build_local_path(target_file_path, artifact_name, plan)
-    src_path = artifact_utils.build_repo_path(artifact_name, plan, branch)
+def download_artifact(ssh: SSHClient, plan: str, branch: str, artifact_name: str, target_file_path: str,
+                      extract_to: Optional[str] = None) -> str:
+    """
+    Downloads artifact (in any of supported formats, see
+    artifact_utils.pull_candidates) and returns its local path (or
+    extract_to).
+    """
+    sftp = ssh.open_sftp()
+    try:
+        artifact_name, ext, src_path, chunked = find_artifact(
+            lambda path: sftp_exists(sftp, path), artifact_name, plan, branch,
+            target_file_path, extract_to)
+    finally:
+        sftp.close()
+
     print("Pulling artifact for branch '{}' from repo path: '{}' ...".format(branch, src_path))
-    with SCPClient(ssh.get_transport()) as scp:
-        scp.get(src_path, local_path=dst_path)
+    if chunked:
+        return pull_chunked(artifact_chunks.sftp_store(ssh), src_path, artifact_name, plan, ext,
+                            target_file_path, extract_to)
+    elif extract_to:
+        sftp_extract_file(ssh, src_path, extract_to)
+        return extract_to
+
+    dst_path = artifact_utils.build_local_path(target_file_path, artifact_name, plan, ext)
+    sftp_download_file(ssh, src_path, dst_path)
+    return dst_path
+
+
+def find_artifact(exists: Callable[[str], bool], artifact_name: Optional[str], plan: str,
+                  branch: str, target_file_path: Optional[str] = None,
+                  extract_to: Optional[str] = None) -> Tuple[Optional[str], str, str, bool]:
+    """
+    Returns (artifact name, extension, repo path, whether it is chunked) of
+    the first of pull candidates of given artifact that exists in repo, as a
+    whole or chunked (see artifact_chunks). Raises FileNotFoundError if none
+    does.
+
+    If the artifact is to be saved under target_file_path with an explicit
+    extension, only the artifact in that format is considered, so that its
+    content always matches the name.
+    """
+    target_ext = None if extract_to else artifact_utils.artifact_ext(target_file_path or '')
+    for name, ext in artifact_utils.pull_candidates(artifact_name):
+        if target_ext and ext != target_ext:
+            continue
+        path = artifact_utils.build_repo_path(name, plan, branch, ext)
+        if exists(path + artifact_chunks.MANIFEST_EXT):
+            return name, ext, path, True
+        elif exists(path):
+            return name, ext, path, False
+    raise FileNotFoundError("Artifact {} of plan {} not found on branch {}".format(
+        artifact_name or artifact_utils.default_build_artifact_name(plan), plan, branch))
+
+
+def pull_chunked(store: dict, src_path: str, artifact_name: Optional[str], plan: str, ext: str,
+                 target_file_path: str, extract_to: Optional[str]) -> str:
+    """
+    Pulls chunked artifact and returns its local path (or extract_to).
+    """
+    dst_path = artifact_utils.build_local_path(target_file_path, artifact_name, plan, ext)
+    try:
+        digest = artifact_chunks.pull(store, src_path, dst_path)
+    finally:
+        artifact_chunks.close_store(store)
+
+    if not extract_to:
+        return dst_path
+
+    with open(dst_path, 'rb') as f:
+        artifact_utils.extract_stream(iter(lambda: f.read(1024 * 1024), b''), extract_to,
+                                      src_path, {'sha256': digest})
+    return extract_to
+
+
+def sftp_exists(sftp, path: str) -> bool:
+    try:
+        sftp.stat(path)
+        return True
+    except IOError:
+        return False
+
+
+def sftp_download_file(ssh: SSHClient, src_path: str, dst_path: str) -> None:
+    """
+    Downloads file over SFTP with pipelined (prefetched) reads, unless the
+    same version of it (size and mtime) is in the local artifact cache. The
+    file is downloaded to its partial path first, so an interrupted download
+    of the same remote file is resumed.
+    """
+    repo = ssh.get_transport().getpeername()[0]
+    sftp = ssh.open_sftp()
+    try:
+        attrs = sftp.stat(src_path)
+        source = {'size': attrs.st_size, 'mtime': attrs.st_mtime}
+        if artifact_cache.fetch(repo, src_path, source, dst_path):
+            return
+        partial = artifact_utils.partial_path(dst_path)
+        offset = 0
+        if artifact_utils.load_partial_state(dst_path, source) is not None:
+            offset = os.path.getsize(partial)
+            print("Resuming download from byte {}".format(offset))
+        artifact_utils.save_partial_state(dst_path, source, {})
+
+        start = time.time()
+        with sftp.open(src_path, 'rb') as remote, \
+                open(partial, 'ab' if offset else 'wb') as local:
+            remote.seek(offset)
+            remote.prefetch(attrs.st_size)
+            while True:
+                chunk = remote.read(1024 * 1024)
+                if not chunk:
+                    break
+                local.write(chunk)
+    finally:
+        sftp.close()
+
+    artifact_utils.complete_partial(dst_path)
+    artifact_utils.report_throughput('Downloaded', src_path, attrs.st_size - offset,
+                                     time.time() - start)
+    artifact_cache.store(repo, src_path, source, dst_path)
+
+
+def sftp_extract_file(ssh: SSHClient, src_path: str, target_dir: str) -> None:
+    """
+    Extracts file to target_dir while it is being downloaded over SFTP,
+    verifying it against the sha256 stored next to it, if any.
+    """
+    sftp = ssh.open_sftp()
+    try:
+        expected = {}
+        try:
+            with sftp.open(src_path + artifact_utils.CHECKSUM_EXT, 'r') as checksum_file:
+                expected['sha256'] = checksum_file.read().decode().split()[0]
+        except IOError:
+            pass
+
+        with sftp.open(src_path, 'rb') as remote:
+            remote.prefetch(sftp.stat(src_path).st_size)
+            artifact_utils.extract_stream(iter(lambda: remote.read(1024 * 1024), b''),
+                                          target_dir, src_path, expected)
+    finally:
+        sftp.close()
+
 
-        
 def s3_download_artifact(s3: boto3.resources, bucket: str, plan: str,
-                         branch: str, artifact_name: str, target_file_path: str) -> None:
-    buck = s3.Bucket(bucket)
-    dst_path = artifact_utils.build_local_path(target_file_path, artifact_name, plan)
-    src_path = artifact_utils.build_repo_path(artifact_name, plan, branch)
+                         branch: str, artifact_name: str, target_file_path: str,
+                         extract_to: Optional[str] = None) -> str:
+    """
+    Downloads artifact (in any of supported formats, see
+    artifact_utils.pull_candidates) and returns its local path (or
+    extract_to).
+    """
+    client = s3.Bucket(bucket).meta.client
+    artifact_name, ext, src_path, chunked = find_artifact(
+        lambda path: s3_exists(client, bucket, path), artifact_name, plan, branch,
+        target_file_path, extract_to)
+
     print("Pulling artifact for branch '{}' from repo path: '{}' ...".format(branch, src_path))
-    buck.download_file(src_path, dst_path)
+    if chunked:
+        return pull_chunked(artifact_chunks.s3_store(client, bucket), src_path, artifact_name,
+                            plan, ext, target_file_path, extract_to)
+    elif extract_to:
+        s3_extract_file(client, bucket, src_path, extract_to)
+        return extract_to
+
+    dst_path = artifact_utils.build_local_path(target_file_path, artifact_name, plan, ext)
+    s3_download_file(client, bucket, src_path, dst_path)
+    return dst_path
+
+
+def s3_exists(client, bucket: str, path: str) -> bool:
+    try:
+        client.head_object(Bucket=bucket, Key=path)
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+
+def s3_extract_file(client, bucket: str, src_path: str, target_dir: str) -> None:
+    """
+    Extracts S3 object to target_dir while it is being downloaded,
+    verifying it against the sha256 from its metadata and against its ETag
+    (which is the MD5 of objects not uploaded in parts), if any.
+    """
+    response = client.get_object(Bucket=bucket, Key=src_path)
+    expected = {}
+    if artifact_utils.CHECKSUM_METADATA_KEY in response.get('Metadata', {}):
+        expected['sha256'] = response['Metadata'][artifact_utils.CHECKSUM_METADATA_KEY]
+    etag = response['ETag'].strip('"')
+    if '-' not in etag:
+        expected['md5'] = etag
+
+    artifact_utils.extract_stream(response['Body'].iter_chunks(1024 * 1024),
+                                  target_dir, src_path, expected)
+
+
+def s3_download_file(client, bucket: str, src_path: str, dst_path: str) -> None:
+    """
+    Downloads S3 object in parts fetched concurrently with ranged GETs,
+    unless the same version of it (ETag and size) is in the local artifact
+    cache. The object is downloaded to its partial path first and completed parts are
+    recorded, so an interrupted download of the same object version (ETag)
+    fetches only the missing parts.
+    """
+    head = client.head_object(Bucket=bucket, Key=src_path)
+    size = head['ContentLength']
+    source = {'etag': head['ETag'], 'size': size}
+    if artifact_cache.fetch(bucket, src_path, source, dst_path):
+        return
+
+    part_size = artifact_utils.transfer_part_size()
+    partial = artifact_utils.partial_path(dst_path)
+
+    progress = artifact_utils.load_partial_state(dst_path, source)
+    if progress is None or progress.get('part_size') != part_size:
+        progress = {'part_size': part_size, 'done': []}
+        open(partial, 'wb').close()
+    done = set(progress['done'])
+    if done:
+        print("Resuming download, {} parts already downloaded".format(len(done)))
+    artifact_utils.save_partial_state(dst_path, source, progress)
+
+    parts = [part for part in range(math.ceil(size / part_size)) if part not in done]
+    lock = threading.Lock()
+    fd = os.open(partial, os.O_WRONLY)
+
+    def download_part(part: int) -> None:
+        first_byte = part * part_size
+        last_byte = min(size, first_byte + part_size) - 1
+        body = client.get_object(Bucket=bucket, Key=src_path, IfMatch=head['ETag'],
+                                 Range='bytes={}-{}'.format(first_byte, last_byte))['Body']
+        offset = first_byte
+        for chunk in body.iter_chunks(1024 * 1024):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+        with lock:
+            progress['done'].append(part)
+            artifact_utils.save_partial_state(dst_path, source, progress)
+
+    start = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=artifact_utils.transfer_concurrency()) as executor:
+            list(executor.map(download_part, parts))
+    finally:
+        os.close(fd)
+
+    artifact_utils.complete_partial(dst_path)
+    downloaded = sum(min(part_size, size - part * part_size) for part in parts)
+    artifact_utils.report_throughput('Downloaded', src_path, downloaded, time.time() - start)
+    artifact_cache.store(bucket, src_path, source, dst_path)
 
 
 def main():
     args = parse_args()
+    artifact_utils.set_transfer_settings(args.part_size, args.concurrency)
+    artifact_cache.set_cache_settings(not args.no_cache, args.cache_dir, args.cache_max_size)
     if args.hostname != 'S3':
         ssh = SSHClient()
         ssh.set_missing_host_key_policy(AutoAddPolicy())
@@ -222,7 +493,7 @@ def main():
 
         download_specific_or_default(ssh, args.plan, args.branch, args.artifact_name,
                                      args.target_file_path, args.hostname, args.port,
-                                     args.username, args.fallback_branch)
+                                     args.username, args.fallback_branch, args.extract_to)
 
         ssh.close()
     else:
@@ -233,7 +504,8 @@ def main():
             endpoint_url=args.s3_url
         )
         s3_download_specific_or_default(s3_res, args.s3_bucket, args.plan, args.branch,
-                                        args.artifact_name, args.target_file_path, args.fallback_branch)
+                                        args.artifact_name, args.target_file_path, args.fallback_branch,
+                                        args.extract_to)
 
 
 if __name__ == '__main__':
@@ -3,6 +3,11 @@
 Pulls artifacts from external repo using branches defined in branchConfig.yaml
 file.
 
+Artifacts of all plans are pulled concurrently, over a pool of SSH
+connections (each download opening its own SFTP channel) or S3 clients.
+Artifact of a plan using the current branch falls back to the default branch
+from branchConfig.yaml if it does not exist.
+
 Run the script with -h flag to learn about script's running options.
 """
 __author__ = "Michal Cwiertnia"
@@ -11,24 +16,29 @@ __license__ = "This software is released under the MIT license cited in " \
               "LICENSE.txt"
 
 import os
+import queue
+import sys
+import time
 import yaml
 import argparse
 import boto3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
 from paramiko import SSHClient, AutoAddPolicy
 
-from pull_artifact import (download_artifact_safe,
-                           download_specific_or_default,
-                           s3_download_artifact_safe,
-                           s3_download_specific_or_default)
+import artifact_cache
+import artifact_utils
+from pull_artifact import download_artifact, s3_download_artifact
 
 
 BRANCH_CFG_PATH = 'branchConfig.yaml'
 BAMBOO_BRANCH_NAME = 'bamboo_planRepository_branchName'
 DEFAULT_BRANCH = 'default'
 CURRENT_BRANCH = 'current_branch'
+DEFAULT_CONNECTIONS = 4
 
 
-def main():
+def parse_args():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         description='Pull sources and images lists for branches specified in '
@@ -60,64 +70,129 @@ def main():
         help='The S3 bucket name',
         default='bamboo-artifacts-2')
 
-    args = parser.parse_args()
+    parser.add_argument(
+        '--connections',
+        type=int,
+        help='Maximum number of artifacts pulled concurrently (each over '
+             'its own SSH connection or S3 client)',
+        default=DEFAULT_CONNECTIONS)
+
+    artifact_utils.add_transfer_args(parser)
+    artifact_cache.add_cache_args(parser)
+
+    return parser.parse_args()
+
+
+def plan_branches(branch_cfg: dict) -> List[tuple]:
+    """
+    Returns a list of (plan, branch, fallback branch) triples of plans whose
+    artifacts should be pulled. Fallback branch is None for plans with an
+    explicitly set branch.
+    """
+    default_branch = branch_cfg.get(DEFAULT_BRANCH)
+    plans = []
+    for plan, branch in branch_cfg.get('sources').items():
+        if branch == CURRENT_BRANCH:
+            plans.append((plan, os.getenv(BAMBOO_BRANCH_NAME), default_branch))
+        else:
+            plans.append((plan, branch, None))
+    return plans
+
+
+def pull_plan(connections: queue.Queue, download: Callable[..., str], plan: str,
+              branch: str, fallback_branch: Optional[str]) -> Optional[dict]:
+    """
+    Pulls default build artifact of given plan from branch, or from
+    fallback_branch if it fails, using a connection taken from the pool.
+    Returns a summary of the pull or None if it failed.
+
+    :download: function downloading artifact over a connection, with
+        arguments and result as download_artifact.
+    """
+    branches = [branch]
+    if fallback_branch and fallback_branch != branch:
+        branches.append(fallback_branch)
+
+    connection = connections.get()
+    try:
+        for index, current in enumerate(branches):
+            print('Getting artifact for plan {}\'s from branch {}'.format(plan, current))
+            start = time.time()
+            try:
+                local_path = download(connection, plan, current, None, None)
+            except Exception as ex:
+                print('Branch {} in plan {} not found: {}'.format(current, plan, ex))
+                if index + 1 < len(branches):
+                    print('Pulling artifact of plan {} from branch {}.'.format(
+                        plan, branches[index + 1]))
+                continue
+
+            return {'plan': plan, 'branch': current, 'size': os.path.getsize(local_path),
+                    'time': time.time() - start}
+    finally:
+        connections.put(connection)
+
+    print('Pulling artifact of plan {} failed.'.format(plan))
+    return None
+
+
+def print_summary(plans: List[tuple], results: List[Optional[dict]], elapsed: float) -> None:
+    print('\nPulled artifacts:')
+    for (plan, branch, _), result in zip(plans, results):
+        if result:
+            print('    {:<30} {:<40} {:>10.1f} MB {:>8.1f} s'.format(
+                plan, result['branch'], result['size'] / (1024 * 1024), result['time']))
+        else:
+            print('    {:<30} {:<40} {:>10} {:>10}'.format(plan, branch, 'FAILED', ''))
+    total_size = sum(result['size'] for result in results if result)
+    print('Total: {:.1f} MB in {:.1f} s'.format(total_size / (1024 * 1024), elapsed))
+
+
+def main():
+    args = parse_args()
+    artifact_utils.set_transfer_settings(args.part_size, args.concurrency)
+    artifact_cache.set_cache_settings(not args.no_cache, args.cache_dir, args.cache_max_size)
+
+    with open(BRANCH_CFG_PATH, 'r') as branch_cfg_file:
+        plans = plan_branches(yaml.safe_load(branch_cfg_file))
+    if not plans:
+        return
+
+    connections = queue.Queue()
+    for _ in range(max(1, min(args.connections, len(plans)))):
+        if args.hostname != 'S3':
+            ssh = SSHClient()
+            ssh.set_missing_host_key_policy(AutoAddPolicy())
+            ssh.load_system_host_keys()
+            ssh.connect(args.hostname, port=args.port, username=args.username)
+            connections.put(ssh)
+        else:
+            # boto3 resources are not thread safe, so every worker gets its own
+            connections.put(boto3.session.Session().resource(
+                service_name='s3',
+                endpoint_url=args.s3_url
+            ))
 
     if args.hostname != 'S3':
-        ssh = SSHClient()
-        ssh.set_missing_host_key_policy(AutoAddPolicy())
-        ssh.load_system_host_keys()
-        ssh.connect(args.hostname, port=args.port, username=args.username)
-
-        with open(BRANCH_CFG_PATH, 'r') as branch_cfg_file:
-            branch_cfg = yaml.load(branch_cfg_file)
-            default_branch = branch_cfg.get(DEFAULT_BRANCH)
-
-            for plan, branch in branch_cfg.get('sources').items():
-                if branch != CURRENT_BRANCH:
-                    print('Getting artifact for plan {}\'s from branch {}'
-                          .format(plan, branch))
-                    exc_log = 'Branch {} in plan {} not found.'.format(branch,
-                                                                   plan)
-                    download_artifact_safe(ssh, plan, branch, args.hostname,
-                                           args.port, args.username,
-                                           exc_handler=exit,
-                                           exc_handler_args=(1,),
-                                           exc_log=exc_log)
-                else:
-                    download_specific_or_default(ssh, plan,
-                                                 os.getenv(BAMBOO_BRANCH_NAME),
-                                                 args.hostname, args.port,
-                                                 args.username,
-                                                 default_branch=default_branch)
-        ssh.close()
+        download = download_artifact
     else:
-        s3_session = boto3.session.Session()
-        s3_res = s3_session.resource(
-            service_name='s3',
-            endpoint_url=args.s3_url
-        )
-
-        with open(BRANCH_CFG_PATH, 'r') as branch_cfg_file:
-            branch_cfg = yaml.load(branch_cfg_file)
-            default_branch = branch_cfg.get(DEFAULT_BRANCH)
-
-            for plan, branch in branch_cfg.get('sources').items():
-                if branch != CURRENT_BRANCH:
-                    print('Getting artifact for plan {}\'s from branch {}'
-                          .format(plan, branch))
-                    exc_log = 'Branch {} in plan {} not found.'.format(branch,
-                                                                       plan)
-                    s3_download_artifact_safe(s3_res, args.s3_bucket, plan, branch, args.hostname,
-                                              args.port, args.username,
-                                              exc_handler=exit,
-                                              exc_handler_args=(1,),
-                                              exc_log=exc_log)
-                else:
-                    s3_download_specific_or_default(s3_res, args.s3_bucket, plan,
-                                                    os.getenv(BAMBOO_BRANCH_NAME),
-                                                    args.hostname, args.port,
-                                                    args.username,
-                                                    default_branch=default_branch)
+        def download(s3, plan, branch, artifact_name, target_file_path):
+            return s3_download_artifact(s3, args.s3_bucket, plan, branch, artifact_name,
+                                        target_file_path)
+
+    start = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=connections.qsize()) as executor:
+            results = list(executor.map(
+                lambda p: pull_plan(connections, download, *p), plans))
+    finally:
+        if args.hostname != 'S3':
+            while not connections.empty():
+                connections.get().close()
+
+    print_summary(plans, results, time.time() - start)
+    if not all(results):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -15,6 +15,15 @@ Artifacts with custom names are placed in a directory depending on
 the plan's repo and branch, for example:
 `op-worker/feature/VFS-1234-my-branch/custom-artifact.tar.gz`
 
+Artifacts are gzip (`.tar.gz`) or zstd (`.tar.zst`) compressed tarballs.
+The format of a pushed artifact is given by the extension of its name
+(or, for the default build artifact, of the source file). Copies of the
+same artifact in other formats are removed from the repo.
+
+sha256 of a pushed artifact is kept in its S3 metadata or in a `.sha256` file
+next to it, and the upload is skipped if the artifact in the repo is
+identical.
+
 Run the script with -h flag to learn about script's running options.
 """
 __author__ = "Jakub Kudzia, Darin Nikolow"
@@ -22,19 +31,24 @@ __copyright__ = "Copyright (C) 2016-2022 ACK CYFRONET AGH"
 __license__ = "This software is released under the MIT license cited in " \
               "LICENSE.txt"
 
+import shlex
 import signal
 import sys
 import argparse
 import time
+import io
+import os
 import boto3
+import artifact_chunks
 import artifact_utils
 
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from typing import Optional
 from paramiko import SSHClient, AutoAddPolicy, SSHException
 from scp import SCPClient, SCPException
 from artifact_utils import *
 
-PARTIAL_EXT = '.partial'
-
 def parse_args():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -58,14 +72,16 @@ def parse_args():
 
     parser.add_argument(
         '--artifact-name', '-an',
-        help='Name for the artifact, with '+ARTIFACTS_EXT+' extension, used for artifact identification. ' +
-             'If not specified, uses default build artifact name.',
+        help='Name for the artifact, with one of '+', '.join(ARTIFACTS_EXTS)+' extensions, used for ' +
+             'artifact identification. If not specified, uses default build artifact name ' +
+             '(with the extension of the source file).',
         default=None,
         required=False)
 
     parser.add_argument(
         '--source-file-path', '-sf',
-        help='Path to the '+ARTIFACTS_EXT+' file to be pushed as an artifact. Defaults to the artifact name in CWD.',
+        help='Path to the '+' or '.join(ARTIFACTS_EXTS)+' file to be pushed as an artifact. ' +
+             'Defaults to the artifact name in CWD.',
         default=None,
         required=False)
 
@@ -89,16 +105,49 @@ def parse_args():
         help='The S3 bucket name',
         default='bamboo-artifacts-2')
 
+    parser.add_argument(
+        '--chunked',
+        action='store_true',
+        help='Push the artifact as content-defined chunks, uploading only chunks '
+             'missing in the repo (see artifact_chunks.py). Chunks are shared '
+             'between versions of the artifact only if it is compressed with '
+             '--rsyncable (e.g. `tar -I "zstd -T0 --rsyncable"`)')
+
+    artifact_utils.add_transfer_args(parser)
+
     return parser.parse_args()
 
 def ssh_upload_artifact(ssh: SSHClient, plan: str, branch: str, hostname: str, port: int,
-                         username: str, artifact_name: str, source_file_path: str) -> None:
-    src_path = artifact_utils.build_local_path(source_file_path, artifact_name, plan)
-    dst_path = artifact_utils.build_repo_path(artifact_name, plan, branch)
+                         username: str, artifact_name: str, source_file_path: str,
+                         chunked: bool = False) -> None:
+    ext = pushed_artifact_ext(artifact_name, source_file_path)
+    src_path = artifact_utils.build_local_path(source_file_path, artifact_name, plan, ext)
+    dst_path = artifact_utils.build_repo_path(artifact_name, plan, branch, ext)
     print("Uploading artifact")
     print("    source path: {}".format(src_path))
     print("    dest.  path: {}".format(dst_path))
 
+    if chunked:
+        store = artifact_chunks.sftp_store(ssh)
+        try:
+            artifact_chunks.push(store, src_path, dst_path)
+        finally:
+            artifact_chunks.close_store(store)
+        for path in superseded_paths(artifact_name, plan, branch, ext, chunked):
+            delete_file(ssh, path)
+        return
+
+    digest = artifact_utils.file_sha256(src_path)
+    # the checksum file is only a hint - the artifact itself is hashed
+    # before anything is skipped or removed
+    if (ssh_remote_checksum(ssh, dst_path) == digest and
+            ssh_file_sha256(ssh, dst_path) == digest):
+        artifact_utils.report_skipped_upload(src_path, os.path.getsize(src_path))
+        ssh_touch(ssh, dst_path)
+        for path in superseded_paths(artifact_name, plan, branch, ext, chunked):
+            delete_file(ssh, path)
+        return
+
     partial_file_name = dst_path + partial_extension()
 
     def signal_handler(_signum, _frame):
@@ -111,7 +160,13 @@ def ssh_upload_artifact(ssh: SSHClient, plan: str, branch: str, hostname: str, p
 
     try:
         ssh_upload_artifact_unsafe(ssh, src_path, partial_file_name)
+        # the checksum file is written only after the artifact is in place,
+        # so that it never describes different content
+        delete_file(ssh, dst_path + CHECKSUM_EXT)
         rename_file(ssh, partial_file_name, dst_path)
+        ssh_write_checksum(ssh, dst_path, digest)
+        for path in superseded_paths(artifact_name, plan, branch, ext, chunked):
+            delete_file(ssh, path)
     except (SCPException, SSHException) as e:
         print("Uploading artifact of plan {0}, on branch {1} failed"
               .format(plan, branch))
@@ -125,8 +180,62 @@ def ssh_upload_artifact_unsafe(ssh: SSHClient, artifact_name: str, remote_path:
     :param artifact_name: name of artifact to be pushed
     :param remote_path: path for uploaded file
     """
+    start = time.time()
     with SCPClient(ssh.get_transport()) as scp:
         scp.put(artifact_name, remote_path=remote_path)
+    artifact_utils.report_throughput('Uploaded', artifact_name,
+                                     os.path.getsize(artifact_name), time.time() - start)
+
+def ssh_remote_checksum(ssh: SSHClient, path: str) -> Optional[str]:
+    """
+    Returns sha256 of artifact at given repo path, read from the checksum
+    file next to it, or None if there is none.
+    """
+    sftp = ssh.open_sftp()
+    try:
+        sftp.stat(path)
+        with sftp.open(path + CHECKSUM_EXT, 'r') as checksum_file:
+            return checksum_file.read().decode().split()[0]
+    except (IOError, IndexError):
+        return None
+    finally:
+        sftp.close()
+
+def ssh_file_sha256(ssh: SSHClient, path: str) -> Optional[str]:
+    """
+    Returns sha256 of artifact at given repo path, computed on the repo
+    host, or None if it cannot be computed.
+    """
+    try:
+        return run_command(ssh, "sha256sum {}".format(shlex.quote(path))).split()[0]
+    except (SSHException, IndexError):
+        return None
+
+def ssh_touch(ssh: SSHClient, path: str) -> None:
+    """
+    Sets modification time of artifact at given repo path to now, as
+    retention of artifacts (see remove_old_artifacts.py) relies on it.
+    """
+    sftp = ssh.open_sftp()
+    try:
+        sftp.utime(path, None)
+    finally:
+        sftp.close()
+
+def ssh_write_checksum(ssh: SSHClient, path: str, digest: str) -> None:
+    """
+    Atomically writes checksum file (in sha256sum format) of artifact at
+    given repo path.
+    """
+    checksum_path = path + CHECKSUM_EXT
+    partial_checksum_path = checksum_path + partial_extension()
+    content = '{}  {}\n'.format(digest, os.path.basename(path)).encode()
+    sftp = ssh.open_sftp()
+    try:
+        sftp.putfo(io.BytesIO(content), partial_checksum_path)
+        sftp.posix_rename(partial_checksum_path, checksum_path)
+    finally:
+        sftp.close()
 
 def partial_extension() -> str:
     return "{partial}.{timestamp}".format(
@@ -136,7 +245,7 @@ def partial_extension() -> str:
 
 def rename_file(ssh: SSHClient, src_file: str,
                 target_file: str) -> None:
-    ssh.exec_command("mv {0} {1}".format(src_file, target_file))
+    run_command(ssh, "mv {0} {1}".format(src_file, target_file))
 
 def delete_file(ssh: SSHClient, file_name: str) -> None:
     """
@@ -144,22 +253,104 @@ def delete_file(ssh: SSHClient, file_name: str) -> None:
     :param ssh: sshclient with opened connection
     :param file_name: name of file to be unlocked
     """
-    ssh.exec_command("rm -rf {}".format(file_name))
+    run_command(ssh, "rm -rf {}".format(file_name))
+
+def run_command(ssh: SSHClient, command: str) -> str:
+    """
+    Runs command on the repo host and returns its output. Raises
+    SSHException if it fails.
+    """
+    _, stdout, stderr = ssh.exec_command(command)
+    output = stdout.read().decode()
+    if stdout.channel.recv_exit_status() != 0:
+        raise SSHException("Command '{}' failed: {}".format(
+            command, stderr.read().decode().strip()))
+    return output
 
 def s3_upload_artifact(s3: boto3.resources, bucket: str, plan: str,
-                            branch: str, artifact_name: str, source_file_path) -> None:
-    src_path = artifact_utils.build_local_path(source_file_path, artifact_name, plan)
-    dst_path = artifact_utils.build_repo_path(artifact_name, plan, branch)
+                            branch: str, artifact_name: str, source_file_path,
+                            chunked: bool = False) -> None:
+    ext = pushed_artifact_ext(artifact_name, source_file_path)
+    src_path = artifact_utils.build_local_path(source_file_path, artifact_name, plan, ext)
+    dst_path = artifact_utils.build_repo_path(artifact_name, plan, branch, ext)
     print("Uploading artifact")
     print("    source path: {}".format(src_path))
     print("    dest.  path: {}".format(dst_path))
 
-    data = open(src_path, 'rb')
     buck = s3.Bucket(bucket)
-    buck.put_object(Key=dst_path, Body=data)
+    if chunked:
+        artifact_chunks.push(artifact_chunks.s3_store(buck.meta.client, bucket),
+                             src_path, dst_path)
+    else:
+        digest = artifact_utils.file_sha256(src_path)
+        part_size = artifact_utils.transfer_part_size()
+        config = TransferConfig(multipart_threshold=part_size,
+                                multipart_chunksize=part_size,
+                                max_concurrency=artifact_utils.transfer_concurrency())
+        if s3_remote_checksum(buck.meta.client, bucket, dst_path) == digest:
+            artifact_utils.report_skipped_upload(src_path, os.path.getsize(src_path))
+            s3_touch(buck, dst_path, digest, config)
+        else:
+            start = time.time()
+            buck.upload_file(src_path, dst_path, Config=config,
+                             ExtraArgs={'Metadata': {CHECKSUM_METADATA_KEY: digest}})
+            artifact_utils.report_throughput('Uploaded', src_path,
+                                             os.path.getsize(src_path), time.time() - start)
+    for path in superseded_paths(artifact_name, plan, branch, ext, chunked):
+        buck.Object(path).delete()
+
+def s3_touch(buck, path: str, digest: str, config: TransferConfig) -> None:
+    """
+    Refreshes LastModified of artifact at given repo path, as retention of
+    artifacts (see remove_old_artifacts.py) relies on it, by copying it onto
+    itself (which requires its metadata to be replaced).
+    """
+    buck.copy({'Bucket': buck.name, 'Key': path}, path, Config=config,
+              ExtraArgs={'Metadata': {CHECKSUM_METADATA_KEY: digest},
+                         'MetadataDirective': 'REPLACE'})
+
+def s3_remote_checksum(client, bucket: str, path: str) -> Optional[str]:
+    """
+    Returns sha256 of artifact at given repo path, read from its metadata,
+    or None if it does not exist or has no checksum.
+    """
+    try:
+        head = client.head_object(Bucket=bucket, Key=path)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    return head.get('Metadata', {}).get(CHECKSUM_METADATA_KEY)
+
+def pushed_artifact_ext(artifact_name: str, source_file_path: str) -> str:
+    """
+    Returns extension (format) of pushed artifact - the one of its name or,
+    for the default build artifact, of the source file.
+    """
+    return (artifact_utils.artifact_ext(artifact_name or '') or
+            artifact_utils.artifact_ext(source_file_path or '') or ARTIFACTS_EXT)
+
+def superseded_paths(artifact_name: str, plan: str, branch: str, ext: str,
+                     chunked: bool) -> list:
+    """
+    Returns repo paths of the same artifact in formats (or chunked/whole
+    representations) other than the pushed one. They are removed after push,
+    as otherwise a stale copy preferred by pull_artifact would shadow the
+    pushed one.
+    """
+    paths = []
+    for other in ARTIFACTS_EXTS:
+        path = artifact_utils.build_repo_path(artifact_utils.with_artifact_ext(artifact_name, other),
+                                              plan, branch, other)
+        if other != ext or chunked:
+            paths += [path, path + CHECKSUM_EXT]
+        if other != ext or not chunked:
+            paths.append(path + artifact_chunks.MANIFEST_EXT)
+    return paths
 
 def main():
     args = parse_args()
+    artifact_utils.set_transfer_settings(args.part_size, args.concurrency)
     if args.hostname != 'S3':
         ssh = SSHClient()
         ssh.set_missing_host_key_policy(AutoAddPolicy())
@@ -167,7 +358,7 @@ def main():
         ssh.connect(args.hostname, port=args.port, username=args.username)
         ssh_upload_artifact(ssh, args.plan, args.branch,
                              args.hostname, args.port, args.username,
-                             args.artifact_name, args.source_file_path)
+                             args.artifact_name, args.source_file_path, args.chunked)
         ssh.close()
     else:
         s3_session = boto3.session.Session()
@@ -177,7 +368,8 @@ def main():
             endpoint_url=args.s3_url
         )
         s3_upload_artifact(s3_res, args.s3_bucket, args.plan,
-                                args.branch, args.artifact_name, args.source_file_path)
+                                args.branch, args.artifact_name, args.source_file_path,
+                                args.chunked)
 
 
 if __name__ == '__main__':
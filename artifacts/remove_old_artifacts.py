@@ -0,0 +1,258 @@
+#! /usr/bin/env python3
+"""
+Removes old artifacts from the S3 artifacts repo.
+
+Objects are listed per plan (`artifacts/<plan>/<branch>/...`), concurrently
+and with pagination, and an object is removed if its branch is not protected
+(release branches are protected by default), is not one of the --keep-last
+most recently updated branches of its plan, and either the object is older
+than --older-than days or the branch no longer exists in the git repository
+of the plan (when --git-url-template is given).
+
+Chunks of chunked artifacts (see artifact_chunks.py) are removed if they are
+older than --older-than days and are not referenced by any manifest left in
+the repo. Chunks modified within artifact_chunks.CHUNK_GRACE_PERIOD before
+the listing are always kept, as they may belong to a push whose manifest has
+not been written yet (pushes touch old chunks they reuse).
+
+Objects are removed in DeleteObjects batches of up to 1000 keys. Run with
+--dry-run to only print a report of what would be removed.
+
+Run the script with -h flag to learn about script's running options.
+"""
+__copyright__ = "Copyright (C) 2026 ACK CYFRONET AGH"
+__license__ = "This software is released under the MIT license cited in " \
+              "LICENSE.txt"
+
+import argparse
+import datetime
+import fnmatch
+import json
+import subprocess
+import sys
+import boto3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set
+
+import artifact_chunks
+from artifact_utils import ARTIFACTS_DIR
+
+
+DELETE_BATCH_SIZE = 1000
+LISTING_THREADS = 16
+DEFAULT_PROTECTED = ['release/*']
+# Removing artifacts younger than that requires confirmation
+MIN_UNCONFIRMED_AGE_DAYS = 365
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Remove old artifacts from S3 artifacts repo.')
+
+    parser.add_argument(
+        '--s3-url',
+        help='The S3 endpoint URL',
+        default='https://storage.cloud.cyfronet.pl')
+
+    parser.add_argument(
+        '--s3-bucket',
+        help='The S3 bucket name',
+        default='bamboo-artifacts-2')
+
+    parser.add_argument(
+        '--older-than',
+        type=int,
+        help='Age (in days) of artifacts to be removed',
+        default=MIN_UNCONFIRMED_AGE_DAYS)
+
+    parser.add_argument(
+        '--keep-last',
+        type=int,
+        help='Number of most recently updated branches of every plan whose '
+             'artifacts are always kept',
+        default=1)
+
+    parser.add_argument(
+        '--protect',
+        action='append',
+        help='Pattern of branches whose artifacts are always kept (can be '
+             'repeated)',
+        default=list(DEFAULT_PROTECTED))
+
+    parser.add_argument(
+        '--git-url-template',
+        help='URL of git repository of a plan, with {plan} placeholder, e.g. '
+             'ssh://git@git.example.com/vfs/{plan}.git. If given, artifacts of '
+             'branches that no longer exist are removed regardless of age.',
+        default=None)
+
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Only print a report of artifacts that would be removed')
+
+    parser.add_argument(
+        '--yes', '-y',
+        action='store_true',
+        help='Do not ask for confirmation')
+
+    return parser.parse_args()
+
+
+def list_plans(client, bucket: str) -> List[str]:
+    plans = []
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=ARTIFACTS_DIR + '/', Delimiter='/'):
+        for prefix in page.get('CommonPrefixes', []):
+            plans.append(prefix['Prefix'][len(ARTIFACTS_DIR) + 1:].rstrip('/'))
+    return plans
+
+
+def list_objects(client, bucket: str, prefix: str) -> List[dict]:
+    objects = []
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        objects.extend(page.get('Contents', []))
+    return objects
+
+
+def live_branches(git_url_template: Optional[str], plan: str) -> Optional[Set[str]]:
+    """
+    Returns names of branches existing in the git repository of given plan,
+    or None if they cannot be determined.
+    """
+    if not git_url_template:
+        return None
+    result = subprocess.run(['git', 'ls-remote', '--heads', git_url_template.format(plan=plan)],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        print('WARNING: could not list branches of plan {}, skipping liveness check'.format(plan))
+        return None
+    return {line.split('refs/heads/', 1)[1] for line in result.stdout.splitlines()
+            if 'refs/heads/' in line}
+
+
+def select_plan_deletions(plan: str, objects: List[dict], live: Optional[Set[str]],
+                          args, cutoff: datetime.datetime) -> List[dict]:
+    """
+    Returns objects of given plan to be removed according to retention rules
+    (see module doc).
+    """
+    branches = {}
+    for obj in objects:
+        parts = obj['Key'].split('/')
+        branches.setdefault('/'.join(parts[2:-1]), []).append(obj)
+
+    by_update = sorted(branches, key=lambda b: max(o['LastModified'] for o in branches[b]),
+                       reverse=True)
+    kept = set(by_update[:args.keep_last])
+
+    deletions = []
+    for branch, branch_objects in branches.items():
+        if branch in kept or any(fnmatch.fnmatch(branch, p) for p in args.protect):
+            continue
+        if live is not None and branch not in live:
+            deletions.extend(branch_objects)
+        else:
+            deletions.extend(o for o in branch_objects if o['LastModified'] < cutoff)
+    return deletions
+
+
+def select_chunk_deletions(client, bucket: str, chunks: List[dict], manifests: List[str],
+                           cutoff: datetime.datetime) -> List[dict]:
+    """
+    Returns chunks older than cutoff that are not referenced by any of given
+    manifests.
+    """
+    def referenced(key: str) -> Set[str]:
+        body = client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        return {digest for digest, _ in json.loads(body.decode())['chunks']}
+
+    with ThreadPoolExecutor(max_workers=LISTING_THREADS) as executor:
+        used = set().union(*executor.map(referenced, manifests))
+    return [c for c in chunks
+            if c['Key'].rsplit('/', 1)[-1] not in used and c['LastModified'] < cutoff]
+
+
+def delete_objects(client, bucket: str, keys: List[str]) -> int:
+    """
+    Removes objects in DeleteObjects batches. Returns number of errors.
+    """
+    batches = [keys[i:i + DELETE_BATCH_SIZE] for i in range(0, len(keys), DELETE_BATCH_SIZE)]
+
+    def delete_batch(batch: List[str]) -> int:
+        response = client.delete_objects(
+            Bucket=bucket, Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+        for error in response.get('Errors', []):
+            print('Could not delete {}: {}'.format(error['Key'], error.get('Message')))
+        return len(response.get('Errors', []))
+
+    with ThreadPoolExecutor(max_workers=LISTING_THREADS) as executor:
+        return sum(executor.map(delete_batch, batches))
+
+
+def print_report(deletions: Dict[str, List[dict]], dry_run: bool) -> None:
+    print('{} artifacts:'.format('Would remove' if dry_run else 'Removing'))
+    for plan, objects in sorted(deletions.items()):
+        if objects:
+            print('    {:<40} {:>8} objects {:>12.1f} MB'.format(
+                plan, len(objects), sum(o['Size'] for o in objects) / (1024 * 1024)))
+    all_objects = [o for objects in deletions.values() for o in objects]
+    print('Total: {} objects, {:.1f} MB {}'.format(
+        len(all_objects), sum(o['Size'] for o in all_objects) / (1024 * 1024),
+        'would be reclaimed' if dry_run else 'reclaimed'))
+
+
+def main():
+    args = parse_args()
+    if args.older_than < MIN_UNCONFIRMED_AGE_DAYS and not args.dry_run and not args.yes:
+        answer = input('You specified less than {} days for age of artifacts to be removed. '
+                       'Is this what you want? (yes/no) '.format(MIN_UNCONFIRMED_AGE_DAYS))
+        if answer != 'yes':
+            print('Exiting...')
+            sys.exit(1)
+
+    s3_session = boto3.session.Session()
+    client = s3_session.client(
+        service_name='s3',
+        endpoint_url=args.s3_url
+    )
+    listing_start = datetime.datetime.now(datetime.timezone.utc)
+    cutoff = listing_start - datetime.timedelta(days=args.older_than)
+
+    chunks_plan = artifact_chunks.CHUNKS_DIR.split('/', 1)[1]
+    plans = [plan for plan in list_plans(client, args.s3_bucket) if plan != chunks_plan]
+
+    def plan_deletions(plan: str) -> tuple:
+        objects = list_objects(client, args.s3_bucket, '{}/{}/'.format(ARTIFACTS_DIR, plan))
+        live = live_branches(args.git_url_template, plan)
+        deleted = select_plan_deletions(plan, objects, live, args, cutoff)
+        deleted_keys = {o['Key'] for o in deleted}
+        manifests = [o['Key'] for o in objects if o['Key'] not in deleted_keys and
+                     o['Key'].endswith(artifact_chunks.MANIFEST_EXT)]
+        return plan, deleted, manifests
+
+    print('Listing artifacts of {} plans...'.format(len(plans)))
+    with ThreadPoolExecutor(max_workers=LISTING_THREADS) as executor:
+        results = list(executor.map(plan_deletions, plans))
+
+    deletions = {plan: deleted for plan, deleted, _ in results}
+    chunks = list_objects(client, args.s3_bucket, artifact_chunks.CHUNKS_DIR + '/')
+    if chunks:
+        manifests = [key for _, _, plan_manifests in results for key in plan_manifests]
+        chunk_cutoff = min(cutoff, listing_start - datetime.timedelta(
+            seconds=artifact_chunks.CHUNK_GRACE_PERIOD))
+        deletions[chunks_plan] = select_chunk_deletions(client, args.s3_bucket, chunks,
+                                                        manifests, chunk_cutoff)
+
+    print_report(deletions, args.dry_run)
+    if not args.dry_run:
+        keys = [o['Key'] for objects in deletions.values() for o in objects]
+        if delete_objects(client, args.s3_bucket, keys):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
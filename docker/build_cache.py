@@ -0,0 +1,458 @@
+"""Build caches (ccache, rebar3) shared between agents through a store.
+
+A store is either a local (e.g. network mounted) directory or an S3 bucket
+(any S3-compatible service, e.g. minio), given as 'DIR' or
+'s3://BUCKET[/PREFIX]'. Files are kept in the store content-addressed
+(objects/<sha256>), so that the same content is stored and transferred only
+once, and every cache has a manifest mapping its files to their digests.
+Every upload adds its changes to the manifest as a separate part, so that
+concurrent uploads of different agents never overwrite each other. Parts
+are compacted (dropping entries not used for MANIFEST_MAX_AGE_DAYS) once
+there are COMPACTION_THRESHOLD of them, and objects no longer referenced by
+any manifest are removed then.
+
+Use of entries is tracked through access and modification times of the
+files: restored files get the time of the last use of their entry, and
+entries whose files have been read or written since then are refreshed in
+the manifest on upload (at most once per ENTRY_TOUCH_AGE).
+
+Digests of local files are remembered in a state file next to the cache
+directory, so that only files changed since the last sync are hashed again.
+Only entries missing locally are downloaded and only new or changed ones are
+uploaded.
+"""
+
+__copyright__ = "Copyright (C) 2026 ACK CYFRONET AGH"
+__license__ = "This software is released under the MIT license cited in LICENSE.txt"
+
+
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_S3_URL = "https://storage.cloud.cyfronet.pl"
+TRANSFER_THREADS = 16
+HASH_CHUNK_SIZE = 1024 * 1024
+# Files that change on every build without carrying any reusable content
+EXCLUDED_PATTERNS = ["stats", "*.lock", "*.tmp*", "tmp/*", "ccache.conf"]
+COMPACTION_THRESHOLD = 16
+MANIFEST_MAX_AGE_DAYS = 30
+ENTRY_TOUCH_AGE = 24 * 3600
+MANIFESTS_PREFIX = "manifests/"
+OBJECTS_PREFIX = "objects/"
+# Objects are stored before manifest parts referencing them are written, so
+# recently stored ones are never removed as unreferenced
+OBJECT_GRACE_PERIOD = 2 * ENTRY_TOUCH_AGE
+
+
+def open_store(url, s3_url=DEFAULT_S3_URL):
+    """Returns a store (see module doc) for given url."""
+    if url.startswith("s3://"):
+        # boto3 is needed only by agents that use S3 stores
+        import boto3
+
+        bucket, _, prefix = url[len("s3://") :].partition("/")
+        client = boto3.session.Session().client(service_name="s3", endpoint_url=s3_url)
+        return {"type": "s3", "client": client, "bucket": bucket, "prefix": prefix}
+
+    root = os.path.abspath(url)
+    if not os.path.isdir(root):
+        # e.g. a network share that is not mounted - writing to the mount
+        # point would silently fill the local disk
+        raise FileNotFoundError(f"Build cache store {root} does not exist")
+    return {"type": "local", "root": root}
+
+
+def download(store, name, cache_dir):
+    """Fills cache_dir with entries of cache with given name missing in it.
+    Returns stats of the sync."""
+    os.makedirs(cache_dir, exist_ok=True)
+    remote = _read_manifest(store, name)
+    local = _scan(cache_dir)
+
+    missing = {
+        path: entry
+        for path, entry in remote.items()
+        if local.get(path, {}).get("sha256") != entry["sha256"]
+    }
+
+    def fetch(item):
+        path, entry = item
+        target = os.path.join(cache_dir, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        _get_object(store, entry["sha256"], target)
+        os.chmod(target, entry["mode"])
+        os.utime(target, (entry["updated"], entry["updated"]))
+        return path, entry
+
+    with ThreadPoolExecutor(max_workers=TRANSFER_THREADS) as executor:
+        fetched = list(executor.map(fetch, missing.items()))
+
+    _save_state(cache_dir, _scan(cache_dir, {path: e["sha256"] for path, e in fetched}))
+    return {
+        "hits": len(remote) - len(missing),
+        "downloaded": len(missing),
+        "downloaded_bytes": sum(entry["size"] for entry in missing.values()),
+    }
+
+
+def upload(store, name, cache_dir):
+    """Uploads entries of cache_dir that are not in the store yet and adds
+    them to the manifest of cache with given name. Returns stats of the
+    sync."""
+    local = _scan(cache_dir)
+    remote = _read_manifest(store, name)
+    # objects of entries close to expiry may be removed before the new
+    # manifest part is written, so they are stored again
+    reuse_cutoff = (
+        time.time() - MANIFEST_MAX_AGE_DAYS * 24 * 3600 + OBJECT_GRACE_PERIOD
+    )
+    stored_digests = {
+        entry["sha256"] for entry in remote.values() if entry["updated"] >= reuse_cutoff
+    }
+
+    changed = {
+        path: entry
+        for path, entry in local.items()
+        if remote.get(path, {}).get("sha256") != entry["sha256"]
+    }
+    used = {
+        path: entry
+        for path, entry in local.items()
+        if path not in changed
+        and entry["last_used"] - remote[path]["updated"] > ENTRY_TOUCH_AGE
+    }
+    new_objects = {
+        entry["sha256"]: path
+        for path, entry in changed.items()
+        if entry["sha256"] not in stored_digests
+    }
+
+    def send(item):
+        digest, path = item
+        _put_object(store, digest, os.path.join(cache_dir, path))
+
+    with ThreadPoolExecutor(max_workers=TRANSFER_THREADS) as executor:
+        list(executor.map(send, new_objects.items()))
+
+    if changed or used:
+        _write_manifest_part(store, name, dict(changed, **used))
+        _compact_manifest(store, name)
+
+    _save_state(cache_dir, local)
+    return {
+        "new": len(changed),
+        "uploaded": len(new_objects),
+        "uploaded_bytes": sum(local[path]["size"] for path in new_objects.values()),
+    }
+
+
+def format_stats(name, download_stats, upload_stats):
+    return (
+        f"Build cache {name}: {download_stats['hits']} entries up to date, "
+        f"{download_stats['downloaded']} restored from store "
+        f"({_format_size(download_stats['downloaded_bytes'])}), "
+        f"{upload_stats['new']} new after build, {upload_stats['uploaded']} "
+        f"uploaded ({_format_size(upload_stats['uploaded_bytes'])})"
+    )
+
+
+def _scan(cache_dir, known_digests=None):
+    """Returns a dict mapping paths of files in cache_dir to their size,
+    mode, digest and time of last use (access or modification). Digests are taken from known_digests or from the state
+    file for files whose size and mtime did not change."""
+    known_digests = known_digests or {}
+    state = _load_state(cache_dir)
+    entries = {}
+    for root, _dirs, files in os.walk(cache_dir):
+        for filename in files:
+            full_path = os.path.join(root, filename)
+            path = os.path.relpath(full_path, cache_dir)
+            if _is_excluded(path) or not os.path.isfile(full_path):
+                continue
+
+            stat = os.stat(full_path)
+            previous = state.get(path)
+            if path in known_digests:
+                digest = known_digests[path]
+            elif (
+                previous
+                and previous["size"] == stat.st_size
+                and previous["mtime_ns"] == stat.st_mtime_ns
+            ):
+                digest = previous["sha256"]
+            else:
+                digest = _sha256(full_path)
+
+            entries[path] = {
+                "sha256": digest,
+                "size": stat.st_size,
+                "mode": stat.st_mode & 0o777,
+                "mtime_ns": stat.st_mtime_ns,
+                "last_used": max(stat.st_atime, stat.st_mtime),
+            }
+    return entries
+
+
+def _is_excluded(path):
+    return any(
+        fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(os.path.basename(path), pattern)
+        for pattern in EXCLUDED_PATTERNS
+    )
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _state_path(cache_dir):
+    cache_dir = os.path.abspath(cache_dir)
+    return os.path.join(
+        os.path.dirname(cache_dir), f".{os.path.basename(cache_dir)}.build_cache.json"
+    )
+
+
+def _load_state(cache_dir):
+    try:
+        with open(_state_path(cache_dir), "r") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_state(cache_dir, state):
+    data = json.dumps(state).encode()
+    _atomic_write(_state_path(cache_dir), lambda f: f.write(data))
+
+
+def _manifest_parts_prefix(name):
+    return f"{MANIFESTS_PREFIX}{name}/"
+
+
+def _object_key(digest):
+    return f"{OBJECTS_PREFIX}{digest[:2]}/{digest}"
+
+
+def _read_manifest(store, name):
+    return _merge_parts(_read_manifest_parts(store, name).values())
+
+
+def _read_manifest_parts(store, name):
+    """Returns a dict mapping keys of manifest parts to their entries. Parts
+    removed meanwhile by compaction are skipped."""
+    parts = {}
+    for key, _modified in _list(store, _manifest_parts_prefix(name)):
+        if not key.endswith(".json"):
+            continue
+        data = _read(store, key)
+        if data is not None:
+            parts[key] = json.loads(data.decode())
+    return parts
+
+
+def _merge_parts(parts):
+    """Merges manifest parts, taking the most recently updated entry of
+    every path."""
+    manifest = {}
+    for part in parts:
+        for path, entry in part.items():
+            if path not in manifest or manifest[path]["updated"] <= entry["updated"]:
+                manifest[path] = entry
+    return manifest
+
+
+def _write_manifest_part(store, name, entries):
+    """Writes entries as a new manifest part. Entries without an update time
+    (new or used ones) are marked as updated now."""
+    now = time.time()
+    part = {
+        path: {
+            "sha256": entry["sha256"],
+            "size": entry["size"],
+            "mode": entry["mode"],
+            "updated": entry.get("updated", now),
+        }
+        for path, entry in entries.items()
+    }
+    key = f"{_manifest_parts_prefix(name)}{uuid.uuid4().hex}.json"
+    _write(store, key, json.dumps(part).encode())
+
+
+def _compact_manifest(store, name):
+    """Merges manifest parts into a single one, dropping entries that have
+    not been used for MANIFEST_MAX_AGE_DAYS, and removes objects that are no
+    longer referenced. Only parts that have been merged are removed, so
+    concurrent uploads and compactions never lose entries."""
+    parts = _read_manifest_parts(store, name)
+    if len(parts) < COMPACTION_THRESHOLD:
+        return
+
+    cutoff = time.time() - MANIFEST_MAX_AGE_DAYS * 24 * 3600
+    manifest = _merge_parts(parts.values())
+    manifest = {path: e for path, e in manifest.items() if e["updated"] >= cutoff}
+    _write_manifest_part(store, name, manifest)
+    for key in parts:
+        _delete(store, key)
+
+    _remove_unreferenced_objects(store)
+
+
+def _remove_unreferenced_objects(store):
+    """Removes objects that are not referenced by manifest of any cache,
+    except for ones stored within OBJECT_GRACE_PERIOD."""
+    cutoff = time.time() - OBJECT_GRACE_PERIOD
+    # objects are listed before manifests are read, so that entries added
+    # meanwhile are taken into account
+    candidates = [
+        key for key, modified in _list(store, OBJECTS_PREFIX) if modified < cutoff
+    ]
+    if not candidates:
+        return
+
+    names = {
+        key[len(MANIFESTS_PREFIX) :].rpartition("/")[0]
+        for key, _modified in _list(store, MANIFESTS_PREFIX)
+    }
+    referenced = set()
+    for name in names:
+        referenced.update(e["sha256"] for e in _read_manifest(store, name).values())
+
+    for key in candidates:
+        if os.path.basename(key) not in referenced:
+            _delete(store, key)
+
+
+def _get_object(store, digest, target):
+    if store["type"] == "s3":
+        store["client"].download_file(
+            store["bucket"], _s3_key(store, _object_key(digest)), target
+        )
+    else:
+        _atomic_write(
+            target,
+            lambda f: _copy_content(os.path.join(store["root"], _object_key(digest)), f),
+        )
+
+
+def _put_object(store, digest, source):
+    if store["type"] == "s3":
+        store["client"].upload_file(
+            source, store["bucket"], _s3_key(store, _object_key(digest))
+        )
+    else:
+        target = os.path.join(store["root"], _object_key(digest))
+        if os.path.exists(target):
+            # restarts the grace period, as for objects uploaded to S3 again
+            os.utime(target)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            _atomic_write(target, lambda f: _copy_content(source, f))
+
+
+def _read(store, key):
+    if store["type"] == "s3":
+        client = store["client"]
+        try:
+            response = client.get_object(Bucket=store["bucket"], Key=_s3_key(store, key))
+        except client.exceptions.NoSuchKey:
+            return None
+        return response["Body"].read()
+
+    try:
+        with open(os.path.join(store["root"], key), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _write(store, key, data):
+    if store["type"] == "s3":
+        store["client"].put_object(
+            Bucket=store["bucket"], Key=_s3_key(store, key), Body=data
+        )
+    else:
+        path = os.path.join(store["root"], key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _atomic_write(path, lambda f: f.write(data))
+
+
+def _list(store, prefix):
+    """Returns (key, modification time) pairs of objects with given prefix
+    (recursively)."""
+    if store["type"] == "s3":
+        keys = []
+        paginator = store["client"].get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=store["bucket"], Prefix=_s3_key(store, prefix)
+        ):
+            keys.extend(
+                (
+                    prefix + obj["Key"][len(_s3_key(store, prefix)) :],
+                    obj["LastModified"].timestamp(),
+                )
+                for obj in page.get("Contents", [])
+            )
+        return keys
+
+    keys = []
+    top = os.path.join(store["root"], prefix)
+    for root, _dirs, files in os.walk(top):
+        for filename in files:
+            path = os.path.join(root, filename)
+            try:
+                modified = os.path.getmtime(path)
+            except FileNotFoundError:
+                continue
+            keys.append((prefix + os.path.relpath(path, top), modified))
+    return keys
+
+
+def _delete(store, key):
+    if store["type"] == "s3":
+        store["client"].delete_object(Bucket=store["bucket"], Key=_s3_key(store, key))
+    else:
+        try:
+            os.remove(os.path.join(store["root"], key))
+        except FileNotFoundError:
+            pass
+
+
+def _s3_key(store, key):
+    return f"{store['prefix'].rstrip('/')}/{key}" if store["prefix"] else key
+
+
+def _atomic_write(path, write):
+    """Writes file at path with given function (taking the file object), so
+    that readers never see it partially written."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _copy_content(source, target_file):
+    with open(source, "rb") as f:
+        shutil.copyfileobj(f, target_file)
+
+
+def _format_size(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
@@ -0,0 +1,74 @@
+"""Detection of source files changed on a feature branch.
+
+Changes are computed with git against the merge base of HEAD and given base
+branch, so that work merged into the base branch in the meantime is not
+counted. Uncommitted changes of tracked files are included.
+"""
+
+__copyright__ = "Copyright (C) 2026 ACK CYFRONET AGH"
+__license__ = "This software is released under the MIT license cited in LICENSE.txt"
+
+
+import os
+import subprocess
+
+import yaml
+
+
+DEFAULT_BASE_BRANCH = "develop"
+BRANCH_CONFIG = "branchConfig.yaml"
+
+
+def fallback_branch(repo_dir="."):
+    """Returns the branch that the current one falls back to according to
+    branchConfig.yaml of given repository (see images_branch_config)."""
+    try:
+        with open(os.path.join(repo_dir, BRANCH_CONFIG), "r") as f:
+            return yaml.load(f, yaml.Loader)["default"]
+    except (IOError, KeyError, TypeError):
+        return DEFAULT_BASE_BRANCH
+
+
+def changed_files(base_branch, repo_dir="."):
+    """Returns a list of paths (relative to repo_dir) of files changed since
+    HEAD diverged from base_branch (local or remote one), or None if that
+    cannot be determined (or HEAD has not diverged, e.g. it is the base
+    branch itself, which makes comparing against it meaningless)."""
+    merge_base = None
+    for ref in [f"origin/{base_branch}", base_branch]:
+        merge_base = _git(repo_dir, "merge-base", "HEAD", ref)
+        if merge_base:
+            break
+
+    if not merge_base:
+        print(
+            f"WARNING: could not find merge base of HEAD and {base_branch} "
+            f"in {os.path.abspath(repo_dir)}"
+        )
+        return None
+
+    if merge_base == _git(repo_dir, "rev-parse", "HEAD"):
+        print(f"WARNING: HEAD has not diverged from {base_branch}")
+        return None
+
+    diff = _git(repo_dir, "diff", "--name-only", "--relative", merge_base.strip())
+    return None if diff is None else diff.splitlines()
+
+
+def erlang_modules(paths):
+    """Returns a set of names of Erlang modules defined by given files."""
+    return {
+        os.path.basename(path)[: -len(".erl")]
+        for path in paths
+        if path.endswith(".erl")
+    }
+
+
+def _git(repo_dir, *args):
+    result = subprocess.run(
+        ["git", "-C", repo_dir] + list(args),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    )
+    return result.stdout if result.returncode == 0 else None
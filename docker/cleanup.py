@@ -5,7 +5,9 @@ Copyright (C) 2015 ACK CYFRONET AGH
 This software is released under the MIT license cited in 'LICENSE.txt'
 
 Cleans up Docker containers given by their name or id. Running containers are
-killed first. Volumes are not removed automatically.
+killed first. Volumes are not removed automatically. Networks given with the
+--network option are removed after the containers, as are environment
+networks (see env_up.py --isolated-network) left without containers.
 
 Run the script with -h flag to learn about script's running options.
 """
@@ -25,6 +27,25 @@ parser.add_argument(
     nargs='*',
     help='IDs of dockers to be cleaned up')
 
+parser.add_argument(
+    '-n', '--network',
+    action='append',
+    default=[],
+    help='name of docker network to be removed (can be repeated)',
+    dest='networks')
+
 args = parser.parse_args()
 
-docker.remove(args.docker_ids, volumes=True, force=True, timeout=120)
+networks = list(args.networks)
+if args.docker_ids:
+    env_networks = docker.env_networks(args.docker_ids)
+    docker.remove(args.docker_ids, volumes=True, force=True, timeout=120)
+    # Networks still used by other dockers of the environment are removed
+    # along with the last of them
+    for network in env_networks:
+        if network not in networks and \
+                not docker.ps(all=True, quiet=True,
+                              filters=[('network', network)]):
+            networks.append(network)
+if networks:
+    docker.remove_networks(networks, timeout=120)
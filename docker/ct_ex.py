@@ -18,6 +18,7 @@ import os
 import sys
 
 import ct_utils
+import test_durations
 from environment import docker, dockers_config
 from environment.common import HOST_STORAGE_PATH, remove_dockers_and_volumes
 
@@ -34,9 +35,10 @@ def main():
 
     return_code = run_tests(args)
 
-    if return_code != 0 and not ct_utils.any_test_skipped(
-        os.path.join(SCRIPT_DIR, "test_distributed/logs/*/surefire.xml")
-    ):
+    report_path = os.path.join(SCRIPT_DIR, "test_distributed/logs/*/surefire.xml")
+    test_durations.record_reports(report_path, "ct_ex")
+
+    if return_code != 0 and not ct_utils.any_test_skipped(report_path):
         return_code = 0
 
     sys.exit(return_code)
@@ -3,7 +3,9 @@
 """Runs common tests in erlang using one-env.
 
 The output is put into 'test_distributed/logs'. The (init|end)_per_suite
-"testcases" are removed from the surefire.xml output.
+"testcases" are removed from the surefire.xml output. With --rerun-failed,
+only the cases that failed in the last run are run again and their results
+are applied to the last report.
 
 All paths used are relative to script's path, not to the running user's CWD.
 Run the script with -h flag to learn about script's running options.
@@ -20,6 +22,8 @@ import re
 import sys
 
 import ct_utils
+import surefire
+import test_durations
 from environment import docker, dockers_config
 from environment.common import HOST_STORAGE_PATH, remove_dockers_and_volumes
 
@@ -28,10 +32,17 @@ sys.path.insert(0, os.path.join(SCRIPT_DIR, "bamboos/docker"))
 
 COVER_SPEC = "cover.spec"
 COVER_TMP_SPEC = "cover_tmp.spec"
+RERUN_SPEC = "rerun_failed.spec"
 
 
 def main():
-    args = ct_utils.parse_args()
+    args = parse_args()
+
+    report_path = os.path.join(SCRIPT_DIR, "test_distributed/logs/*/surefire.xml")
+    previous_report = None
+    if args.rerun_failed:
+        previous_report = prepare_rerun(report_path)
+
     args = configure_cover(args)
 
     dockers_config.ensure_image(args, "image", "worker")
@@ -39,14 +50,65 @@ def main():
 
     return_code = run_tests(args)
 
-    if return_code != 0 and not ct_utils.any_test_skipped(
-        os.path.join(SCRIPT_DIR, "test_distributed/logs/*/surefire.xml")
-    ):
+    test_durations.record_reports(report_path, "ct_onenv")
+
+    if previous_report:
+        report_path = apply_rerun(previous_report, report_path)
+
+    if return_code != 0 and not ct_utils.any_test_skipped(report_path):
         return_code = 0
 
     sys.exit(return_code)
 
 
+def parse_args():
+    parser = ct_utils.create_arg_parser()
+
+    parser.add_argument(
+        "--rerun-failed",
+        action="store_true",
+        default=False,
+        help="run again only the test cases that failed in the last run "
+        "(according to its surefire.xml)",
+        dest="rerun_failed",
+    )
+
+    return parser.parse_args()
+
+
+def prepare_rerun(report_path):
+    previous_report = surefire.last_report(report_path)
+    failed = surefire.failed_cases(previous_report) if previous_report else []
+    if not failed:
+        print(f"No failed test cases to rerun in {previous_report}")
+        sys.exit(0)
+
+    print(f"Rerunning failed test cases from {previous_report}:")
+    for suite, groups, case in failed:
+        print(f"    {suite} {'/'.join(groups or ['*'])} {case or '*'}")
+
+    surefire.write_rerun_spec(
+        failed,
+        os.path.join(SCRIPT_DIR, "test_distributed", RERUN_SPEC),
+        lambda suite: os.path.dirname(ct_utils.find_suite_file(f"{suite}.erl")) or ".",
+    )
+
+    return previous_report
+
+
+def apply_rerun(previous_report, report_path):
+    os.remove(os.path.join(SCRIPT_DIR, "test_distributed", RERUN_SPEC))
+
+    rerun_report = surefire.last_report(report_path)
+    if not rerun_report or rerun_report == previous_report:
+        return report_path
+
+    surefire.merge_rerun(previous_report, rerun_report, rerun_report)
+    surefire.retire_report(previous_report)
+
+    return rerun_report
+
+
 def configure_cover(args):
     if cover_override := os.environ.get("bamboo_coverOptionOverride"):
         print("----------------------------------------------------")
@@ -153,7 +215,6 @@ def prepare_ct_command(args):
     ct_command = [
         "ct_run",
         "-abort_if_missing_suites",
-        "-dir", ".",
         "-logdir", "./logs/",
         "-ct_hooks",
         "cth_surefire", '[{path, "surefire.xml"}]',
@@ -174,17 +235,22 @@ def prepare_ct_command(args):
     )
     ct_command.extend(code_paths)
 
-    if args.suites:
-        ct_command.append("-suite")
-        ct_command.extend([locate_suite(s) for s in args.suites])
+    if args.rerun_failed:
+        ct_command.extend(["-spec", RERUN_SPEC])
+    else:
+        ct_command.extend(["-dir", "."])
+
+        if args.suites:
+            ct_command.append("-suite")
+            ct_command.extend([locate_suite(s) for s in args.suites])
 
-    if args.groups:
-        ct_command.append("-group")
-        ct_command.extend(args.groups)
+        if args.groups:
+            ct_command.append("-group")
+            ct_command.extend(args.groups)
 
-    if args.cases:
-        ct_command.append("-case")
-        ct_command.extend(args.cases)
+        if args.cases:
+            ct_command.append("-case")
+            ct_command.extend(args.cases)
 
     if args.cover:
         ct_command.extend(["-cover", COVER_TMP_SPEC])
@@ -7,7 +7,12 @@ This software is released under the MIT license cited in 'LICENSE.txt'
 Runs oneprovider integration tests, providing Erlang's ct_run with every
 environmental argument it needs for successful run. The output is put into
 'test_distributed/logs'. The (init|end)_per_suite "testcases" are removed from
-the surefire.xml output.
+the surefire.xml output. With --shards, suites are split between several test
+masters running concurrently and their reports are merged into one. With
+--rerun-failed, only the cases that failed in the last run are run again and
+their results are applied to the last report. With --cover-changed-since,
+only modules changed on the current branch are instrumented and coverage of
+the others is taken from the last cover data.
 
 All paths used are relative to script's path, not to the running user's CWD.
 Run the script with -h flag to learn about script's running options.
@@ -22,27 +27,62 @@ import os
 import platform
 import re
 import shutil
+import sqlite3
 import sys
-import time
 import glob
 import fnmatch
-import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.insert(0, 'bamboos/docker')
-from environment import docker, dockers_config
-from environment.common import HOST_STORAGE_PATH, remove_dockers_and_volumes
+import changed_sources
+import surefire
+import test_durations
+import test_impact
+from environment import admission, docker, dockers_config
+from environment.common import HOST_STORAGE_PATH, generate_uid, \
+    remove_dockers_and_volumes, remove_env_dockers, remove_stale_envs
 
 
 def skipped_test_exists(junit_report_path):
-    reports = glob.glob(junit_report_path)
     # if there are many reports, check only the last one
-    reports.sort()
-    tree = ElementTree.parse(reports[-1])
-    testsuites = tree.getroot()
-    for testsuite in testsuites:
-        if testsuite.attrib['skipped'] != '0':
-            return True
-    return False
+    report = surefire.last_report(junit_report_path)
+    return report is not None and surefire.report_summary(report)['skipped'] > 0
+
+
+def all_cover_modules(ebin_dirs):
+    """Returns names of all modules compiled into given directories (and
+    their subdirectories)."""
+    return [os.path.basename(beam)[:-len('.beam')]
+            for ebin_dir in ebin_dirs
+            for beam in glob.glob(os.path.join(ebin_dir, '**', '*.beam'),
+                                  recursive=True)]
+
+
+def changed_cover_modules(base_branch, ebin_dirs):
+    """Returns a set of covered modules changed since the current branch
+    diverged from base_branch (including modules that include changed
+    headers), or None if changes cannot be determined."""
+    changed = changed_sources.changed_files(base_branch, script_dir)
+    if changed is None:
+        print('WARNING: running full cover analysis')
+        return None
+
+    modules = changed_sources.erlang_modules(changed)
+    headers = [path for path in changed if path.endswith('.hrl')]
+    if headers:
+        modules |= test_impact.modules_including(headers, script_dir)
+    modules &= set(all_cover_modules(ebin_dirs))
+    print('Instrumenting modules changed since {0}: {1}'.format(
+        base_branch, ', '.join(sorted(modules)) or 'none'))
+    sys.stdout.flush()
+    return modules
+
+
+def last_coverdata():
+    """Returns the most recently written cover data in logs."""
+    coverdata = glob.glob(os.path.join(script_dir, 'test_distributed', 'logs',
+                                       '**', 'all.coverdata'), recursive=True)
+    return max(coverdata, key=os.path.getmtime) if coverdata else None
 
 
 def locate_suite(name):
@@ -60,6 +100,28 @@ def locate_suite(name):
     return find_suite_file(name)
 
 
+def find_all_suites():
+    suites = []
+    for root, dirs, files in os.walk('test_distributed'):
+        for name in fnmatch.filter(files, '*_SUITE.erl'):
+            suites.append(
+                os.path.relpath(os.path.join(root, name), 'test_distributed'))
+    return sorted(suites)
+
+
+def partition_suites(suites, shards):
+    """Splits suites into at most given number of non-empty shards with
+    similar total duration, according to durations of previous runs."""
+    try:
+        durations = test_durations.suite_durations('ct_run')
+    except (sqlite3.Error, OSError) as e:
+        print('WARNING: could not read test durations, splitting suites evenly: '
+              '{0}'.format(e))
+        durations = {}
+    return test_durations.partition(suites, shards, durations,
+                                    key=test_durations.suite_name)
+
+
 def find_suite_file(name):
     for root, dirs, files in os.walk('test_distributed'):
         if name in files:
@@ -111,6 +173,33 @@ parser.add_argument(
     help='run cover analysis',
     dest='cover')
 
+parser.add_argument(
+    '--cover-changed-since',
+    default=None,
+    metavar='BRANCH',
+    help='run cover analysis (implies --cover) instrumenting only modules '
+         'changed since the current branch diverged from BRANCH - coverage '
+         'of other modules is taken from the last cover data in logs',
+    dest='cover_changed_since')
+
+parser.add_argument(
+    '--affected-only',
+    action='store_true',
+    default=False,
+    help='run only suites affected by changes made since the current branch '
+         'diverged from the base branch (unless suites are given explicitly); '
+         'all suites are run if ${0} ENV variable is set to true'.format(
+             test_impact.FULL_RUN_VAR),
+    dest='affected_only')
+
+parser.add_argument(
+    '--base-branch',
+    default=None,
+    help='base branch for --affected-only (by default the one from '
+         'branchConfig.yaml or {0})'.format(
+             changed_sources.DEFAULT_BASE_BRANCH),
+    dest='base_branch')
+
 parser.add_argument(
     '--stress',
     action='store_true',
@@ -144,11 +233,57 @@ parser.add_argument(
     help='if set, environment will not be cleaned up after tests',
     dest='no_clean')
 
+parser.add_argument(
+    '--rerun-failed',
+    action='store_true',
+    default=False,
+    help='run again only the test cases that failed in the last run '
+         '(according to its surefire.xml)',
+    dest='rerun_failed')
+
+parser.add_argument(
+    '--shards',
+    type=int,
+    default=1,
+    help='number of test masters, each with its own environment, that '
+         'suites are split between and run concurrently',
+    dest='shards')
+
+parser.add_argument(
+    '--concurrent',
+    action='store_true',
+    default=False,
+    help='allow other test runs on this host at the same time - clean up '
+         'only dockers of own environment and wait until the CPUs and '
+         'memory it needs are not reserved by other runs',
+    dest='concurrent')
+
+parser.add_argument(
+    '--cpus',
+    type=int,
+    default=admission.DEFAULT_ENV_CPUS,
+    help='number of CPUs reserved for the environment in concurrent mode',
+    dest='cpus')
+
+parser.add_argument(
+    '--memory',
+    type=int,
+    default=admission.DEFAULT_ENV_MEMORY_MB,
+    help='memory (in MB) reserved for the environment in concurrent mode',
+    dest='memory')
+
 args = parser.parse_args()
 dockers_config.ensure_image(args, 'image', 'worker')
 
+if args.rerun_failed and args.shards > 1:
+    print('ERROR: --rerun-failed cannot be combined with --shards')
+    sys.exit(1)
+
 script_dir = os.path.dirname(os.path.abspath(__file__))
-uid = str(int(time.time()))
+uid = generate_uid()
+
+if args.cover_changed_since:
+    args.cover = True
 
 if 'bamboo_coverOptionOverride' in os.environ:
     print("----------------------------------------------------")
@@ -202,19 +337,24 @@ with open(cover_template, 'r') as template, open(new_cover, 'w') as cover:
         else:
             print(line, file=cover)
 
+    changed_modules = None
+    if args.cover and args.cover_changed_since:
+        changed_modules = changed_cover_modules(args.cover_changed_since,
+                                                docker_dirs)
+        if changed_modules is not None:
+            excl_mods.extend(sorted(set(all_cover_modules(docker_dirs)) -
+                                    changed_modules - set(excl_mods)))
+
     print('{{incl_dirs_r, ["{0}]}}.'.format(', "'.join(incl_dirs)), file=cover)
     print('{{excl_mods, [{0}]}}.'.format(
         ', '.join(excl_mods)), file=cover)
 
 ct_command = ['ct_run',
               '-abort_if_missing_suites',
-              '-dir', '.',
-              '-logdir', './logs/',
               '-ct_hooks', 'cth_surefire', '[{path, "surefire.xml"}]',
               'and', 'cth_logger', 'and', 'cth_env_up', 'and', 'cth_mock',
               'and', 'cth_posthook',
               '-noshell',
-              '-name', 'testmaster@testmaster.{0}.test'.format(uid),
               '-include', './include', '../include', '../_build/default/lib']
 
 code_paths = ['-pa']
@@ -225,17 +365,48 @@ code_paths.extend(
     glob.glob(os.path.join(script_dir, '_build/default/lib', '*', 'ebin')))
 ct_command.extend(code_paths)
 
-if args.suites:
-    ct_command.append('-suite')
-    ct_command.extend([locate_suite(s) for s in args.suites])
-
-if args.cases:
-    ct_command.append('-case')
-    ct_command.extend(args.cases)
-
-if args.groups:
-    ct_command.append('-group')
-    ct_command.extend(args.groups)
+suites = [locate_suite(s) for s in args.suites] if args.suites else []
+
+report_path = "test_distributed/logs/*/surefire.xml"
+rerun_spec = os.path.join(script_dir, 'test_distributed', 'rerun_failed.spec')
+if args.rerun_failed:
+    previous_report = surefire.last_report(report_path)
+    failed = surefire.failed_cases(previous_report) if previous_report else []
+    if not failed:
+        print('No failed test cases to rerun in {0}'.format(previous_report))
+        os.remove(new_cover)
+        sys.exit(0)
+
+    print('Rerunning failed test cases from {0}:'.format(previous_report))
+    for failed_suite, failed_groups, failed_case in failed:
+        print('    {0} {1} {2}'.format(failed_suite,
+                                       '/'.join(failed_groups or ['*']),
+                                       failed_case or '*'))
+    surefire.write_rerun_spec(
+        failed, rerun_spec,
+        lambda s: os.path.dirname(find_suite_file(s + '.erl')) or '.')
+    ct_command.extend(['-spec', os.path.basename(rerun_spec)])
+    suites = []
+else:
+    if args.affected_only and not suites:
+        affected = test_impact.affected_erlang_suites(
+            args.base_branch or changed_sources.fallback_branch())
+        if affected == []:
+            print('No suites are affected by the changes, nothing to run')
+            os.remove(new_cover)
+            sys.exit(0)
+        elif affected:
+            suites = [find_suite_file(s + '.erl') for s in affected]
+
+    ct_command.extend(['-dir', '.'])
+
+    if args.cases:
+        ct_command.append('-case')
+        ct_command.extend(args.cases)
+
+    if args.groups:
+        ct_command.append('-group')
+        ct_command.extend(args.groups)
 
 if args.stress_time:
     ct_command.extend(['-env', 'stress_time', args.stress_time])
@@ -332,9 +503,7 @@ elif args.cover:
             with open(file, 'w') as jsonFile:
                 jsonFile.write(json.dumps(data))
 
-ct_command.extend(['-erl_args', '-enable-feature', 'maybe_expr'])
-
-command = '''
+command_template = '''
 import os, shutil, subprocess, sys, stat
 
 os.environ['HOME'] = '/root'
@@ -370,23 +539,14 @@ except:
 command = {cmd}
 ret = subprocess.call(command)
 
-import xml.etree.ElementTree as ElementTree, glob, re
-for file in glob.glob('logs/*/surefire.xml'):
-    tree = ElementTree.parse(file)
-    for suite in tree.findall('.//testsuite'):
-        for test in suite.findall('testcase'):
-            match = re.match('(init|end)_per_suite', test.attrib['name'])
-            if match is not None:
-                suite.remove(test)
-    tree.write(file)
+import glob
+sys.path.insert(0, '{surefire_dir}')
+import surefire
+for file in glob.glob('{logdir}/ct_run.{node_name}.*/surefire.xml'):
+    surefire.process_report(file, '(init|end)_per_suite')
 
 sys.exit(ret)
 '''
-command = command.format(
-    uid=os.geteuid(),
-    gid=os.getegid(),
-    cmd=ct_command,
-    shed_privileges=(platform.system() == 'Linux'))
 
 volumes = []
 
@@ -403,20 +563,192 @@ if args.no_clean:
 if os.path.isdir(expanduser('~/.docker')):
     volumes += [(expanduser('~/.docker'), '/tmp/docker_config', 'ro')]
 
-remove_dockers_and_volumes()
-
-ret = docker.run(tty=True,
-                 rm=True,
-                 interactive=True,
-                 workdir=os.path.join(script_dir, 'test_distributed'),
-                 volumes=volumes,
-                 reflect=[(script_dir, 'rw'),
-                          ('/var/run/docker.sock', 'rw'),
-                          (HOST_STORAGE_PATH, 'rw')],
-                 name='testmaster_{0}'.format(uid),
-                 hostname='testmaster.{0}.test'.format(uid),
-                 image=args.image,
-                 command=['python', '-c', command])
+volumes += [surefire.docker_volume()]
+
+
+def run_testmaster(env_uid, suites, stdout=None, logdir='logs'):
+    """Runs ct_run for given suites (all if empty) in a test master docker
+    with its own environment identified by env_uid. logdir is relative to
+    test_distributed."""
+    node_name = 'testmaster@testmaster.{0}.test'.format(env_uid)
+    cmd = ct_command + ['-logdir', './{0}/'.format(logdir), '-name', node_name]
+    if suites:
+        cmd.append('-suite')
+        cmd.extend(suites)
+    cmd.extend(['-erl_args', '-enable-feature', 'maybe_expr'])
+
+    command = command_template.format(
+        uid=os.geteuid(),
+        gid=os.getegid(),
+        cmd=cmd,
+        node_name=node_name,
+        logdir=logdir,
+        surefire_dir=surefire.CONTAINER_DIR,
+        shed_privileges=(platform.system() == 'Linux'))
+
+    if args.concurrent:
+        admission.admit(env_uid, args.cpus, args.memory)
+
+    try:
+        return docker.run(tty=stdout is None,
+                          rm=True,
+                          interactive=stdout is None,
+                          workdir=os.path.join(script_dir, 'test_distributed'),
+                          volumes=volumes,
+                          reflect=[(script_dir, 'rw'),
+                                   ('/var/run/docker.sock', 'rw'),
+                                   (HOST_STORAGE_PATH, 'rw')],
+                          name='testmaster_{0}'.format(env_uid),
+                          hostname='testmaster.{0}.test'.format(env_uid),
+                          envs={docker.ENV_ID_VAR: env_uid},
+                          labels={docker.ENV_LABEL: env_uid},
+                          image=args.image,
+                          command=['python', '-c', command],
+                          stdout=stdout)
+    finally:
+        if args.concurrent:
+            if not args.no_clean:
+                remove_env_dockers(env_uid)
+            admission.release(env_uid)
+
+
+def shard_logdir(shard_uid):
+    """Returns logdir (relative to test_distributed) of given shard. Every
+    shard has its own one, as concurrent ct_run processes would race on the
+    index files of a shared one."""
+    return os.path.join('logs', 'shard.{0}'.format(shard_uid))
+
+
+def run_shard(shard_num, env_uid, suites):
+    logs_dir = os.path.join(script_dir, 'test_distributed', 'logs')
+    os.makedirs(os.path.join(script_dir, 'test_distributed',
+                             shard_logdir(env_uid)), exist_ok=True)
+    log_path = os.path.join(logs_dir,
+                            'shard{0}.{1}.log'.format(shard_num, env_uid))
+    print('Shard {0}: running {1} in environment {2}, output in {3}'.format(
+        shard_num, ', '.join(suites), env_uid, log_path))
+    sys.stdout.flush()
+
+    with open(log_path, 'w') as log:
+        ret = run_testmaster(env_uid, suites, stdout=log,
+                             logdir=shard_logdir(env_uid))
+
+    print('Shard {0}: finished with code {1}'.format(shard_num, ret))
+    sys.stdout.flush()
+    return ret
+
+
+def merge_shards_output(shard_uids):
+    """Merges surefire reports (and cover data, if any) of all shards into
+    a single report directory, which is returned."""
+    logs_dir = os.path.join(script_dir, 'test_distributed', 'logs')
+    merged_dir = os.path.join(logs_dir, 'ct_run.shards.{0}'.format(uid))
+    run_dirs = []
+    for shard_uid in shard_uids:
+        run_dirs.extend(glob.glob(os.path.join(
+            script_dir, 'test_distributed', shard_logdir(shard_uid),
+            'ct_run.testmaster@testmaster.{0}.test.*'.format(shard_uid))))
+
+    reports = [os.path.join(d, 'surefire.xml') for d in run_dirs
+               if os.path.isfile(os.path.join(d, 'surefire.xml'))]
+    surefire.merge_reports(reports, os.path.join(merged_dir, 'surefire.xml'))
+    # Keep reports of shards, but under a name that is not picked up along
+    # with the merged one
+    for report in reports:
+        shutil.move(report, report[:-len('.xml')] + '.shard.xml')
+
+    coverdata = []
+    for run_dir in run_dirs:
+        coverdata.extend(glob.glob(os.path.join(run_dir, '**', '*.coverdata'),
+                                   recursive=True))
+    if coverdata:
+        merge_cmd = 'cover:start(), [cover:import(F) || F <- {0}], ' \
+                    'cover:export("{1}"), init:stop().'.format(
+                        '[{0}]'.format(', '.join(
+                            '"{0}"'.format(f) for f in coverdata)),
+                        os.path.join(merged_dir, 'all.coverdata'))
+        run_erl(merge_cmd)
+
+    return merged_dir
+
+
+def merge_previous_coverdata(previous_coverdata, instrumented, run_dir):
+    """Adds coverage of modules that were not instrumented in the run (as
+    they have not changed) from previous cover data to the cover data of
+    the run in run_dir."""
+    current = glob.glob(os.path.join(run_dir, '**', 'all.coverdata'),
+                        recursive=True)
+    target = current[0] if current else os.path.join(run_dir, 'all.coverdata')
+    print('Merging coverage of unchanged modules from {0} into {1}'.format(
+        previous_coverdata, target))
+    sys.stdout.flush()
+
+    # Data of instrumented modules is dropped, as it refers to their
+    # previous versions. cover:export/2 exports a single module, hence
+    # the modules that are kept go through temporary files.
+    merge_cmd = 'cover:start(), ok = cover:import("{0}"), ' \
+                'Kept = cover:imported_modules() -- [{1}], ' \
+                'Files = [begin F = "{2}" ++ atom_to_list(M), ' \
+                'ok = cover:export(F, M), F end || M <- Kept], ' \
+                'cover:stop(), cover:start(), ' \
+                '[ok = cover:import(F) || F <- {3} ++ Files], ' \
+                'ok = cover:export("{4}"), [file:delete(F) || F <- Files], ' \
+                'init:stop().'.format(
+                    previous_coverdata,
+                    ', '.join("'{0}'".format(m) for m in sorted(instrumented)),
+                    os.path.join(run_dir, 'previous.coverdata.'),
+                    '[{0}]'.format(', '.join('"{0}"'.format(f)
+                                             for f in current)),
+                    target)
+    if run_erl(merge_cmd) != 0:
+        print('WARNING: could not merge previous cover data')
+
+
+def run_erl(expression):
+    """Evaluates given Erlang expression in a test master docker."""
+    return docker.run(rm=True,
+                      reflect=[(script_dir, 'rw')],
+                      user=str(os.geteuid()),
+                      image=args.image,
+                      command=['erl', '-noshell', '-eval', expression])
+
+
+if args.concurrent:
+    remove_stale_envs()
+else:
+    remove_dockers_and_volumes()
+
+previous_coverdata = last_coverdata() if changed_modules is not None else None
+
+if args.shards > 1:
+    shards = partition_suites(suites or find_all_suites(), args.shards)
+    shard_uids = [generate_uid() for _ in shards]
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        rets = list(executor.map(run_shard, range(len(shards)), shard_uids,
+                                 shards))
+    ret = next((r for r in rets if r != 0), 0)
+    report_path = os.path.join(merge_shards_output(shard_uids), 'surefire.xml')
+else:
+    ret = run_testmaster(uid, suites)
+
+test_durations.record_reports(report_path, 'ct_run')
+
+if changed_modules is not None:
+    last_run_report = surefire.last_report(report_path)
+    if not previous_coverdata:
+        print('WARNING: no previous cover data, coverage of unchanged '
+              'modules is missing')
+    elif last_run_report:
+        merge_previous_coverdata(previous_coverdata, changed_modules,
+                                 os.path.dirname(last_run_report))
+
+if args.rerun_failed:
+    os.remove(rerun_spec)
+    rerun_report = surefire.last_report(report_path)
+    if rerun_report and rerun_report != previous_report:
+        surefire.merge_rerun(previous_report, rerun_report, rerun_report)
+        surefire.retire_report(previous_report)
+        report_path = rerun_report
 
 os.remove(new_cover)
 if args.cover:
@@ -424,7 +756,7 @@ if args.cover:
         os.remove(file)
         shutil.move(file + '.bak', file)
 
-if ret != 0 and not skipped_test_exists("test_distributed/logs/*/surefire.xml"):
+if ret != 0 and not skipped_test_exists(report_path):
     ret = 0
 
 sys.exit(ret)
@@ -10,10 +10,10 @@ import glob
 import os
 import platform
 import sys
-import xml.etree.ElementTree as ElementTree
 from os.path import expanduser
 
 import images_branch_config
+import surefire
 from environment import docker
 
 
@@ -65,21 +65,21 @@ ct_env.update({ct_env})
 
 ret = subprocess.run(ct_cmd, env=ct_env).returncode
 
-import xml.etree.ElementTree as ElementTree, glob, re
+import glob
+sys.path.insert(0, '{surefire_dir}')
+import surefire
 for file in glob.glob('**/logs/*/surefire.xml', recursive=True):
-    tree = ElementTree.parse(file)
-    for suite in tree.findall('.//testsuite'):
-        for test in suite.findall('testcase'):
-            match = re.match('(init|end)_per_(suite|group)', test.attrib['name'])
-            if match is not None:
-                suite.remove(test)
-    tree.write(file)
+    surefire.process_report(file, '(init|end)_per_(suite|group)')
 
 sys.exit(ret)
 """
 
 
 def parse_args():
+    return create_arg_parser().parse_args()
+
+
+def create_arg_parser():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         description="Run Common Tests.",
@@ -191,7 +191,7 @@ def parse_args():
         dest="rsync",
     )
 
-    return parser.parse_args()
+    return parser
 
 
 def get_docker_volumes():
@@ -200,6 +200,7 @@ def get_docker_volumes():
         dir_path = expanduser(os.path.join("~", dir_name))
         if os.path.isdir(dir_path):
             volumes.append((dir_path, os.path.join("/tmp", dir_name), "ro"))
+    volumes.append(surefire.docker_volume())
 
     return volumes
 
@@ -212,6 +213,7 @@ def get_docker_command(ct_cmd, ct_env):
         ct_env=ct_env,
         user_home=expanduser("~"),
         config_dirs=CONFIG_DIRS,
+        surefire_dir=surefire.CONTAINER_DIR,
         shed_privileges=(platform.system() == "Linux"),
     )
 
@@ -269,6 +271,5 @@ def any_test_skipped(junit_report_path):
     reports = glob.glob(junit_report_path)
     # if there are many reports, check only the last one
     reports.sort()
-    tree = ElementTree.parse(reports[-1])
 
-    return any(test_suite.attrib["skipped"] != "0" for test_suite in tree.getroot())
+    return surefire.report_summary(reports[-1])["skipped"] > 0
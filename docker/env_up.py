@@ -14,7 +14,7 @@ Run the script with -h flag to learn about script's running options.
 import argparse
 import json
 
-from environment import env, dockers_config
+from environment import env, dockers_config, couchbase
 
 parser = argparse.ArgumentParser(
     formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -132,6 +132,24 @@ parser.add_argument(
     help='path to a directory where the logs will be stored',
     dest='logdir')
 
+parser.add_argument(
+    '-cbh', '--couchbase-host',
+    action='append',
+    default=None,
+    type=couchbase.parse_docker_host,
+    help='remote docker host in format user@hostname[:port] to start '
+         'a single-node couchbase cluster on (can be repeated, one cluster '
+         'per host); overrides couchbase_hosts from the json configuration',
+    dest='couchbase_hosts')
+
+parser.add_argument(
+    '-in', '--isolated-network',
+    action='store_true',
+    default=False,
+    help='attach dockers to a dedicated docker network, where they resolve '
+         'each other by hostnames',
+    dest='isolated_network')
+
 parser.add_argument(
     'config_path',
     action='store',
@@ -158,6 +176,8 @@ output = env.up(args.config_path, image=args.image, ceph_image=args.ceph_image,
                 bin_op_worker=args.bin_op_worker,
                 bin_cluster_worker=args.bin_cluster_worker,
                 bin_onepanel=args.bin_onepanel,
-                bin_oc=args.bin_oc, logdir=args.logdir)
+                bin_oc=args.bin_oc, logdir=args.logdir,
+                couchbase_hosts=args.couchbase_hosts,
+                isolated_network=args.isolated_network)
 
 print(json.dumps(output))
@@ -0,0 +1,144 @@
+# coding=utf-8
+"""Copyright (C) 2026 ACK CYFRONET AGH
+This software is released under the MIT license cited in 'LICENSE.txt'
+
+Budgets CPU and memory between environments running concurrently on one host.
+
+Every test run reserves the resources its environment is expected to use in
+a registry kept under REGISTRY_DIR (one file per environment). A reservation
+is granted when it fits within the host's resources together with the
+reservations of other live runs - otherwise admit waits for them to finish.
+Reservations of runs whose process is gone are stale and are dropped.
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import time
+
+REGISTRY_DIR = '/tmp/bamboos_envs'
+DEFAULT_ENV_CPUS = 4
+DEFAULT_ENV_MEMORY_MB = 8192
+ADMISSION_CHECK_INTERVAL = 10
+# Part of the host memory that may be reserved by environments
+MEMORY_BUDGET_RATIO = 0.9
+
+
+class AdmissionTimeout(Exception):
+    pass
+
+
+def host_resources():
+    """Returns a tuple (cpus, memory in MB) of resources available on host."""
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    return os.cpu_count(), memory // (1024 * 1024)
+
+
+def admit(env_id, cpus, memory_mb, timeout=None):
+    """Reserves resources for environment identified by env_id, waiting until
+    they are available. A run that is alone on the host is always admitted,
+    even if it requests more than the host has.
+    """
+    host_cpus, host_memory_mb = host_resources()
+    memory_budget_mb = host_memory_mb * MEMORY_BUDGET_RATIO
+    deadline = time.time() + timeout if timeout is not None else None
+    announced = False
+
+    while True:
+        with _registry_lock():
+            reservations = _live_reservations()
+            used_cpus = sum(r['cpus'] for r in reservations.values())
+            used_memory_mb = sum(r['memory_mb'] for r in reservations.values())
+
+            if not reservations or (
+                    used_cpus + cpus <= host_cpus and
+                    used_memory_mb + memory_mb <= memory_budget_mb):
+                _write_reservation(env_id, {
+                    'pid': os.getpid(),
+                    'cpus': cpus,
+                    'memory_mb': memory_mb,
+                    'admitted': time.time()
+                })
+                return
+
+        if deadline is not None and time.time() > deadline:
+            raise AdmissionTimeout(
+                'Timeout while waiting for {0} CPUs and {1} MB of memory '
+                'for environment {2}'.format(cpus, memory_mb, env_id))
+
+        if not announced:
+            print('Waiting for {0} CPUs and {1} MB of memory to be released '
+                  'by environments: {2}'.format(cpus, memory_mb,
+                                                ', '.join(reservations)))
+            announced = True
+        time.sleep(ADMISSION_CHECK_INTERVAL)
+
+
+def release(env_id):
+    """Releases resources reserved for environment identified by env_id."""
+    with _registry_lock():
+        _remove_reservation(env_id)
+
+
+def stale_envs():
+    """Drops reservations of runs whose process is gone and returns ids of
+    their environments.
+    """
+    with _registry_lock():
+        stale = [env_id for env_id, reservation in _reservations().items()
+                 if not _process_alive(reservation['pid'])]
+        for env_id in stale:
+            _remove_reservation(env_id)
+        return stale
+
+
+@contextlib.contextmanager
+def _registry_lock():
+    if not os.path.exists(REGISTRY_DIR):
+        os.makedirs(REGISTRY_DIR, exist_ok=True)
+    with open(os.path.join(REGISTRY_DIR, '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _reservations():
+    reservations = {}
+    for filename in os.listdir(REGISTRY_DIR):
+        if filename.endswith('.json'):
+            with open(os.path.join(REGISTRY_DIR, filename), 'r') as f:
+                reservations[filename[:-len('.json')]] = json.load(f)
+    return reservations
+
+
+def _live_reservations():
+    return {env_id: reservation
+            for env_id, reservation in _reservations().items()
+            if _process_alive(reservation['pid'])}
+
+
+def _write_reservation(env_id, reservation):
+    with open(_reservation_path(env_id), 'w') as f:
+        json.dump(reservation, f)
+
+
+def _remove_reservation(env_id):
+    if os.path.exists(_reservation_path(env_id)):
+        os.remove(_reservation_path(env_id))
+
+
+def _reservation_path(env_id):
+    return os.path.join(REGISTRY_DIR, '{0}.json'.format(env_id))
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -25,7 +25,7 @@ def _node_up(image, uid):
         name=hostname, hostname=hostname)
 
     settings = docker.inspect(container)
-    ip = settings['NetworkSettings']['IPAddress']
+    ip = docker.ip_address(settings)
 
     return {
         'docker_ids': [container],
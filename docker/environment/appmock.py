@@ -147,7 +147,7 @@ sleep 5'''  # Add sleep so logs can be chowned
 
 
 def _ready(node):
-    node_ip = docker.inspect(node)['NetworkSettings']['IPAddress']
+    node_ip = docker.ip_address(docker.inspect(node))
     return common.nagios_up(node_ip, '9999')
 
 
@@ -38,7 +38,7 @@ def _node_up(image, pools, name, uid):
     key = docker.exec_(container, ['ceph', 'auth', 'print-key', username],
                        output=True)
     settings = docker.inspect(container)
-    ip = settings['NetworkSettings']['IPAddress']
+    ip = docker.ip_address(settings)
 
     return {
         'docker_ids': [container],
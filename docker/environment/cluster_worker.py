@@ -8,10 +8,11 @@ Brings up a set of cluster-worker nodes. They can create separate clusters.
 from . import worker, docker, common
 
 def up(image, bindir, dns_server, uid, config_path, logdir=None,
-       storages_dockers=None):
+       storages_dockers=None, db_docker_hosts=None):
     return worker.up(image, bindir, dns_server, uid, config_path,
                      ClusterWorkerConfigurator(), logdir,
-                     storages_dockers=storages_dockers)
+                     storages_dockers=storages_dockers,
+                     db_docker_hosts=db_docker_hosts)
 
 
 class ClusterWorkerConfigurator:
@@ -56,5 +57,5 @@ class ClusterWorkerConfigurator:
         return False
 
     def ready_check(self, container):
-        ip = docker.inspect(container)['NetworkSettings']['IPAddress']
+        ip = docker.ip_address(docker.inspect(container))
         return common.nagios_up(ip, '80', 'http')
@@ -11,10 +11,11 @@ import argparse
 import inspect
 import json
 import os
+import random
 import requests
 import time
 import sys
-from . import docker
+from . import docker, admission
 from .timeouts import *
 import tempfile
 import stat
@@ -180,7 +181,7 @@ def get_docker_name(name_or_container):
 
 def get_docker_ip(name_or_container):
     config = docker.inspect(name_or_container)
-    return config['NetworkSettings']['IPAddress']
+    return docker.ip_address(config)
 
 
 def env_domain_name():
@@ -205,6 +206,13 @@ def format_hostname(domain_parts, uid):
     return '.'.join(domain_parts).replace('@', '')
 
 
+def env_network_name(uid):
+    """Formats name of the user-defined docker network that isolates
+    dockers of the environment identified by uid.
+    """
+    return format_hostname('network', uid)
+
+
 def format_erl_node_name(app_name, hostname):
     """Formats full node name for an erlang VM hosted on docker based on app_name and hostname.
     NOTE: Hostnames are also used as docker names!
@@ -215,10 +223,12 @@ def format_erl_node_name(app_name, hostname):
 
 
 def generate_uid():
-    """Returns a uid (based on current time),
+    """Returns a uid (based on current time, with a random suffix so that
+    environments started at the same time do not collide),
     that can be used to group dockers in DNS
     """
-    return str(int(time.time()))
+    return '{0}{1:05d}'.format(int(time.time()),
+                               random.SystemRandom().randint(0, 99999))
 
 
 def create_users(container, users):
@@ -335,3 +345,40 @@ def remove_dockers_and_volumes():
                 print("Captured output: %s" % e.output)
             except Exception as e:
                 print("Removing docker volume %s failed due to %s" % (volume, e))
+
+
+def remove_env_dockers(env_id):
+    """Removes dockers (along with their anonymous volumes) labelled as
+    belonging to environment identified by env_id.
+    """
+    containers = docker.ps(all=True, quiet=True,
+                           filters=[('label', '{0}={1}'.format(
+                               docker.ENV_LABEL, env_id))])
+    print("Docker containers of environment {0} to remove".format(env_id),
+          containers)
+    if containers:
+        try:
+            docker.remove(containers, force=True, volumes=True,
+                          timeout=DOCKER_CMD_TIMEOUT * len(containers),
+                          stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            print(e)
+            print("Captured output: %s" % e.output)
+
+    networks = docker.list_networks(
+        filters=[('label', '{0}={1}'.format(docker.ENV_LABEL, env_id))])
+    if networks:
+        try:
+            docker.remove_networks(networks, timeout=DOCKER_CMD_TIMEOUT,
+                                   stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            print(e)
+            print("Captured output: %s" % e.output)
+
+
+def remove_stale_envs():
+    """Removes dockers of environments whose test runs are gone, leaving
+    environments of other runs on the same host intact.
+    """
+    for env_id in admission.stale_envs():
+        remove_env_dockers(env_id)
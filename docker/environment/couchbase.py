@@ -22,6 +22,59 @@ ALL_COUCHBASE_PORTS = [
 ]
 
 
+WORKER_DOMAINS = [('zone_domains', 'oz_worker'),
+                  ('provider_domains', 'op_worker'),
+                  ('cluster_domains', 'cluster_worker')]
+
+
+def parse_docker_host(spec):
+    """Parses docker host given as 'user@hostname[:port]' into a docker_host
+    dict.
+    """
+    username, at, address = spec.rpartition('@')
+    if not at or not username:
+        raise ValueError('Invalid docker host: {0}, expected '
+                         'user@hostname[:port]'.format(spec))
+    hostname, _, port = address.partition(':')
+
+    docker_host = {'ssh_username': username, 'ssh_hostname': hostname}
+    if port:
+        docker_host['ssh_port'] = port
+    return docker_host
+
+
+def remote_docker_hosts(config, docker_hosts):
+    """Returns a dict mapping cluster instances to given remote docker hosts
+    on which their couchbase should be started. Couchbase publishes all its
+    ports on a remote host, so only single-node clusters are moved, one per
+    host in the order of given hosts. The remaining clusters (and those with
+    db_docker_host set explicitly) stay where they are.
+    """
+    docker_hosts = list(docker_hosts)
+    assigned = {}
+    for domains_attribute, app_name in WORKER_DOMAINS:
+        for instance, instance_config in sorted(
+                config.get(domains_attribute, {}).items()):
+            if not docker_hosts:
+                return assigned
+
+            db_nodes = set()
+            for node in instance_config.get(app_name, {}).values():
+                db_nodes.update(node.get('sys.config', {}).get(app_name, {})
+                                .get('db_nodes', []))
+
+            db_driver = instance_config.get('db_driver', 'couchdb')
+            if len(db_nodes) == 1 and \
+                    db_driver in ['couchbase', 'couchdb'] and \
+                    'db_docker_host' not in instance_config:
+                docker_host = docker_hosts.pop(0)
+                sys.stderr.write('Starting couchbase of {0} on {1}@{2}\n'.format(
+                    instance, docker_host['ssh_username'],
+                    docker_host['ssh_hostname']))
+                assigned[instance] = docker_host
+    return assigned
+
+
 def _couchbase(cluster_name, num):
     return 'couchbase{0}-{1}'.format(num, cluster_name)
 
@@ -68,7 +121,7 @@ def _ready(container, docker_host=None):
     if docker_host:
         hostname = docker_host['ssh_hostname']
     else:
-        hostname = docker.inspect(container)['NetworkSettings']['IPAddress']
+        hostname = docker.ip_address(docker.inspect(container))
 
     url = 'http://{0}:{1}/pools'.format(hostname, ADMIN_PORT)
     try:
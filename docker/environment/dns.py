@@ -35,10 +35,13 @@ def dns_hostname(uid):
     return common.format_hostname('dns', uid)
 
 
-def maybe_start(config, uid):
-    """Sets up DNS configuration values, starting the server if needed."""
+def maybe_start(config, uid, wait=True):
+    """Sets up DNS configuration values, starting the server if needed.
+    If wait is False, the server is not probed for readiness after start -
+    useful when dockers can resolve each other by means of docker network
+    and the server is needed only for domains registered later on."""
     if config == 'auto':
-        dns_config = up(uid, [], [], 'none')
+        dns_config = up(uid, [], [], 'none', wait)
         return [dns_config['dns']], dns_config
 
     if config == 'none':
@@ -64,7 +67,7 @@ def maybe_restart_with_configuration(config, uid, output):
         up(uid, hosts, dnses, dns_hostname(uid))
 
 
-def up(uid, hosts, dnses, dns_to_restart):
+def up(uid, hosts, dnses, dns_to_restart, wait=True):
     dns = dns_to_restart
     if dns == 'none':
         # Start new DNS docker (just the docker, don't start the DNS server yet)
@@ -84,7 +87,8 @@ def up(uid, hosts, dnses, dns_to_restart):
 
     ip = common.get_docker_ip(dns)
 
-    common.wait_until(_dns_ready, [dns], DNS_WAIT_SECONDS)
+    if wait:
+        common.wait_until(_dns_ready, [dns], DNS_WAIT_SECONDS)
 
     return {'dns': ip, 'docker_ids': [dns]}
 
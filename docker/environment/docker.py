@@ -6,14 +6,42 @@ This software is released under the MIT license cited in 'LICENSE.txt'
 Functions wrapping capabilities of docker binary.
 """
 
+import hashlib
 import json
 import os
 import subprocess
 import sys
+import tempfile
+import threading
 from six import string_types
 
 PULL_DOCKER_IMAGE_RETRIES = 5
 
+# Remote docker hosts are reached through one multiplexed SSH connection per
+# host (OpenSSH ControlMaster). The master is kept alive for given number of
+# seconds after the last command that used it has finished.
+SSH_CONTROL_PERSIST_SECONDS = 600
+SSH_CONTROL_DIR = os.path.join(tempfile.gettempdir(), 'bamboos-ssh')
+
+_ssh_masters = set()
+_ssh_masters_lock = threading.Lock()
+
+# Dockers are labelled with id of the environment they belong to, taken from
+# the ENV_ID_VAR variable (set by test runners for the test master), so that
+# they can be cleaned up without affecting other environments on the host.
+ENV_LABEL = 'org.onedata.bamboos.env'
+ENV_ID_VAR = 'BAMBOOS_ENV_ID'
+# Label of user-defined networks created for environments (set to their uid),
+# which are removed along with the last of their dockers (see cleanup.py).
+ENV_NETWORK_LABEL = 'org.onedata.bamboos.env_network'
+
+# Network modes built into docker, which do not support network aliases.
+BUILTIN_NETWORKS = ['bridge', 'host', 'none']
+
+# User-defined network that containers started on the local docker host are
+# attached to, unless a network is given explicitly (see set_default_network).
+_default_network = None
+
 
 # Adds a bind-mount consistency option depending on the container's access_level.
 # This option applies to macOS only, otherwise is ignored by Docker. It relaxes
@@ -38,7 +66,7 @@ def run(image, docker_host=None, detach=False, dns_list=[], add_host={},
         rm=False, reflect=[], volumes=[], name=None, workdir=None, user=None,
         group=None, group_add=[], cpuset_cpus=None, privileged=False,
         publish=[], run_params=[], command=None, output=False, stdin=None,
-        stdout=None, stderr=None, network=None):
+        stdout=None, stderr=None, network=None, labels={}):
     cmd = ['docker']
 
     cmd.append('run')
@@ -58,8 +86,16 @@ def run(image, docker_host=None, detach=False, dns_list=[], add_host={},
     if hostname:
         cmd.extend(['-h', hostname])
 
+    if network is None and docker_host is None:
+        network = _default_network
+
     if network:
         cmd.extend(['--network', network])
+        # Make the container resolvable by its hostname through the
+        # network's built-in DNS
+        if hostname and network not in BUILTIN_NETWORKS and \
+                not network.startswith('container:'):
+            cmd.extend(['--network-alias', hostname])
 
     if detach or sys.__stdin__.isatty():
         if interactive:
@@ -73,6 +109,12 @@ def run(image, docker_host=None, detach=False, dns_list=[], add_host={},
     if name:
         cmd.extend(['--name', name])
 
+    labels = dict(labels)
+    if ENV_ID_VAR in os.environ and docker_host is None:
+        labels.setdefault(ENV_LABEL, os.environ[ENV_ID_VAR])
+    for key, value in labels.items():
+        cmd.extend(['--label', '{0}={1}'.format(key, value)])
+
     if rm:
         cmd.append('--rm')
 
@@ -133,13 +175,21 @@ def run(image, docker_host=None, detach=False, dns_list=[], add_host={},
     return subprocess.call(cmd, stdin=stdin, stderr=stderr, stdout=stdout)
 
 
+# noinspection PyDefaultArgument
 def exec_(container, command, docker_host=None, user=None, group=None,
           detach=False, interactive=False, tty=False, privileged=False,
-          output=False, stdin=None, stdout=None, stderr=None):
+          output=False, stdin=None, stdout=None, stderr=None, envs={},
+          workdir=None):
     cmd = ['docker']
 
     cmd.append('exec')
 
+    for key in envs:
+        cmd.extend(['-e', '{0}={1}'.format(key, envs[key])])
+
+    if workdir:
+        cmd.extend(['-w', os.path.abspath(workdir)])
+
     if user:
         user_group = '{0}:{1}'.format(user, group) if group else user
         cmd.extend(['-u', user_group])
@@ -182,6 +232,22 @@ def inspect(container, docker_host=None, timeout=None, stderr=None):
     return json.loads(out)[0]
 
 
+def ip_address(container_config):
+    """Returns IP address of a container given its inspect output. Containers
+    attached to user-defined networks have no IP address on the default
+    bridge, in such case the address from the first network is returned.
+    """
+    settings = container_config['NetworkSettings']
+    if settings.get('IPAddress'):
+        return settings['IPAddress']
+
+    for network in (settings.get('Networks') or {}).values():
+        if network.get('IPAddress'):
+            return network['IPAddress']
+
+    return ''
+
+
 def logs(container, docker_host=None):
     cmd = ['docker']
 
@@ -304,6 +370,19 @@ def image_exists(image):
         )
 
 
+def image_id(image):
+    """Returns id (digest of configuration) of local docker image or None if
+    the image has not been pulled."""
+
+    with open(os.devnull, 'w') as DEVNULL:
+        try:
+            return subprocess.check_output(
+                ['docker', 'image', 'inspect', '--format', '{{.Id}}', image],
+                universal_newlines=True, stderr=DEVNULL).strip()
+        except subprocess.CalledProcessError:
+            return None
+
+
 def remove_image(image):
     """Removes docker image."""
 
@@ -370,6 +449,84 @@ def remove_volumes(volumes, timeout=None, stderr=None):
     return subprocess.check_call(cmd, stderr=stderr)
 
 
+def create_network(name, driver='bridge', labels={}):
+    """
+    Create a user-defined network
+    """
+    cmd = ['docker', 'network', 'create', '--driver', driver]
+
+    labels = dict(labels)
+    if ENV_ID_VAR in os.environ:
+        labels.setdefault(ENV_LABEL, os.environ[ENV_ID_VAR])
+    for key, value in labels.items():
+        cmd.extend(['--label', '{0}={1}'.format(key, value)])
+    cmd.append(name)
+
+    return subprocess.check_output(cmd, universal_newlines=True).strip()
+
+
+def list_networks(filters=None):
+    """
+    List networks
+    """
+    cmd = ['docker', 'network', 'ls', '--quiet']
+    if filters:
+        for f in filters:
+            cmd.extend(['-f', '{}={}'.format(f[0], f[1])])
+
+    return subprocess.check_output(cmd, universal_newlines=True).split()
+
+
+def remove_networks(networks, timeout=None, stderr=None):
+    """
+    Remove networks
+    """
+    cmd = ['docker', 'network', 'rm']
+    if isinstance(networks, string_types):
+        cmd.append(networks)
+    else:
+        cmd.extend(networks)
+
+    if timeout is not None:
+        cmd = add_timeout_cmd(cmd, timeout)
+
+    return subprocess.check_call(cmd, stderr=stderr)
+
+
+def set_default_network(network):
+    """
+    Sets the network that containers started on the local docker host are
+    attached to when no network is given explicitly (None restores the
+    docker default)
+    """
+    global _default_network
+    _default_network = network
+
+
+def env_networks(containers):
+    """
+    Returns names of environment networks (see ENV_NETWORK_LABEL) that given
+    containers are attached to
+    """
+    networks = set()
+    with open(os.devnull, 'w') as DEVNULL:
+        for container in containers:
+            try:
+                info = inspect(container, stderr=DEVNULL)
+            except subprocess.CalledProcessError:
+                continue
+            networks.update(
+                (info['NetworkSettings'].get('Networks') or {}).keys())
+    if not networks:
+        return []
+
+    env_network_names = subprocess.check_output(
+        ['docker', 'network', 'ls', '--format', '{{.Name}}',
+         '-f', 'label={0}'.format(ENV_NETWORK_LABEL)],
+        universal_newlines=True).split()
+    return sorted(networks & set(env_network_names))
+
+
 def connect_docker_to_network(network, container):
     """
     Connect docker to the network
@@ -396,10 +553,81 @@ def format_command(docker_cmd, entry_point, docker_host):
 
 
 def wrap_in_ssh_call(docker_cmd, docker_host):
-    username = docker_host['ssh_username']
-    hostname = docker_host['ssh_hostname']
+    """Wraps given command so that it is executed on a remote docker host.
+    The command is run over a multiplexed SSH connection shared by all
+    commands directed to that host, which is established on first use.
+    Several commands can be in flight over the connection at once.
+    """
+    ssh_connect(docker_host)
+    return ['ssh'] + _ssh_options(docker_host) + [_ssh_destination(docker_host),
+                                                  ' '.join(docker_cmd)]
+
+
+def ssh_connect(docker_host):
+    """Ensures that a master SSH connection to given docker host is running.
+    Safe to call concurrently - only one master is started per host.
+    """
+    key = _ssh_host_key(docker_host)
+    with _ssh_masters_lock:
+        if key in _ssh_masters:
+            return
+
+        if not _ssh_master_alive(docker_host):
+            if not os.path.exists(SSH_CONTROL_DIR):
+                os.makedirs(SSH_CONTROL_DIR, 0o700)
+            subprocess.check_call(
+                ['ssh', '-M', '-N', '-f'] + _ssh_options(docker_host) +
+                [_ssh_destination(docker_host)])
+
+        _ssh_masters.add(key)
+
+
+def ssh_disconnect(docker_host):
+    """Closes the master SSH connection to given docker host (if any)."""
+    with _ssh_masters_lock:
+        _ssh_masters.discard(_ssh_host_key(docker_host))
+        if _ssh_master_alive(docker_host):
+            with open(os.devnull, 'w') as DEVNULL:
+                subprocess.call(
+                    ['ssh', '-O', 'exit'] + _ssh_options(docker_host) +
+                    [_ssh_destination(docker_host)],
+                    stdout=DEVNULL, stderr=DEVNULL)
+
+
+def _ssh_master_alive(docker_host):
+    with open(os.devnull, 'w') as DEVNULL:
+        return 0 == subprocess.call(
+            ['ssh', '-O', 'check'] + _ssh_options(docker_host) +
+            [_ssh_destination(docker_host)],
+            stdout=DEVNULL, stderr=DEVNULL)
+
+
+def _ssh_options(docker_host):
+    port = docker_host['ssh_port'] if 'ssh_port' in docker_host else 22
+    # ControlMaster=auto makes ssh fall back to creating a new master should
+    # the persisted one expire between commands.
+    return ['-p', str(port),
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath={0}'.format(_ssh_control_path(docker_host)),
+            '-o', 'ControlPersist={0}'.format(SSH_CONTROL_PERSIST_SECONDS)]
+
+
+def _ssh_destination(docker_host):
+    return '{0}@{1}'.format(docker_host['ssh_username'],
+                            docker_host['ssh_hostname'])
+
+
+def _ssh_host_key(docker_host):
     port = docker_host['ssh_port'] if 'ssh_port' in docker_host else 22
-    return ['ssh', '-p', port, '{0}@{1}'.format(username, hostname), ' '.join(docker_cmd)]
+    return docker_host['ssh_username'], docker_host['ssh_hostname'], str(port)
+
+
+def _ssh_control_path(docker_host):
+    # Unix socket paths are limited to about 100 characters, so the socket
+    # is named after a digest of the connection parameters.
+    digest = hashlib.sha1(
+        '@'.join(_ssh_host_key(docker_host)).encode('utf-8')).hexdigest()
+    return os.path.join(SSH_CONTROL_DIR, digest[:16])
 
 
 def add_timeout_cmd(cmd, timeout):
@@ -13,7 +13,7 @@ import json
 import time
 from . import appmock, client, common, zone_worker, cluster_manager, \
     worker, provider_worker, cluster_worker, docker, dns, storages, panel, \
-    dockers_config
+    dockers_config, couchbase
 
 
 def default(key):
@@ -45,10 +45,18 @@ def up(config_path,
        bin_cluster_worker=default('bin_cluster_worker'),
        bin_oc=default('bin_oc'),
        bin_onepanel=default('bin_onepanel'),
-       logdir=default('logdir')):
+       logdir=default('logdir'),
+       couchbase_hosts=None,
+       isolated_network=False):
     config = common.parse_json_config_file(config_path)
     uid = common.generate_uid()
 
+    # Start single-node couchbase clusters on remote docker hosts, if any
+    # were given
+    if couchbase_hosts is None:
+        couchbase_hosts = config.get('couchbase_hosts', [])
+    db_docker_hosts = couchbase.remote_docker_hosts(config, couchbase_hosts)
+
     output = {
         'docker_ids': [],
         'oz_worker_nodes': [],
@@ -61,8 +69,36 @@ def up(config_path,
         'onepanel_nodes': []
     }
 
-    # Start DNS
-    [dns_server], dns_output = dns.maybe_start('auto', uid)
+    # Attach all dockers to a dedicated network, where they can resolve each
+    # other by hostnames. The DNS server is then needed only for domains.
+    if isolated_network:
+        output['network'] = common.env_network_name(uid)
+        docker.create_network(output['network'],
+                              labels={docker.ENV_NETWORK_LABEL: uid})
+        docker.set_default_network(output['network'])
+    try:
+        return _start_components(config, config_path, uid, output, image,
+                                 ceph_image, cephrados_image, s3_image,
+                                 swift_image, glusterfs_image, webdav_image,
+                                 xrootd_image, nfs_image, http_image, bin_am,
+                                 bin_oz, bin_cluster_manager, bin_op_worker,
+                                 bin_cluster_worker, bin_oc, bin_onepanel,
+                                 logdir, db_docker_hosts, isolated_network)
+    finally:
+        docker.set_default_network(None)
+
+
+def _start_components(config, config_path, uid, output, image, ceph_image,
+                      cephrados_image, s3_image, swift_image, glusterfs_image,
+                      webdav_image, xrootd_image, nfs_image, http_image,
+                      bin_am, bin_oz, bin_cluster_manager, bin_op_worker,
+                      bin_cluster_worker, bin_oc, bin_onepanel, logdir,
+                      db_docker_hosts, isolated_network):
+    # Start DNS. Within an isolated network dockers resolve each other by
+    # hostnames, so there is no need to wait for it until it is restarted
+    # with domains that resolve only through it (see below).
+    [dns_server], dns_output = dns.maybe_start('auto', uid,
+                                               wait=not isolated_network)
     common.merge(output, dns_output)
 
     # Start appmock instances
@@ -78,7 +114,7 @@ def up(config_path,
     # Start provider cluster instances
     setup_worker(zone_worker, bin_oz, 'zone_domains',
                  bin_cluster_manager, config, config_path, dns_server, image,
-                 logdir, output, uid)
+                 logdir, output, uid, db_docker_hosts=db_docker_hosts)
 
     # Start storages
     storages_dockers, storages_dockers_ids = \
@@ -99,12 +135,13 @@ def up(config_path,
     if config.get('provider_domains'):
         setup_worker(provider_worker, bin_op_worker, 'provider_domains',
                      bin_cluster_manager, config, config_path, dns_server, image,
-                     logdir, output, uid, storages_dockers)
+                     logdir, output, uid, storages_dockers,
+                     db_docker_hosts=db_docker_hosts)
 
     # Start stock cluster worker instances
     setup_worker(cluster_worker, bin_cluster_worker, 'cluster_domains',
                  bin_cluster_manager, config, config_path, dns_server, image,
-                 logdir, output, uid)
+                 logdir, output, uid, db_docker_hosts=db_docker_hosts)
 
     # Start oneclient instances
     if 'oneclient' in config:
@@ -183,7 +220,8 @@ echo $?'''
 
 
 def setup_worker(worker, bin_worker, domains_name, bin_cm, config, config_path,
-                 dns_server, image, logdir, output, uid, storages_dockers=None):
+                 dns_server, image, logdir, output, uid, storages_dockers=None,
+                 db_docker_hosts=None):
     if domains_name in config:
         # Start cluster_manager instances
         cluster_manager_output = cluster_manager.up(image, bin_cm, dns_server,
@@ -194,7 +232,8 @@ def setup_worker(worker, bin_worker, domains_name, bin_cm, config, config_path,
         # Start op_worker instances
         cluster_worker_output = worker.up(image, bin_worker, dns_server, uid,
                                           config_path, logdir,
-                                          storages_dockers=storages_dockers)
+                                          storages_dockers=storages_dockers,
+                                          db_docker_hosts=db_docker_hosts)
         common.merge(output, cluster_worker_output)
         # Make sure OP domains are added to the dns server.
         # Setting first arg to 'auto' will force the restart and this is needed
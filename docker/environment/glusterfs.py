@@ -30,7 +30,7 @@ def _node_up(image, volumes, name, uid, transport, mountpoint):
         detach=True)
 
     settings = docker.inspect(container)
-    ip = settings['NetworkSettings']['IPAddress']
+    ip = docker.ip_address(settings)
     port = 24007
 
     # Depending on the host setup glusterd starts automatically in the container
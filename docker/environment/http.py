@@ -17,7 +17,7 @@ from . import common, docker
 def _http_ready(container):
     try:
         settings = docker.inspect(container)
-        host = settings['NetworkSettings']['IPAddress']
+        host = docker.ip_address(settings)
         output = docker.exec_(container,
                           ['curl', '-kSs', '--head',
                            '--user', 'user:password', 'https://{}/test_data/index.txt'.format(host)],
@@ -42,7 +42,7 @@ def _node_up(image, name, uid):
     common.wait_until(_http_ready, [container], HTTP_READY_WAIT_SECONDS)
 
     settings = docker.inspect(container)
-    ip = settings['NetworkSettings']['IPAddress']
+    ip = docker.ip_address(settings)
 
     return {
         'docker_ids': [container],
@@ -32,7 +32,7 @@ def _node_up(image, uid, name, path):
     common.wait_until(_nfs_ready, [container], NFS_READY_WAIT_SECONDS)
 
     settings = docker.inspect(container)
-    ip = settings['NetworkSettings']['IPAddress']
+    ip = docker.ip_address(settings)
 
     return {
         'docker_ids': [container],
@@ -12,10 +12,11 @@ from . import common, docker, worker, gui
 
 
 def up(image, bindir, dns_server, uid, config_path, logdir=None,
-       storages_dockers=None):
+       storages_dockers=None, db_docker_hosts=None):
     return worker.up(image, bindir, dns_server, uid, config_path,
                      ProviderWorkerConfigurator(), logdir,
-                     storages_dockers=storages_dockers)
+                     storages_dockers=storages_dockers,
+                     db_docker_hosts=db_docker_hosts)
 
 
 class ProviderWorkerConfigurator:
@@ -141,7 +142,7 @@ class ProviderWorkerConfigurator:
         return False
 
     def ready_check(self, container):
-        ip = docker.inspect(container)['NetworkSettings']['IPAddress']
+        ip = docker.ip_address(docker.inspect(container))
         return common.nagios_up(ip, '443', 'https')
 
 
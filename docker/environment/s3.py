@@ -21,7 +21,7 @@ def _node_up(image, buckets, name, uid):
         detach=True)
 
     settings = docker.inspect(container)
-    ip = settings['NetworkSettings']['IPAddress']
+    ip = docker.ip_address(settings)
     port = 4569
     host_name = '{0}:{1}'.format(ip, port)
     access_key = 'AccessKey'
@@ -46,7 +46,7 @@ def _node_up(image, containers, name, uid):
         run_params=["--entrypoint", "bash"])
 
     settings = docker.inspect(container)
-    ip = settings['NetworkSettings']['IPAddress']
+    ip = docker.ip_address(settings)
 
     docker.exec_(container,
                  ['bash', '-c',
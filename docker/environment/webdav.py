@@ -17,7 +17,7 @@ from . import common, docker
 def _webdav_ready(container):
     try:
         settings = docker.inspect(container)
-        host = settings['NetworkSettings']['IPAddress']
+        host = docker.ip_address(settings)
         output = docker.exec_(container,
                           ['curl', '-s', '-X', 'OPTIONS', '--head',
                            '-u', 'admin:password', 'http://{}:80'.format(host)],
@@ -42,7 +42,7 @@ def _node_up(image, name, uid):
     common.wait_until(_webdav_ready, [container], WEBDAV_READY_WAIT_SECONDS)
 
     settings = docker.inspect(container)
-    ip = settings['NetworkSettings']['IPAddress']
+    ip = docker.ip_address(settings)
 
     return {
         'docker_ids': [container],
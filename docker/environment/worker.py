@@ -181,7 +181,7 @@ def _db_driver_module(db_driver):
 
 
 def up(image, bindir, dns_server, uid, config_path, configurator, logdir=None,
-       storages_dockers=None):
+       storages_dockers=None, db_docker_hosts=None):
     config = common.parse_json_config_file(config_path)
 
     input_dir = config['dirs_config'][configurator.app_name()]['input_dir']
@@ -217,6 +217,8 @@ def up(image, bindir, dns_server, uid, config_path, configurator, logdir=None,
 
         db_driver = _db_driver(instance_config)
         db_docker_host = _db_docker_host(instance_config)
+        if db_docker_host is None and db_docker_hosts:
+            db_docker_host = db_docker_hosts.get(instance)
 
         for worker_node in gen_dev_cfg['nodes']:
             tw_cfg, db_nodes = _tweak_config(gen_dev_cfg, worker_node, instance,
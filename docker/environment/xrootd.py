@@ -17,7 +17,7 @@ from . import common, docker
 def _xrootd_ready(container):
     try:
         settings = docker.inspect(container)
-        host = settings['NetworkSettings']['IPAddress']
+        host = docker.ip_address(settings)
         output = docker.exec_(container,
                 ['xrdfs', 'root://{}/'.format(host), 'stat', '/data'],
                           output=True,
@@ -41,7 +41,7 @@ def _node_up(image, name, uid):
     common.wait_until(_xrootd_ready, [container], XROOTD_READY_WAIT_SECONDS)
 
     settings = docker.inspect(container)
-    ip = settings['NetworkSettings']['IPAddress']
+    ip = docker.ip_address(settings)
 
     return {
         'docker_ids': [container],
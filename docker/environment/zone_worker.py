@@ -9,7 +9,7 @@ import os
 from . import docker, common, worker, gui, panel
 
 def up(image, bindir, dns_server, uid, config_path, logdir=None,
-       dnsconfig_path=None, storages_dockers=None):
+       dnsconfig_path=None, storages_dockers=None, db_docker_hosts=None):
     if dnsconfig_path is None:
         config = common.parse_json_config_file(config_path)
         input_dir = config['dirs_config']['oz_worker']['input_dir']
@@ -18,7 +18,8 @@ def up(image, bindir, dns_server, uid, config_path, logdir=None,
                                       'data', 'dns.config')
 
     return worker.up(image, bindir, dns_server, uid, config_path,
-                     OZWorkerConfigurator(dnsconfig_path), logdir)
+                     OZWorkerConfigurator(dnsconfig_path), logdir,
+                     db_docker_hosts=db_docker_hosts)
 
 
 class OZWorkerConfigurator:
@@ -111,5 +112,5 @@ sed -i.bak s/onedata.org/{domain}/g /root/bin/node/data/dns.config
         return True
 
     def ready_check(self, container):
-        ip = docker.inspect(container)['NetworkSettings']['IPAddress']
+        ip = docker.ip_address(docker.inspect(container))
         return common.nagios_up(ip, '443', 'https')
@@ -12,17 +12,32 @@ The script uses user's SSH keys in case dependency fetching is needed.
 
 Unknown arguments will be passed to the command.
 
+With --persistent, the container (with the user and keys already prepared) is
+kept running for the source directory and subsequent commands are run in it
+with 'docker exec'. It stops after --idle-timeout seconds without commands
+and is recreated when the builder image or the container options change.
+
+With --build-cache, the ccache and rebar3 caches are synced with a shared
+store (see build_cache module), so that they are reused between agents.
+
 Run the script with -h flag to learn about script's running options.
 """
 
 from os.path import expanduser
 import argparse
+import fcntl
+import hashlib
+import json
 import os
 import platform
 import sys
 import socket
 import re
+import subprocess
+import tempfile
+import time
 
+import build_cache
 from environment import docker, dockers_config
 
 
@@ -77,6 +92,22 @@ parser.add_argument(
     help='Specify the cache prefix on host system (default: /var/cache)',
     dest='cache_prefix')
 
+parser.add_argument(
+    '--build-cache',
+    action='store',
+    default=os.environ.get('BAMBOOS_BUILD_CACHE'),
+    help='shared store (a directory or s3://bucket[/prefix]) that the '
+         'ccache and rebar3 caches are synced with before and after the '
+         'build; defaults to $BAMBOOS_BUILD_CACHE',
+    dest='build_cache')
+
+parser.add_argument(
+    '--build-cache-s3-url',
+    action='store',
+    default=build_cache.DEFAULT_S3_URL,
+    help='the S3 endpoint URL of the shared build cache store',
+    dest='build_cache_s3_url')
+
 parser.add_argument(
     '-k', '--keys',
     action='store',
@@ -140,6 +171,30 @@ parser.add_argument(
     help='CPUs in which to allow execution (0-3, 0,1)',
     dest='cpuset_cpus')
 
+parser.add_argument(
+    '--persistent',
+    action='store_true',
+    default=False,
+    help='run the command in a builder container kept running for the '
+         'source directory between invocations',
+    dest='persistent')
+
+parser.add_argument(
+    '--idle-timeout',
+    type=int,
+    default=3600,
+    help='time (in seconds) without commands after which the persistent '
+         'builder container stops',
+    dest='idle_timeout')
+
+parser.add_argument(
+    '--stop-builder',
+    action='store_true',
+    default=False,
+    help='stop the persistent builder container of the source directory '
+         'and exit',
+    dest='stop_builder')
+
 [args, pass_args] = parser.parse_known_args()
 dockers_config.ensure_image(args, 'image', 'builder')
 
@@ -161,7 +216,7 @@ else:
     git config --global url.https://github.com/.insteadOf git://github.com/
     """
 
-command = '''
+setup_command = '''
 import os, shutil, subprocess, sys
 
 os.environ['HOME'] = '/root'
@@ -209,7 +264,9 @@ except:
 subprocess.call([
     'sh', '-c', \'\'\'''' + git_config_sh + '''\'\'\'
 ])
+'''
 
+run_command = '''
 sh_command = (
     'eval $(ssh-agent) > /dev/null; '
     'ssh-add 2>&1; '
@@ -219,7 +276,67 @@ ret = subprocess.call(['sh', '-c', sh_command])
 sys.exit(ret)
 '''
 
-command = command.format(
+# The persistent builder keeps the environment prepared by setup_command,
+# with a single ssh-agent, and exits when no commands have been run in it
+# (see exec_command) for idle_timeout seconds.
+builder_command = '''
+import time
+
+os.makedirs('{sessions_dir}')
+subprocess.call(['ssh-agent', '-a', '{ssh_auth_sock}'], stdout=subprocess.DEVNULL)
+os.environ['SSH_AUTH_SOCK'] = '{ssh_auth_sock}'
+subprocess.call(['ssh-add'])
+open('{ready_file}', 'w').close()
+
+def session_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+last_active = time.time()
+while True:
+    time.sleep(10)
+    if any(session_alive(int(s)) for s in os.listdir('{sessions_dir}')):
+        last_active = time.time()
+    elif time.time() - last_active > {idle_timeout}:
+        sys.exit(0)
+'''
+
+exec_command = '''
+import os, subprocess, sys
+
+os.environ['HOME'] = '/root'
+if {shed_privileges}:
+    os.environ['PATH'] = os.environ['PATH'].replace('sbin', 'bin')
+    os.environ['HOME'] = '/home/maketmp'
+    docker_gid = os.stat('/var/run/docker.sock').st_gid
+    os.setgroups([docker_gid])
+    os.setregid({gid}, {gid})
+    os.setreuid({uid}, {uid})
+
+os.environ['SSH_AUTH_SOCK'] = '{ssh_auth_sock}'
+session = os.path.join('{sessions_dir}', str(os.getpid()))
+open(session, 'w').close()
+try:
+    ret = subprocess.call(['sh', '-c', '{command} {params}'])
+finally:
+    os.remove(session)
+sys.exit(ret)
+'''
+
+BUILDER_LABEL = 'org.onedata.bamboos.builder'
+BUILDER_READY_TIMEOUT = 300
+builder_files = {
+    'ssh_auth_sock': '/tmp/builder/ssh-agent.sock',
+    'sessions_dir': '/tmp/builder/sessions',
+    'ready_file': '/tmp/builder/ready'
+}
+
+command_args = dict(
     command=args.command,
     params=' '.join(pass_args),
     uid=os.geteuid(),
@@ -227,7 +344,10 @@ command = command.format(
     src=args.src,
     shed_privileges=(platform.system() == 'Linux' and os.geteuid() != 0),
     grant_sudo_rights=args.grant_sudo_rights,
-    groups=args.groups)
+    groups=args.groups,
+    idle_timeout=args.idle_timeout,
+    **builder_files)
+command = (setup_command + run_command).format(**command_args)
 
 # Mount docker socket so dockers can start dockers
 reflect = [(args.src, 'rw'), ('/var/run/docker.sock', 'rw')]
@@ -241,10 +361,15 @@ volumes = [
     (args.keys, '/tmp/keys', 'ro')
 ]
 
+cache_dirs = {}
 if args.mount_cache:
+    cache_dirs = {
+        'ccache': "%s/ccache"%(args.cache_prefix),
+        'rebar3': "%s/rebar3"%(args.cache_prefix)
+    }
     volumes.extend([
-        ("%s/ccache"%(args.cache_prefix), '/var/cache/ccache', 'rw'),
-        ("%s/rebar3"%(args.cache_prefix), '/var/cache/rebar3', 'rw')
+        (cache_dirs['ccache'], '/var/cache/ccache', 'rw'),
+        (cache_dirs['rebar3'], '/var/cache/rebar3', 'rw')
     ])
 
 if os.path.isdir(expanduser('~/.docker')):
@@ -253,15 +378,166 @@ if os.path.isdir(expanduser('~/.docker')):
 split_envs = [e.split('=') for e in args.envs]
 envs = {kv[0]: kv[1] for kv in split_envs}
 
-ret = docker.run(tty=True,
-                 interactive=True,
-                 rm=True,
-                 reflect=reflect,
-                 volumes=volumes,
-                 envs=envs,
-                 workdir=args.workdir if args.workdir else args.src,
-                 image=args.image,
-                 privileged=args.privileged,
-                 cpuset_cpus=args.cpuset_cpus,
-                 command=['python3', '-c', command])
+
+
+def builder_name():
+    """Returns name of the persistent builder container of the source
+    directory (and user)."""
+    src_digest = hashlib.sha1(os.path.abspath(args.src).encode()).hexdigest()
+    return 'builder_{0}_{1}'.format(os.geteuid(), src_digest[:12])
+
+
+def builder_container(name):
+    """Returns inspect output of builder container with given name, or None
+    if it does not exist."""
+    if not docker.ps(all=True, quiet=True, filters=[('name', '^/?{0}$'.format(name))]):
+        return None
+    return docker.inspect(name)
+
+
+def builder_lock(name, kind):
+    """Returns opened lock file of given kind of builder container with given
+    name (see run_in_builder)."""
+    return open(os.path.join(tempfile.gettempdir(),
+                             '{0}.{1}.lock'.format(name, kind)), 'w')
+
+
+def start_builder(name, builder_script, config_digest):
+    try:
+        docker.run(detach=True,
+                   tty=True,
+                   interactive=True,
+                   rm=True,
+                   name=name,
+                   labels={BUILDER_LABEL: config_digest},
+                   reflect=reflect,
+                   volumes=volumes,
+                   image=args.image,
+                   privileged=args.privileged,
+                   cpuset_cpus=args.cpuset_cpus,
+                   command=['python3', '-c', builder_script])
+    except subprocess.CalledProcessError:
+        # the name is taken - another session has just created the builder
+        if not builder_container(name):
+            raise
+        print('Builder container {0} has been started by another '
+              'session'.format(name))
+
+    deadline = time.time() + BUILDER_READY_TIMEOUT
+    while docker.exec_(name, ['test', '-f', builder_files['ready_file']],
+                       stderr=subprocess.DEVNULL) != 0:
+        container = builder_container(name)
+        if not container or not container['State']['Running'] or \
+                time.time() > deadline:
+            print('Builder container {0} failed to start'.format(name))
+            if container:
+                print(docker.logs(name))
+                docker.remove([name], force=True)
+            sys.exit(1)
+        time.sleep(1)
+
+
+def run_in_builder():
+    """Runs the command in the persistent builder container, starting it if
+    it is not running or is stale - was started from a different image or
+    with different options.
+    Sessions hold a shared 'usage' lock while running commands in the
+    builder, so that a stale one is recreated only after commands of other
+    sessions have finished. Checking and (re)creating the builder is
+    serialized with an exclusive 'setup' lock."""
+    image_id = docker.image_id(args.image)
+    if image_id is None:
+        docker.pull_image_with_retries(args.image)
+        image_id = docker.image_id(args.image)
+
+    builder_script = (setup_command + builder_command).format(**command_args)
+    config_digest = hashlib.sha1(json.dumps(
+        [image_id, reflect, volumes, args.privileged, args.cpuset_cpus,
+         builder_script]).encode()).hexdigest()
+
+    name = builder_name()
+    usage_lock = builder_lock(name, 'usage')
+    with builder_lock(name, 'setup') as setup_lock:
+        fcntl.flock(setup_lock, fcntl.LOCK_EX)
+        container = builder_container(name)
+        if container and (not container['State']['Running'] or
+                          container['Config']['Labels'].get(BUILDER_LABEL) !=
+                          config_digest):
+            try:
+                fcntl.flock(usage_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print('Builder container {0} is stale, waiting for commands '
+                      'of other sessions to finish'.format(name))
+                fcntl.flock(usage_lock, fcntl.LOCK_EX)
+            print('Builder container {0} is stale, recreating it'.format(name))
+            docker.remove([name], force=True)
+            container = None
+
+        if not container:
+            start_builder(name, builder_script, config_digest)
+        fcntl.flock(usage_lock, fcntl.LOCK_SH)
+
+    try:
+        return docker.exec_(name,
+                            ['python3', '-c', exec_command.format(**command_args)],
+                            tty=True,
+                            interactive=True,
+                            envs=envs,
+                            workdir=args.workdir if args.workdir else args.src)
+    finally:
+        usage_lock.close()
+
+
+if args.stop_builder:
+    if builder_container(builder_name()):
+        docker.remove([builder_name()], force=True)
+    sys.exit(0)
+
+# Syncing build caches is best-effort - a build never fails because of the
+# store (e.g. when it is unreachable or its content is corrupted)
+cache_store = None
+download_stats = {}
+if args.build_cache and cache_dirs:
+    try:
+        cache_store = build_cache.open_store(args.build_cache,
+                                             args.build_cache_s3_url)
+    except Exception as e:
+        print('WARNING: build cache store {0} is not available: {1}'.format(
+            args.build_cache, e))
+if cache_store:
+    for name, cache_dir in cache_dirs.items():
+        try:
+            download_stats[name] = build_cache.download(cache_store, name,
+                                                        cache_dir)
+        except Exception as e:
+            print('WARNING: could not restore build cache {0}: {1}'.format(
+                name, e))
+
+if args.persistent:
+    ret = run_in_builder()
+else:
+    ret = docker.run(tty=True,
+                     interactive=True,
+                     rm=True,
+                     reflect=reflect,
+                     volumes=volumes,
+                     envs=envs,
+                     workdir=args.workdir if args.workdir else args.src,
+                     image=args.image,
+                     privileged=args.privileged,
+                     cpuset_cpus=args.cpuset_cpus,
+                     command=['python3', '-c', command])
+
+if cache_store:
+    for name, cache_dir in cache_dirs.items():
+        try:
+            upload_stats = build_cache.upload(cache_store, name, cache_dir)
+        except Exception as e:
+            print('WARNING: could not save build cache {0}: {1}'.format(
+                name, e))
+            continue
+        if name in download_stats:
+            print(build_cache.format_stats(name, download_stats[name],
+                                           upload_stats))
+
 sys.exit(ret)
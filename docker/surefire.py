@@ -0,0 +1,384 @@
+"""Utilities for post-processing surefire (JUnit XML) reports produced by
+Common Test runs."""
+
+__copyright__ = "Copyright (C) 2026 ACK CYFRONET AGH"
+__license__ = "This software is released under the MIT license cited in LICENSE.txt"
+
+
+import glob
+import json
+import os
+import re
+import xml.etree.ElementTree as ElementTree
+from xml.sax.saxutils import quoteattr
+
+
+SUITE_COUNTERS = ["tests", "failures", "errors", "skipped"]
+# Elements written as separate start and end tags while streaming a report,
+# any other element is kept in memory only until it is complete
+CONTAINER_TAGS = ["testsuites", "testsuite"]
+# Path under which this module is available in test master dockers, so that
+# reports can be processed there right after the tests (see docker_volume)
+CONTAINER_DIR = "/tmp/bamboos_surefire"
+# Suite and group fixtures whose failure skips the cases they set up
+FIXTURE_CASES = re.compile(r"(init|end)_per_(suite|group)$")
+
+
+def docker_volume():
+    """Returns a read-only volume making this module importable from
+    CONTAINER_DIR in a docker."""
+    return (os.path.dirname(os.path.realpath(__file__)), CONTAINER_DIR, "ro")
+
+
+def process_report(report_path, excluded_cases=None):
+    """Rewrites given report in a single streaming pass, so that memory use
+    does not depend on its size: removes test cases whose names match
+    excluded_cases regex (e.g. init/end_per_suite) and gathers a summary of
+    test counters, which is returned and saved next to the report (see
+    report_summary). Removed cases that failed are kept in the summary as
+    failed_fixtures, so that they can still be rerun (see failed_cases) and
+    marked in the merged report (see merge_rerun).
+    Reports that have already been processed are left intact."""
+    summary_path = _summary_path(report_path)
+    previous = {}
+    if os.path.exists(summary_path):
+        with open(summary_path, "r") as f:
+            previous = json.load(f)
+        if os.path.getmtime(summary_path) >= os.path.getmtime(report_path):
+            return previous
+
+    excluded = re.compile(excluded_cases) if excluded_cases else None
+    summary = dict.fromkeys(SUITE_COUNTERS, 0)
+    # the report may have been rewritten (e.g. merged with a rerun) after
+    # fixtures were removed from it
+    summary["failed_fixtures"] = previous.get("failed_fixtures", [])
+    tmp_path = report_path + ".tmp"
+
+    with open(tmp_path, "wb") as out:
+        out.write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+        parents = []
+        for event, elem in ElementTree.iterparse(report_path,
+                                                 events=("start", "end")):
+            if event == "start":
+                if not parents or parents[-1].tag in CONTAINER_TAGS:
+                    parents.append(elem)
+                    if elem.tag in CONTAINER_TAGS:
+                        out.write(_start_tag(elem))
+                        if elem.tag == "testsuite":
+                            _add_counters(summary, elem)
+                continue
+
+            if not parents or parents[-1] is not elem:
+                continue
+
+            parents.pop()
+            if elem.tag in CONTAINER_TAGS:
+                out.write("</{0}>\n".format(elem.tag).encode("utf-8"))
+            elif elem.tag != "testcase" or excluded is None or \
+                    not excluded.match(elem.get("name", "")):
+                elem.tail = None
+                out.write(ElementTree.tostring(elem, encoding="utf-8")
+                          .split(b"?>", 1)[-1].lstrip() + b"\n")
+            elif _failures(elem) and \
+                    [elem.get("classname", ""), elem.get("name")] not in \
+                    [fixture[:2] for fixture in summary["failed_fixtures"]]:
+                elem.tail = None
+                summary["failed_fixtures"].append(
+                    [elem.get("classname", ""), elem.get("name"),
+                     ElementTree.tostring(elem, encoding="unicode")])
+            elem.clear()
+
+    os.replace(tmp_path, report_path)
+    _write_summary(report_path, summary)
+    return summary
+
+
+def report_summary(report_path):
+    """Returns summary of test counters of given report, using the one saved
+    by process_report if it is up to date or computing it in a streaming
+    pass otherwise."""
+    summary_path = _summary_path(report_path)
+    if os.path.exists(summary_path) and \
+            os.path.getmtime(summary_path) >= os.path.getmtime(report_path):
+        with open(summary_path, "r") as f:
+            return json.load(f)
+
+    summary = dict.fromkeys(SUITE_COUNTERS, 0)
+    for _, elem in ElementTree.iterparse(report_path, events=("start",)):
+        if elem.tag == "testsuite":
+            _add_counters(summary, elem)
+        elif elem.tag not in CONTAINER_TAGS:
+            elem.clear()
+    return summary
+
+
+def merge_reports(report_paths, merged_path):
+    """Merges testsuites from given reports into a single report, summing
+    up their counters in the root element."""
+    root = ElementTree.Element("testsuites")
+    totals = dict.fromkeys(SUITE_COUNTERS, 0)
+    time = 0.0
+
+    for report_path in report_paths:
+        for testsuite in ElementTree.parse(report_path).getroot():
+            root.append(testsuite)
+            for counter in SUITE_COUNTERS:
+                totals[counter] += int(testsuite.attrib.get(counter, 0))
+            time += float(testsuite.attrib.get("time", 0))
+
+    for counter, value in totals.items():
+        root.set(counter, str(value))
+    root.set("time", str(time))
+
+    os.makedirs(os.path.dirname(os.path.abspath(merged_path)), exist_ok=True)
+    ElementTree.ElementTree(root).write(merged_path, encoding="utf-8",
+                                        xml_declaration=True)
+
+
+def last_report(report_glob):
+    """Returns the most recently written report matching given glob."""
+    reports = glob.glob(report_glob)
+    return max(reports, key=os.path.getmtime) if reports else None
+
+
+def failed_cases(report_path):
+    """Returns a sorted list of (suite, group path, case) triples of test
+    cases that failed in given report. A failure of suite/group
+    initialization yields None in place of case (or group path and case),
+    as then the whole group (or suite) has to be run again - also when it
+    has been removed from the report by process_report."""
+    failed_testcases = [
+        (testcase.get("classname", ""), testcase.get("name"))
+        for testcase in ElementTree.parse(report_path).getroot().iter("testcase")
+        if _failures(testcase)
+    ]
+    failed_testcases += [tuple(fixture[:2]) for fixture in
+                         _read_summary(report_path).get("failed_fixtures", [])]
+
+    failed = set()
+    for classname, case in failed_testcases:
+        suite, groups = _parse_classname(classname)
+        if re.match(r"(init|end)_per_suite$", case):
+            failed.add((suite, None, None))
+        elif re.match(r"(init|end)_per_group$", case):
+            failed.add((suite, groups or None, None))
+        else:
+            failed.add((suite, groups, case))
+
+    return sorted(failed, key=lambda t: (t[0], t[1] or (), t[2] or ""))
+
+
+def write_rerun_spec(failed, spec_path, suite_dir):
+    """Writes Common Test specification running only given failed cases.
+    suite_dir - function returning directory (relative to the specification)
+    of given suite."""
+    whole_suites = {suite for suite, groups, _ in failed if groups is None}
+    whole_groups = {(suite, groups) for suite, groups, case in failed
+                    if groups is not None and case is None}
+
+    terms = []
+    for suite in sorted(whole_suites):
+        terms.append('{{suites, "{0}", {1}}}.'.format(
+            suite_dir(suite), _atom(suite)))
+
+    cases = {}
+    for suite, groups, case in failed:
+        if suite in whole_suites or (suite, groups) in whole_groups:
+            continue
+        cases.setdefault((suite, groups), []).append(case)
+
+    for suite, groups in sorted(whole_groups | set(cases)):
+        if suite in whole_suites:
+            continue
+        group_path = "[[{0}]]".format(", ".join(_atom(g) for g in groups))
+        if (suite, groups) in whole_groups:
+            terms.append('{{groups, "{0}", {1}, {2}}}.'.format(
+                suite_dir(suite), _atom(suite), group_path))
+        elif groups:
+            terms.append('{{groups, "{0}", {1}, {2}, {{cases, [{3}]}}}}.'.format(
+                suite_dir(suite), _atom(suite), group_path,
+                ", ".join(_atom(c) for c in cases[(suite, groups)])))
+        else:
+            terms.append('{{cases, "{0}", {1}, [{2}]}}.'.format(
+                suite_dir(suite), _atom(suite),
+                ", ".join(_atom(c) for c in cases[(suite, groups)])))
+
+    with open(spec_path, "w") as spec:
+        spec.write("\n".join(terms) + "\n")
+
+
+def merge_rerun(original_path, rerun_path, merged_path):
+    """Writes the original report with results of rerun cases applied.
+    Retried cases are marked the way surefire marks reruns: a case that
+    passed on rerun gets its original failure as flakyFailure/flakyError,
+    while a case that failed again keeps the original failure and gets the
+    rerun one as rerunFailure/rerunError. Cases skipped because of a failed
+    suite/group fixture take their rerun results, and fixtures removed by
+    process_report are put back into the report marked the same way."""
+    rerun = {}
+    for testcase in ElementTree.parse(rerun_path).getroot().iter("testcase"):
+        rerun[(testcase.get("classname"), testcase.get("name"))] = testcase
+    rerun_fixtures = {
+        (classname, name): ElementTree.fromstring(xml) for classname, name, xml
+        in _read_summary(rerun_path).get("failed_fixtures", [])
+    }
+    fixtures = [(classname, name, ElementTree.fromstring(xml))
+                for classname, name, xml
+                in _read_summary(original_path).get("failed_fixtures", [])]
+
+    tree = ElementTree.parse(original_path)
+    testsuites = list(tree.getroot().iter("testsuite"))
+    scopes = [_fixture_scope(classname, name)
+              for classname, name, _ in fixtures] + \
+             [_fixture_scope(testcase.get("classname", ""), testcase.get("name"))
+              for testsuite in testsuites
+              for testcase in testsuite.findall("testcase")
+              if _failures(testcase) and FIXTURE_CASES.match(testcase.get("name"))]
+
+    for testsuite in testsuites:
+        for index, testcase in enumerate(list(testsuite)):
+            key = (testcase.get("classname"), testcase.get("name"))
+            if testcase.tag != "testcase" or key not in rerun:
+                continue
+
+            previous = _failures(testcase)
+            if not previous:
+                if testcase.find("skipped") is not None and \
+                        _in_scopes(key[0] or "", scopes):
+                    testsuite[index] = rerun[key]
+            elif _failures(rerun[key]):
+                for failure in _failures(rerun[key]):
+                    testcase.append(_renamed(failure, "rerun"))
+            else:
+                retried = rerun[key]
+                for failure in previous:
+                    retried.append(_renamed(failure, "flaky"))
+                testsuite[index] = retried
+
+    for classname, name, fixture in fixtures:
+        if (classname, name) in rerun_fixtures:
+            for failure in _failures(rerun_fixtures[(classname, name)]):
+                fixture.append(_renamed(failure, "rerun"))
+        else:
+            for failure in _failures(fixture):
+                fixture.remove(failure)
+                fixture.append(_renamed(failure, "flaky"))
+        testsuite = _testsuite_of(testsuites, classname)
+        if testsuite is not None:
+            testsuite.append(fixture)
+
+    for testsuite in testsuites:
+        _recount(testsuite)
+
+    summary = dict.fromkeys(SUITE_COUNTERS, 0)
+    for testsuite in testsuites:
+        _add_counters(summary, testsuite)
+    root = tree.getroot()
+    if root.tag == "testsuites":
+        for counter in SUITE_COUNTERS:
+            root.set(counter, str(summary[counter]))
+
+    tree.write(merged_path, encoding="utf-8", xml_declaration=True)
+    summary["failed_fixtures"] = [
+        [classname, name, ElementTree.tostring(fixture, encoding="unicode")]
+        for (classname, name), fixture in rerun_fixtures.items()
+    ]
+    _write_summary(merged_path, summary)
+
+
+def retire_report(report_path):
+    """Keeps given report under a name that is not picked up along with the
+    reports of later runs, dropping its summary."""
+    os.replace(report_path, report_path[:-len(".xml")] + ".previous.xml")
+    if os.path.exists(_summary_path(report_path)):
+        os.remove(_summary_path(report_path))
+
+
+def _parse_classname(classname):
+    parts = classname.split(".")
+    for index, part in enumerate(parts):
+        if part.endswith("_SUITE"):
+            return part, tuple(parts[index + 1:])
+    return parts[-1], ()
+
+
+def _atom(name):
+    return "'{0}'".format(name.replace("\\", "\\\\").replace("'", "\\'"))
+
+
+def _fixture_scope(classname, case):
+    suite, groups = _parse_classname(classname)
+    if re.match(r"(init|end)_per_suite$", case):
+        return suite, None
+    return suite, groups
+
+
+def _in_scopes(classname, scopes):
+    suite, groups = _parse_classname(classname)
+    return any(suite == scope_suite and
+               (scope_groups is None or groups[:len(scope_groups)] == scope_groups)
+               for scope_suite, scope_groups in scopes)
+
+
+def _testsuite_of(testsuites, classname):
+    suite = _parse_classname(classname)[0]
+    for testsuite in testsuites:
+        if any(_parse_classname(testcase.get("classname", ""))[0] == suite
+               for testcase in testsuite.findall("testcase")):
+            return testsuite
+    return testsuites[0] if testsuites else None
+
+
+def _failures(testcase):
+    return [e for e in testcase if e.tag in ("failure", "error")]
+
+
+def _renamed(failure, prefix):
+    renamed = ElementTree.Element(prefix + failure.tag.capitalize(),
+                                  failure.attrib)
+    renamed.text = failure.text
+    for child in failure:
+        renamed.append(child)
+    return renamed
+
+
+def _recount(testsuite):
+    testcases = testsuite.findall("testcase")
+    testsuite.set("tests", str(len(testcases)))
+    testsuite.set("skipped", str(sum(1 for t in testcases
+                                     if t.find("skipped") is not None)))
+    testsuite.set("failures", str(sum(1 for t in testcases
+                                      if t.find("failure") is not None)))
+    testsuite.set("errors", str(sum(1 for t in testcases
+                                    if t.find("error") is not None)))
+
+
+def _start_tag(elem):
+    attrs = "".join(" {0}={1}".format(key, quoteattr(value))
+                    for key, value in elem.attrib.items())
+    return "<{0}{1}>\n".format(elem.tag, attrs).encode("utf-8")
+
+
+def _add_counters(summary, testsuite):
+    for counter in SUITE_COUNTERS:
+        # Older JUnit reports (e.g. from py.test) name skips differently
+        value = testsuite.get(counter, testsuite.get("skips", 0)
+                              if counter == "skipped" else 0)
+        summary[counter] += int(value)
+
+
+def _summary_path(report_path):
+    return os.path.splitext(report_path)[0] + ".summary.json"
+
+
+def _read_summary(report_path):
+    summary_path = _summary_path(report_path)
+    if not os.path.exists(summary_path):
+        return {}
+    with open(summary_path, "r") as f:
+        return json.load(f)
+
+
+def _write_summary(report_path, summary):
+    with open(_summary_path(report_path), "w") as f:
+        json.dump(summary, f)
@@ -0,0 +1,202 @@
+"""Historical durations of test suites and cases.
+
+Durations are recorded from surefire/JUnit XML reports produced by test
+runners into a local SQLite database and used to split suites into shards
+that take about the same time to run (longest processing time first).
+"""
+
+__copyright__ = "Copyright (C) 2026 ACK CYFRONET AGH"
+__license__ = "This software is released under the MIT license cited in LICENSE.txt"
+
+
+import contextlib
+import glob
+import hashlib
+import heapq
+import os
+import sqlite3
+import time
+import xml.etree.ElementTree as ElementTree
+from os.path import expanduser
+
+
+DB_PATH_VAR = "BAMBOOS_TEST_DURATIONS_DB"
+DEFAULT_DB_PATH = os.path.join(
+    expanduser("~"), ".cache", "bamboos", "test_durations.db"
+)
+# Number of most recent runs the estimated duration is averaged over
+HISTORY_LENGTH = 5
+# Estimated duration (in seconds) of suites that have never been run
+DEFAULT_SUITE_DURATION = 300.0
+
+SUITE_NAME_SUFFIXES = ("_SUITE", "TestSuite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS suite_durations (
+    runner TEXT NOT NULL,
+    suite TEXT NOT NULL,
+    duration REAL NOT NULL,
+    recorded REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS case_durations (
+    runner TEXT NOT NULL,
+    suite TEXT NOT NULL,
+    testcase TEXT NOT NULL,
+    duration REAL NOT NULL,
+    recorded REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS recorded_report_digests (
+    digest TEXT PRIMARY KEY
+);
+CREATE INDEX IF NOT EXISTS suite_durations_idx
+    ON suite_durations (runner, suite, recorded);
+CREATE INDEX IF NOT EXISTS case_durations_idx
+    ON case_durations (runner, suite, testcase, recorded);
+"""
+
+
+def record_reports(report_glob, runner, db_path=None):
+    """Records durations from all reports matching given glob, skipping the
+    ones that have already been recorded. Reports are identified by their
+    content, as logs of previous runs are rewritten by post-processing.
+    Failures are only reported, as they should never fail the test run
+    itself."""
+    try:
+        with _connect(db_path) as db:
+            for report_path in sorted(glob.glob(report_glob, recursive=True)):
+                digest = _file_digest(report_path)
+                if db.execute(
+                    "SELECT 1 FROM recorded_report_digests WHERE digest = ?",
+                    (digest,),
+                ).fetchone():
+                    continue
+
+                _record_report(db, report_path, runner)
+                db.execute("INSERT INTO recorded_report_digests VALUES (?)", (digest,))
+    except (sqlite3.Error, ElementTree.ParseError, OSError) as e:
+        print(f"WARNING: could not record test durations from {report_glob}: {e}")
+
+
+def suite_durations(runner, db_path=None):
+    """Returns a dict mapping suite names to their estimated durations."""
+    with _connect(db_path) as db:
+        rows = db.execute(
+            "SELECT suite, duration FROM suite_durations WHERE runner = ? "
+            "ORDER BY recorded DESC",
+            (runner,),
+        ).fetchall()
+
+    return _average_recent(rows)
+
+
+def case_durations(runner, db_path=None):
+    """Returns a dict mapping (suite, case) tuples to their estimated
+    durations."""
+    with _connect(db_path) as db:
+        rows = db.execute(
+            "SELECT suite, testcase, duration FROM case_durations "
+            "WHERE runner = ? ORDER BY recorded DESC",
+            (runner,),
+        ).fetchall()
+
+    return _average_recent([((suite, case), d) for suite, case, d in rows])
+
+
+def partition(items, shards, durations, key=lambda item: item):
+    """Splits items into at most given number of non-empty shards, so that
+    the estimated durations of shards are as even as possible. Items are
+    assigned longest first to the shard that is estimated to end first.
+    Items with unknown duration are assumed to take as long as the median
+    of known ones."""
+    known = sorted(durations[key(i)] for i in items if key(i) in durations)
+    default = known[len(known) // 2] if known else DEFAULT_SUITE_DURATION
+
+    def estimate(item):
+        return durations.get(key(item), default)
+
+    heap = [(0.0, shard_num, []) for shard_num in range(min(shards, len(items)))]
+    for item in sorted(items, key=estimate, reverse=True):
+        load, shard_num, shard = heapq.heappop(heap)
+        shard.append(item)
+        heapq.heappush(heap, (load + estimate(item), shard_num, shard))
+
+    return [shard for _, _, shard in sorted(heap, key=lambda s: s[1])]
+
+
+def suite_name(name):
+    """Extracts the suite name from a suite file path, module name or test
+    class name (e.g. 'dir/some_test_SUITE.erl' -> 'some_test_SUITE'). Names
+    of Python tests are their dotted module paths, without test classes
+    (e.g. 'tests/test_x.py' and 'tests.test_x.TestClass' -> 'tests.test_x')."""
+    if name.endswith((".erl", ".py")):
+        name = os.path.splitext(os.path.normpath(name))[0].replace(os.sep, ".")
+    parts = name.split(".")
+    for part in parts:
+        if part.endswith(SUITE_NAME_SUFFIXES):
+            return part
+    while len(parts) > 1 and parts[-1][:1].isupper():
+        parts.pop()
+    return ".".join(parts)
+
+
+def _record_report(db, report_path, runner):
+    recorded = time.time()
+    root = ElementTree.parse(report_path).getroot()
+    testsuites = [root] if root.tag == "testsuite" else root.iter("testsuite")
+
+    for testsuite in testsuites:
+        suites = {}
+        for testcase in testsuite.iter("testcase"):
+            suite = suite_name(testcase.get("classname") or testsuite.get("name"))
+            case_time = float(testcase.get("time") or 0)
+            suites[suite] = suites.get(suite, 0.0) + case_time
+            db.execute(
+                "INSERT INTO case_durations VALUES (?, ?, ?, ?, ?)",
+                (runner, suite, testcase.get("name"), case_time, recorded),
+            )
+
+        # Time of a suite with a dedicated testsuite element also covers
+        # environment setup, which is not reported as a separate case
+        if len(suites) == 1 and testsuite.get("time"):
+            [suite] = suites
+            suites[suite] = max(suites[suite], float(testsuite.get("time")))
+
+        for suite, duration in suites.items():
+            db.execute(
+                "INSERT INTO suite_durations VALUES (?, ?, ?, ?)",
+                (runner, suite, duration, recorded),
+            )
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _average_recent(rows):
+    """Averages durations over the most recent runs, rows must be ordered
+    from the most recent."""
+    history = {}
+    for key, duration in rows:
+        recent = history.setdefault(key, [])
+        if len(recent) < HISTORY_LENGTH:
+            recent.append(duration)
+
+    return {key: sum(recent) / len(recent) for key, recent in history.items()}
+
+
+@contextlib.contextmanager
+def _connect(db_path):
+    db_path = db_path or os.environ.get(DB_PATH_VAR, DEFAULT_DB_PATH)
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+
+    db = sqlite3.connect(db_path, timeout=60)
+    try:
+        db.executescript(SCHEMA)
+        with db:
+            yield db
+    finally:
+        db.close()
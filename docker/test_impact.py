@@ -0,0 +1,326 @@
+"""Selection of tests affected by changes made on a feature branch.
+
+Changed files (see changed_sources) are mapped to tests by module-reference
+analysis of sources: a module is affected if it has changed or references,
+directly or indirectly, a module that has changed, and a test is affected if
+it references an affected module. Erlang modules reference
+others by atoms (remote calls, rpc:call arguments, behaviours, etc.) and
+Python modules by imports. A changed Erlang header affects modules including
+it, directly or through other headers.
+
+Whenever a change cannot be attributed to particular tests (e.g. build
+configuration has changed or a source was deleted), all tests should be
+run - selection functions return None then, as they do when the
+FULL_RUN_VAR environment variable is set to 'true'.
+"""
+
+__copyright__ = "Copyright (C) 2026 ACK CYFRONET AGH"
+__license__ = "This software is released under the MIT license cited in LICENSE.txt"
+
+
+import fnmatch
+import os
+import re
+
+import changed_sources
+
+
+FULL_RUN_VAR = "bamboo_fullTestRun"
+# Share of modules above which changes are considered to affect everything -
+# selecting tests would then only cost time, so all of them are run
+MAX_AFFECTED_SHARE = 0.5
+# Changes of these files do not affect any tests
+IGNORED_PATTERNS = ["*.md", "*.rst", "*.txt", "LICENSE*", ".gitignore", "docs/*"]
+SKIPPED_DIRS = {".git", "_build", "deps", "__pycache__", "node_modules"}
+
+ERLANG_ATOM = re.compile(r"\b[a-z][A-Za-z0-9_@]*")
+ERLANG_INCLUDE = re.compile(r'-include(?:_lib)?\s*\(\s*"([^"]+)"')
+PYTHON_IMPORT = re.compile(
+    r"^[ \t]*(?:from[ \t]+([\w.]+)[ \t]+import[ \t]+(?:\(([^)]*)\)|([\w \t,.*]+))"
+    r"|import[ \t]+([\w \t,.]+))",
+    re.MULTILINE,
+)
+
+
+def affected_erlang_suites(base_branch, repo_dir=".", tests_dir="test_distributed"):
+    """Returns a sorted list of names of Common Test suites (in tests_dir)
+    affected by changes made since HEAD diverged from base_branch, or None
+    if all suites should be run."""
+    changed = _changed_files(base_branch, repo_dir)
+    if changed is None:
+        return None
+
+    sources = _find_files(repo_dir, (".erl", ".hrl"))
+    modules = {
+        _module_name(path): path for path in sources if path.endswith(".erl")
+    }
+    suites = {
+        name: path
+        for name, path in modules.items()
+        if name.endswith("_SUITE") and _in_dir(path, tests_dir)
+    }
+    contents = {path: _read(repo_dir, path) for path in sources}
+
+    changed_modules = set()
+    selected = set()
+    for path in changed:
+        if path.endswith((".erl", ".hrl")) and not os.path.exists(
+            os.path.join(repo_dir, path)
+        ):
+            return _full_run(f"{path} was deleted")
+        elif path.endswith(".erl") and _module_name(path) in modules:
+            changed_modules.add(_module_name(path))
+        elif path.endswith(".hrl"):
+            including = _header_users([path], sources, contents)
+            if not including:
+                return _full_run(f"{path} is not included by any module")
+            changed_modules.update(including)
+        elif _is_ignored(path):
+            continue
+        elif _in_dir(path, tests_dir):
+            owners = _test_data_owners(path, tests_dir, suites, contents)
+            if not owners:
+                return _full_run(f"{path} cannot be attributed to any suite")
+            selected.update(owners)
+        else:
+            return _full_run(f"{path} may affect all suites")
+
+    references = {
+        name: set(ERLANG_ATOM.findall(contents[path])) & set(modules)
+        for name, path in modules.items()
+    }
+    affected = _referencing_modules(changed_modules, references)
+    if affected is None:
+        return _full_run("changes affect most of the modules")
+    selected.update(
+        name
+        for name in suites
+        if name in affected or references[name] & affected
+    )
+    return _report_selection(sorted(selected), len(suites))
+
+
+def affected_python_tests(base_branch, test_dir, repo_dir="."):
+    """Returns a sorted list of paths (relative to repo_dir) of py.test
+    files in test_dir affected by changes made since HEAD diverged from
+    base_branch, or None if all tests should be run."""
+    changed = _changed_files(base_branch, repo_dir)
+    if changed is None:
+        return None
+
+    sources = _find_files(repo_dir, (".py",))
+    modules = {_python_module_name(path): path for path in sources}
+    tests = {
+        name: path
+        for name, path in modules.items()
+        if _in_dir(path, test_dir) and _is_python_test(path)
+    }
+    contents = {path: _read(repo_dir, path) for path in sources}
+
+    changed_modules = set()
+    selected = set()
+    for path in changed:
+        if os.path.basename(path) == "conftest.py":
+            return _full_run(f"{path} may affect all tests")
+        elif path.endswith(".py") and not os.path.exists(os.path.join(repo_dir, path)):
+            return _full_run(f"{path} was deleted")
+        elif path.endswith(".py") and _python_module_name(path) in modules:
+            changed_modules.add(_python_module_name(path))
+        elif _is_ignored(path):
+            continue
+        elif _in_dir(path, test_dir):
+            owners = _test_data_owners(path, test_dir, tests, contents)
+            if not owners:
+                return _full_run(f"{path} cannot be attributed to any test")
+            selected.update(owners)
+        else:
+            return _full_run(f"{path} may affect all tests")
+
+    suffixes = _module_suffixes(modules)
+    references = {
+        name: _python_imports(contents[path], suffixes)
+        for name, path in modules.items()
+    }
+    affected = _referencing_modules(changed_modules, references)
+    if affected is None:
+        return _full_run("changes affect most of the modules")
+    selected.update(
+        name
+        for name in tests
+        if name in affected or references[name] & affected
+    )
+    return _report_selection(sorted(tests[name] for name in selected), len(tests))
+
+
+def modules_including(headers, repo_dir="."):
+    """Returns names of Erlang modules including any of given headers
+    (paths relative to repo_dir), directly or through other headers."""
+    sources = _find_files(repo_dir, (".erl", ".hrl"))
+    contents = {path: _read(repo_dir, path) for path in sources}
+    return _header_users(headers, sources, contents)
+
+
+def _header_users(headers, sources, contents):
+    """Returns names of modules (among sources) including any of given
+    headers, directly or through other headers. Headers are matched by
+    their base names, as include paths depend on include directories."""
+    includes = {
+        path: set(map(os.path.basename, ERLANG_INCLUDE.findall(contents[path])))
+        for path in sources
+    }
+    included = {os.path.basename(header) for header in headers}
+    frontier = set(included)
+    while frontier:
+        frontier = {
+            os.path.basename(path)
+            for path in sources
+            if path.endswith(".hrl") and includes[path] & frontier
+        } - included
+        included |= frontier
+    return {
+        _module_name(path)
+        for path in sources
+        if path.endswith(".erl") and includes[path] & included
+    }
+
+
+def _changed_files(base_branch, repo_dir):
+    if os.environ.get(FULL_RUN_VAR) == "true":
+        print(
+            f"NOTE: running all tests according to ${{{FULL_RUN_VAR}}} ENV variable"
+        )
+        return None
+
+    changed = changed_sources.changed_files(base_branch, repo_dir)
+    if changed is None:
+        return _full_run("changes cannot be determined")
+    elif not changed:
+        return _full_run(f"no changes since {base_branch} found")
+    return changed
+
+
+def _referencing_modules(changed_modules, references):
+    """Returns changed modules and modules referencing them, directly or
+    indirectly, or None if these are more than MAX_AFFECTED_SHARE of all
+    modules."""
+    referencing = {}
+    for name, referenced in references.items():
+        for module in referenced:
+            referencing.setdefault(module, set()).add(name)
+
+    affected = set(changed_modules)
+    frontier = list(changed_modules)
+    while frontier:
+        for name in referencing.get(frontier.pop(), ()):
+            if name not in affected:
+                affected.add(name)
+                frontier.append(name)
+
+    if len(affected) > MAX_AFFECTED_SHARE * len(references):
+        return None
+    return affected
+
+
+def _test_data_owners(path, tests_dir, tests, contents):
+    """Returns names of tests using given data file (e.g. environment
+    description) - ones with a '<test>_data' directory containing it or
+    mentioning the name of the file or of one of its directories."""
+    parts = os.path.relpath(path, tests_dir).split(os.sep)
+    owners = {name for name in tests if f"{name}_data" in parts}
+    if owners:
+        return owners
+
+    names = {os.path.splitext(part)[0] for part in parts}
+    return {
+        name
+        for name, test_path in tests.items()
+        if any(re.search(rf"\b{re.escape(n)}\b", contents[test_path]) for n in names)
+    }
+
+
+def _module_suffixes(modules):
+    """Maps every dotted suffix of given module names to the modules, as
+    test modules are imported relative to various directories."""
+    suffixes = {}
+    for module in modules:
+        parts = module.split(".")
+        for i in range(len(parts)):
+            suffixes.setdefault(".".join(parts[i:]), set()).add(module)
+    return suffixes
+
+
+def _python_imports(content, suffixes):
+    """Returns names of modules imported in content (see _module_suffixes)."""
+    imported = set()
+    for from_module, grouped_names, names, import_modules in PYTHON_IMPORT.findall(
+        content
+    ):
+        if from_module:
+            imported.add(from_module)
+            imported.update(
+                f"{from_module}.{name.split()[0]}"
+                for name in (grouped_names or names).replace("\n", ",").split(",")
+                if name.strip() and name.strip() != "*"
+            )
+        else:
+            imported.update(
+                name.split()[0] for name in import_modules.split(",") if name.strip()
+            )
+
+    return set().union(*(suffixes.get(name, ()) for name in imported))
+
+
+def _report_selection(selected, total):
+    print(f"Selected {len(selected)} of {total} tests affected by changes:")
+    for test in selected:
+        print(f"    {test}")
+    return selected
+
+
+def _full_run(reason):
+    print(f"NOTE: running all tests - {reason}")
+    return None
+
+
+def _find_files(repo_dir, extensions):
+    found = []
+    for root, dirs, files in os.walk(repo_dir):
+        dirs[:] = [d for d in dirs if d not in SKIPPED_DIRS]
+        found.extend(
+            os.path.relpath(os.path.join(root, f), repo_dir)
+            for f in files
+            if f.endswith(extensions)
+        )
+    return found
+
+
+def _read(repo_dir, path):
+    with open(os.path.join(repo_dir, path), "r", errors="replace") as f:
+        return f.read()
+
+
+def _module_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def _python_module_name(path):
+    name = os.path.splitext(os.path.normpath(path))[0].replace(os.sep, ".")
+    return name[: -len(".__init__")] if name.endswith(".__init__") else name
+
+
+def _is_python_test(path):
+    name = os.path.basename(path)
+    return fnmatch.fnmatch(name, "test_*.py") or fnmatch.fnmatch(name, "*_test.py")
+
+
+def _is_ignored(path):
+    return any(
+        fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(os.path.basename(path), pattern)
+        for pattern in IGNORED_PATTERNS
+    )
+
+
+def _in_dir(path, directory):
+    directory = os.path.normpath(directory)
+    path = os.path.normpath(path)
+    return directory in (".", path) or path.startswith(directory + os.sep)
@@ -12,10 +12,13 @@ import argparse
 import os
 import platform
 import sys
-import time
 
-from environment.common import HOST_STORAGE_PATH, remove_dockers_and_volumes
-from environment import docker, dockers_config
+from environment.common import HOST_STORAGE_PATH, generate_uid, \
+    remove_dockers_and_volumes, remove_env_dockers, remove_stale_envs
+from environment import admission, docker, dockers_config
+import changed_sources
+import test_durations
+import test_impact
 import glob
 import xml.etree.ElementTree as ElementTree
 
@@ -101,7 +104,7 @@ parser.add_argument(
     action='store',
     help="Name of docker container where tests will be running",
     dest='docker_name',
-    default='test_run_docker_{}'.format(int(time.time()))
+    default=None
 )
 
 parser.add_argument(
@@ -111,9 +114,66 @@ parser.add_argument(
     dest='no_etc_passwd'
 )
 
+parser.add_argument(
+    '--concurrent',
+    action='store_true',
+    help="Allow other test runs on this host at the same time - clean up only "
+         "dockers of own environment and wait until the CPUs and memory it "
+         "needs are not reserved by other runs",
+    dest='concurrent'
+)
+
+parser.add_argument(
+    '--cpus',
+    type=int,
+    default=admission.DEFAULT_ENV_CPUS,
+    help="Number of CPUs reserved for the environment in concurrent mode",
+    dest='cpus'
+)
+
+parser.add_argument(
+    '--memory',
+    type=int,
+    default=admission.DEFAULT_ENV_MEMORY_MB,
+    help="Memory (in MB) reserved for the environment in concurrent mode",
+    dest='memory'
+)
+
+parser.add_argument(
+    '--affected-only',
+    action='store_true',
+    help="Run only tests affected by changes made since the current branch "
+         "diverged from the base branch; all tests are run if ${0} ENV "
+         "variable is set to true".format(test_impact.FULL_RUN_VAR),
+    dest='affected_only'
+)
+
+parser.add_argument(
+    '--base-branch',
+    default=None,
+    help="Base branch for --affected-only (by default the one from "
+         "branchConfig.yaml or {0})".format(changed_sources.DEFAULT_BASE_BRANCH),
+    dest='base_branch'
+)
+
 [args, pass_args] = parser.parse_known_args()
 dockers_config.ensure_image(args, 'image', 'worker')
 
+test_paths = [args.test_dir]
+if args.affected_only:
+    affected = test_impact.affected_python_tests(
+        args.base_branch or changed_sources.fallback_branch(script_dir),
+        args.test_dir, script_dir)
+    if affected == []:
+        print('No tests are affected by the changes, nothing to run')
+        sys.exit(0)
+    elif affected:
+        test_paths = affected
+
+env_id = generate_uid()
+if args.docker_name is None:
+    args.docker_name = 'test_run_docker_{}'.format(env_id)
+
 command = '''
 import os, subprocess, sys, stat
 
@@ -127,7 +187,7 @@ if {shed_privileges}:
     os.setregid({gid}, {gid})
     os.setreuid({uid}, {uid})
 
-command = ['py.test'] + ['--test-type={test_type}'] + ['{test_dir}'] + ['--docker-name', '{docker_name}'] + {args} + {env_file} + ['--junitxml={report_path}']
+command = ['py.test'] + ['--test-type={test_type}'] + {test_paths} + ['--docker-name', '{docker_name}'] + {args} + {env_file} + ['--junitxml={report_path}']
 ret = subprocess.call(command)
 sys.exit(ret)
 '''
@@ -152,7 +212,7 @@ command = command.format(
     args=pass_args,
     uid=os.geteuid(),
     gid=os.getegid(),
-    test_dir=args.test_dir,
+    test_paths=test_paths,
     docker_name=args.docker_name,
     shed_privileges=(platform.system() == 'Linux'),
     report_path=args.report_path,
@@ -164,7 +224,11 @@ command = command.format(
 # 128MB or more required for chrome tests to run with xvfb
 run_params = ['--shm-size=128m']
 
-remove_dockers_and_volumes()
+if args.concurrent:
+    remove_stale_envs()
+    admission.admit(env_id, args.cpus, args.memory)
+else:
+    remove_dockers_and_volumes()
 
 reflect=[(script_dir, 'rw'),
          ('/var/run/docker.sock', 'rw'),
@@ -173,17 +237,26 @@ reflect=[(script_dir, 'rw'),
 if not args.no_etc_passwd:
     reflect.extend([('/etc/passwd', 'ro')])
          
-ret = docker.run(tty=True,
-                 rm=True,
-                 interactive=True,
-                 name=args.docker_name,
-                 workdir=script_dir,
-                 reflect = reflect,
-                 volumes=[(os.path.join(os.path.expanduser('~'),
-                                        '.docker'), '/tmp/.docker', 'rw')],
-                 image=args.image,
-                 command=['python3', '-c', command],
-                 run_params=run_params)
+try:
+    ret = docker.run(tty=True,
+                     rm=True,
+                     interactive=True,
+                     name=args.docker_name,
+                     workdir=script_dir,
+                     reflect = reflect,
+                     volumes=[(os.path.join(os.path.expanduser('~'),
+                                            '.docker'), '/tmp/.docker', 'rw')],
+                     envs={docker.ENV_ID_VAR: env_id},
+                     labels={docker.ENV_LABEL: env_id},
+                     image=args.image,
+                     command=['python3', '-c', command],
+                     run_params=run_params)
+finally:
+    if args.concurrent:
+        remove_env_dockers(env_id)
+        admission.release(env_id)
+
+test_durations.record_reports(args.report_path, 'test_run')
 
 if ret != 0 and not skipped_test_exists(args.report_path):
     ret = 0
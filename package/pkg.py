@@ -5,7 +5,7 @@
 Copyright (C) 2015 ACK CYFRONET AGH
 This software is released under the MIT license cited in 'LICENSE.txt'
 
-Pushes .tar.gz package archives in onedata's bamboo artifact format:
+Pushes .tar.gz (or .tar.zst) package archives in onedata's bamboo artifact format:
 i. e.
 package/
     centos-7-x86_64
@@ -30,8 +30,16 @@ import os
 import shutil
 import sys
 import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 from subprocess import Popen, PIPE, check_call, check_output, CalledProcessError
 
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
 CONFIG = '''
 Host docker_packages_devel
  HostName 172.17.0.2
@@ -64,6 +72,11 @@ Host packages
 
 APACHE_PREFIX = '/var/www/onedata'
 
+# All ssh and scp calls to the package repo host are multiplexed over a
+# single connection (OpenSSH ControlMaster), kept alive for given number of
+# seconds after the last command that used it has finished.
+SSH_CONTROL_PERSIST_SECONDS = 600
+
 # Paths for legacy RPM repositories (prior to release 1802)
 YUM_REPO_LOCATION = {
     'fedora-21-x86_64': 'yum/fedora/21',
@@ -90,6 +103,11 @@ DEB_PKG_LOCATION = {
     'jammy': 'apt/ubuntu/jammy/pool/main'
 }
 
+ARCHIVE_EXT = {
+    'gz': '.tar.gz',
+    'zst': '.tar.zst'
+}
+
 REPO_TYPE = {
     'trusty': 'deb',
     'wily': 'deb',
@@ -146,25 +164,48 @@ parser_config = subparsers.add_parser(
 # create the parser for the "push" command
 parser_push = subparsers.add_parser(
     'push',
-    help='Deploy .tar.gz package artifact.'
+    help='Deploy .tar.gz or .tar.zst package artifact.'
 )
 parser_push.add_argument(
     'package_artifact',
-    help='Package artifact in tar.gz format'
+    help='Package artifact in tar.gz or tar.zst format'
 )
+parser_push.add_argument(
+    '--jobs',
+    default=4,
+    type=int,
+    help='Number of distributions published (and of packages signed) in '
+         'parallel.',
+    dest='jobs')
 
 # create the parser for the "pull" command
 parser_pull = subparsers.add_parser(
     'pull',
-    help='Pull packages and create .tar.gz archive.'
+    help='Pull packages and create .tar.gz or .tar.zst archive.'
 )
 parser_pull.add_argument(
     'report_artifact',
     help='Report artifact from push command.'
 )
+parser_pull.add_argument(
+    '--format',
+    default='gz',
+    choices=sorted(ARCHIVE_EXT),
+    help='Compression format of the created archive.',
+    dest='format')
 
 args = parser.parse_args()
+aptly_lock = threading.Lock()
 identity_opt = ['-i', args.identity] if args.identity else []
+ssh_control_dir = os.path.join(tempfile.gettempdir(),
+                               'pkg-ssh-{}'.format(os.getpid()))
+# ControlMaster=auto makes ssh fall back to creating a new master should
+# the persisted one expire between commands.
+ssh_opts = identity_opt + ([
+    '-o', 'ControlMaster=auto',
+    '-o', 'ControlPath={}'.format(os.path.join(ssh_control_dir, 'master')),
+    '-o', 'ControlPersist={}'.format(SSH_CONTROL_PERSIST_SECONDS)
+] if args.host else [])
 
 
 def cp_or_scp(hostname, identity_opt, source, dest_dir, from_local=True):
@@ -190,31 +231,84 @@ def ssh_or_sh(hostname, identity_opt, command, return_output=False):
 
 def untar_remote_or_local(hostname, identity_opt, package_artifact, dest_dir):
     ssh_command = ['ssh'] + identity_opt + [hostname] if hostname else []
+    compression = '--zstd' if package_artifact.endswith('.tar.zst') else '-z'
     tar_stream = Popen(['cat', package_artifact], stdout=PIPE)
-    check_call(ssh_command + ['tar', 'xzf', '-', '-C', dest_dir],
+    check_call(ssh_command + ['tar', '-x', compression, '-f', '-', '-C', dest_dir],
                stdin=tar_stream.stdout)
     tar_stream.wait()
 
 
+def start_ssh_master(hostname, ssh_opts):
+    """Opens the connection multiplexed by all subsequent ssh and scp
+    calls to hostname."""
+    if not os.path.exists(ssh_control_dir):
+        os.makedirs(ssh_control_dir, 0o700)
+    check_call(['ssh', '-M', '-N', '-f'] + ssh_opts + [hostname])
+
+
+def stop_ssh_master(hostname, ssh_opts, control_dir):
+    Popen(['ssh', '-O', 'exit'] + ssh_opts + [hostname], stdout=PIPE,
+          stderr=PIPE).communicate()
+    shutil.rmtree(control_dir, ignore_errors=True)
+
+
+def list_tree(hostname, ssh_opts, dir):
+    """Lists packages under dir with a single find and returns them as
+    {distro: {type: [package, ...]}}."""
+    format = quote('%y %P\\n') if hostname else '%y %P\\n'
+    output = ssh_or_sh(hostname, ssh_opts,
+                       ['find', dir, '-mindepth', '1', '-maxdepth', '3',
+                        '-printf', format], True)
+    tree = {}
+    for line in output.decode('utf-8').splitlines():
+        type, path = line.split(' ', 1)
+        parts = path.split('/')
+        distro = tree.setdefault(parts[0], {})
+        if len(parts) == 2 and type == 'd':
+            distro.setdefault(parts[1], [])
+        elif len(parts) == 3:
+            distro.setdefault(parts[1], []).append(parts[2])
+    return tree
+
+
 def copy(source, dest_dir, from_local=True):
-    cp_or_scp(args.host, identity_opt, source, dest_dir, from_local)
+    cp_or_scp(args.host, ssh_opts, source, dest_dir, from_local)
 
 
 def call(command):
-    return ssh_or_sh(args.host, identity_opt, command, True)
+    return ssh_or_sh(args.host, ssh_opts, command, True)
 
 
 def execute(command):
-    return ssh_or_sh(args.host, identity_opt, command)
+    return ssh_or_sh(args.host, ssh_opts, command)
 
 
 def untar(package_artifact, dest_dir):
-    untar_remote_or_local(args.host, identity_opt, package_artifact, dest_dir)
+    untar_remote_or_local(args.host, ssh_opts, package_artifact, dest_dir)
+
+
+def shell(command):
+    """Executes shell command (e.g. a pipeline) on the package host."""
+    return execute(['sh', '-c', quote(command) if args.host else command])
+
 
+def packages_in(tree, distro, type):
+    return sorted(tree.get(distro, {}).get(type, []))
 
-def tar(dir, archive=tempfile.mktemp('.tar.gz')):
-    check_call(['tar', 'czf', archive, '-C', dir, '.'])
-    return archive
+
+def compress_program(archive):
+    """Returns multi-threaded (if available) compression program for
+    archive with given name. Archives are compressed with --rsyncable, so
+    that they are deduplicated when pushed as chunked artifacts."""
+    if archive.endswith('.tar.zst'):
+        return 'zstd -T0 --rsyncable'
+    return '{0} --rsyncable'.format(
+        'pigz' if executable_exists('pigz') else 'gzip')
+
+
+def executable_exists(program):
+    return any(os.access(os.path.join(path, program), os.X_OK)
+               for path in os.environ.get('PATH', '').split(os.pathsep))
 
 
 def deb_package_path(distro, type, package):
@@ -263,6 +357,17 @@ def write_report(packages):
         json.dump(dict(packages), f, indent=2)
 
 
+def write_timing_report(timings):
+    """Prints and saves (next to pkg-list.json) publishing time of every
+    distribution."""
+    print("Publishing times:")
+    for distro, seconds in timings:
+        print("    {:<20} {:>8.1f} s".format(distro, seconds))
+
+    with open('pkg-timing.json', 'w') as f:
+        json.dump(dict(timings), f, indent=2)
+
+
 def push(package_artifact):
     tmp_dir = tempfile.mktemp()
     pkg_dir = os.path.join(tmp_dir, 'package')
@@ -272,93 +377,19 @@ def push(package_artifact):
         execute(['rm', '-rf', tmp_dir])
         execute(['mkdir', '-p', tmp_dir])
         untar(package_artifact, tmp_dir)
-        packages = []
-
-        # for each distribution inside
-        for distro in call(['ls', pkg_dir]).split():
-            if REPO_TYPE[distro] == 'deb':
-                release = args.release
-                # repository names for deb are in the form
-                # relase-distro, e.g. '1802-xenial'
-                if release:
-                    repo = '{}-{}'.format(release, distro)
-                else:
-                    repo = distro
-                # push debs if any were provided
-                binary_dir = os.path.join(pkg_dir, distro, 'binary-amd64')
-                try:
-                    # Check if binary_dir exists in package
-                    execute(['ls', binary_dir])
-                    for package in call(['ls', binary_dir]).split():
-                        if release:
-                            path = deb_release_package_path(distro, release,
-                                                            'binary-amd64', package)
-                        else:
-                            path = deb_package_path(distro, 'binary-amd64', package)
-                        packages.append(path)
-                    execute(['aptly', 'repo', 'add', '-force-replace', repo,
-                         binary_dir])
-                except CalledProcessError:
-                    print("Warning: No binary-amd64 directory in package or empty")
-
-                # push sources if any were provided
-                source_dir = os.path.join(pkg_dir, distro, 'source')
-                try:
-                    # Check if source_dir exists in package
-                    execute(['ls', source_dir])
-                    for package in call(['ls', source_dir]).split():
-                        if release:
-                            path = deb_release_package_path(distro, release,
-                                                            'source', package)
-                        else:
-                            path = deb_package_path(distro, 'source', package)
-                        packages.append(path)
-                    execute(['aptly', 'repo', 'add', '-force-replace', repo,
-                         source_dir])
-                except CalledProcessError:
-                    print("Warning: No source directory in package or empty")
-
-                # update repo
-                if release:
-                    execute(['aptly', 'publish', 'update', '-force-overwrite',
-                            distro, release])
-                else:
-                    execute(['aptly', 'publish', 'update', '-force-overwrite',
-                            distro, distro])
-            elif REPO_TYPE[distro] == 'rpm':
-                # copy packages
-                repo_dir = None
-                scl = args.release
-                if scl:
-                    repo_dir = os.path.join(APACHE_PREFIX,
-                        YUM_SCL_REPO_LOCATION[distro].format(scl,))
-                else:
-                    repo_dir = os.path.join(APACHE_PREFIX,
-                        YUM_REPO_LOCATION[distro])
-
-                distro_contents = os.path.join(pkg_dir, distro)
-
-                print("Signing packages ...")
-                call(['find', distro_contents, '-name', '*.rpm', '-exec', 'rpmresign',
-                      '{}', '\';\''])
-
-                print("Copying packages ...")
-                call(['cp', '-a', os.path.join(distro_contents, '.'), repo_dir])
-
-                for type in ['x86_64', 'SRPMS']:
-                    dir = os.path.join(distro_contents, type)
-                    for package in call(['ls', dir]).split():
-                        if scl:
-                            path = yum_release_package_path(distro, scl, type, package)
-                        else:
-                            path = yum_package_path(distro, type, package)
-                        packages.append(path)
-
-                # update createrepo
-                print("Updating repository ...")
-                call(['createrepo', '--update', repo_dir])
-
-        write_report(packages)
+        tree = list_tree(args.host, ssh_opts, pkg_dir)
+
+        # distributions are independent repositories, so they are published
+        # in parallel
+        pool = ThreadPool(max(1, min(args.jobs, len(tree))))
+        try:
+            results = pool.map(lambda distro: publish(pkg_dir, tree, distro),
+                               sorted(tree))
+        finally:
+            pool.close()
+
+        write_report([path for _, paths, _ in results for path in paths])
+        write_timing_report([(distro, seconds) for distro, _, seconds in results])
         return 0
 
     except CalledProcessError as err:
@@ -367,27 +398,129 @@ def push(package_artifact):
         execute(['rm', '-rf', tmp_dir])
 
 
-def pull(report_artifact):
-    tmp_dir = tempfile.mkdtemp()
-    pkg_dir = os.path.join(tmp_dir, 'package')
+def publish(pkg_dir, tree, distro):
+    """Publishes packages of given distribution. Returns (distro, package
+    paths, publishing time in seconds)."""
+    start = time.time()
+    if REPO_TYPE[distro] == 'deb':
+        packages = publish_deb(pkg_dir, tree, distro)
+    else:
+        packages = publish_rpm(pkg_dir, tree, distro)
+    return distro, packages, time.time() - start
 
-    try:
-        with open(report_artifact, 'r') as f:
-            report = json.load(f)
-            for package_path, distro_dir in report.items():
-                source = os.path.join(APACHE_PREFIX, package_path)
-                dest = os.path.join(pkg_dir, distro_dir)
-                if not os.path.exists(dest):
-                    os.makedirs(dest)
-                copy(source, dest, False)
-
-        archive = tar(tmp_dir)
-        return 0, archive
 
-    except CalledProcessError as err:
-        return err.returncode, None
-    finally:
-        shutil.rmtree(tmp_dir)
+def publish_deb(pkg_dir, tree, distro):
+    packages = []
+    release = args.release
+    # repository names for deb are in the form
+    # relase-distro, e.g. '1802-xenial'
+    if release:
+        repo = '{}-{}'.format(release, distro)
+    else:
+        repo = distro
+
+    # push debs and sources if any were provided
+    for type in ['binary-amd64', 'source']:
+        type_dir = os.path.join(pkg_dir, distro, type)
+        type_packages = packages_in(tree, distro, type)
+        if not type_packages:
+            print("Warning: No {} directory in package or empty".format(type))
+            continue
+
+        for package in type_packages:
+            if release:
+                path = deb_release_package_path(distro, release, type, package)
+            else:
+                path = deb_package_path(distro, type, package)
+            packages.append(path)
+        try:
+            aptly(['repo', 'add', '-force-replace', repo, type_dir])
+        except CalledProcessError:
+            print("Warning: Adding packages from {} directory failed".format(type))
+
+    # update repo
+    aptly(['publish', 'update', '-force-overwrite', distro, release or distro])
+    return packages
+
+
+def publish_rpm(pkg_dir, tree, distro):
+    packages = []
+    scl = args.release
+    if scl:
+        repo_dir = os.path.join(APACHE_PREFIX,
+                                YUM_SCL_REPO_LOCATION[distro].format(scl,))
+    else:
+        repo_dir = os.path.join(APACHE_PREFIX, YUM_REPO_LOCATION[distro])
+
+    distro_contents = os.path.join(pkg_dir, distro)
+
+    print("Signing {} packages ...".format(distro))
+    shell("find {} -name '*.rpm' -print0 | xargs -0 -r -n 1 -P {} rpmresign".format(
+        quote(distro_contents), args.jobs))
+
+    print("Copying {} packages ...".format(distro))
+    call(['cp', '-a', os.path.join(distro_contents, '.'), repo_dir])
+
+    for type in ['x86_64', 'SRPMS']:
+        for package in packages_in(tree, distro, type):
+            if scl:
+                path = yum_release_package_path(distro, scl, type, package)
+            else:
+                path = yum_package_path(distro, type, package)
+            packages.append(path)
+
+    # update createrepo
+    print("Updating {} repository ...".format(distro))
+    call(['createrepo', '--update', '--workers', str(args.jobs), repo_dir])
+    return packages
+
+
+def aptly(command):
+    # aptly locks its database, so its commands cannot run concurrently
+    with aptly_lock:
+        execute(['aptly'] + command)
+
+
+def pull(report_artifact):
+    """Streams all packages listed in the report from the package host in a
+    single tar, laid out as package/<distro>/<type>, and compresses it while
+    receiving."""
+    with open(report_artifact, 'r') as f:
+        report = json.load(f)
+
+    archive = tempfile.mktemp(ARCHIVE_EXT[args.format])
+    command = ['tar', '-c', '-f', '-', '-C', APACHE_PREFIX]
+    for package_path, distro_dir in sorted(report.items()):
+        command += ['--transform', tar_transform(
+            package_path, os.path.join('package', distro_dir,
+                                       os.path.basename(package_path)))]
+    command += sorted(report)
+    if args.host:
+        command = ['ssh'] + ssh_opts + [args.host] + [quote(arg)
+                                                       for arg in command]
+
+    with open(archive, 'wb') as f:
+        tar_stream = Popen(command, stdout=PIPE)
+        compressor = Popen(compress_program(archive).split(),
+                           stdin=tar_stream.stdout, stdout=f)
+        tar_stream.stdout.close()
+        compressor.wait()
+        tar_stream.wait()
+
+    returncode = tar_stream.returncode or compressor.returncode
+    if returncode:
+        os.remove(archive)
+        return returncode, None
+    return 0, archive
+
+
+def tar_transform(source, dest):
+    """Returns tar --transform expression renaming exactly source to dest."""
+    def escape(path, special):
+        return ''.join('\\' + c if c in special else c for c in path)
+
+    return 's|^{}$|{}|'.format(escape(source, '\\|.[]*^$'),
+                               escape(dest, '\\|&'))
 
 
 if __name__ == '__main__':
@@ -395,11 +528,18 @@ if __name__ == '__main__':
 
     if args.action == 'config':
         print(CONFIG)
-    elif args.action == 'push':
-        exit_code = push(args.package_artifact)
-    elif args.action == 'pull':
-        exit_code, archive = pull(args.report_artifact)
-        if exit_code == 0:
-            print(archive)
+    else:
+        if args.host:
+            start_ssh_master(args.host, ssh_opts)
+        try:
+            if args.action == 'push':
+                exit_code = push(args.package_artifact)
+            elif args.action == 'pull':
+                exit_code, archive = pull(args.report_artifact)
+                if exit_code == 0:
+                    print(archive)
+        finally:
+            if args.host:
+                stop_ssh_master(args.host, ssh_opts, ssh_control_dir)
 
     sys.exit(exit_code)
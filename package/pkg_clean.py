@@ -25,48 +25,129 @@ import sys
 import tempfile
 import time
 import logging as LOG
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 from subprocess import check_output
 
+# Suffixes of deb source package files, whose name is <name>_<version><suffix>
+APT_SOURCE_SUFFIXES = ['.dsc', '.debian.tar.xz', '.debian.tar.gz', '.diff.gz']
+UNLINK_THREADS = 8
 
-def apt_clean_package(release, repo, name, version, older_than_days):
+PackageFile = namedtuple('PackageFile', 'name version path ctime size')
+
+
+def apt_package_entry(path):
+    """
+    Returns (name, version) of a deb binary or source package file, or None
+    if path is not one. Versions include the debian revision, as expected by
+    aptly queries.
     """
-    Remove all packages (binary and source) of a specific package
-    identified by name and a version (can be wildcarded) in a repo.
 
-    Example usage:
-      apt_clean_package('1902', 'xenial', 'op-panel', '18.02.0.rc', 7)
+    file_name = os.path.basename(path)
+    parts = file_name.split('_')
+    if len(parts) == 3 and file_name.endswith('.deb'):
+        return parts[0], parts[1]
+    if len(parts) == 2:
+        for suffix in APT_SOURCE_SUFFIXES:
+            if parts[1].endswith(suffix):
+                return parts[0], parts[1][:-len(suffix)]
+    return None
+
+
+def yum_package_entry(release, path):
+    """
+    Returns (name, version-release) of an rpm package file of a release's
+    software collection, or None if path is not one.
+    """
+
+    prefix = 'onedata{}-'.format(release)
+    file_name = os.path.basename(path)
+    parts = file_name.rsplit('-', 2)
+    if (len(parts) != 3 or not parts[0].startswith(prefix) or
+            not file_name.endswith('.rpm')):
+        return None
+    # strip .<arch>.rpm
+    package_release = parts[2].rsplit('.', 2)[0]
+    return parts[0][len(prefix):], parts[1] + '-' + package_release
+
+
+def index_dir(top, parse):
+    """
+    Builds an index of package files under top (recursively) in one pass,
+    as a list of PackageFile. parse(path) returns (name, version) of the
+    package in a file, or None for files that should not be indexed.
+    """
+
+    index = []
+    for dir_path, _, file_names in os.walk(top):
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            entry = parse(path)
+            if entry:
+                stat = os.lstat(path)
+                index.append(PackageFile(entry[0], entry[1], path,
+                                         stat.st_ctime, stat.st_size))
+    return index
+
+
+def select_packages(index, packages, version, older_than_days):
     """
+    Returns files from index of given packages, with a version matching
+    version (regular expression matched at the beginning of the version)
+    and older than older_than_days.
+    """
+
+    names = set(packages)
+    version_re = re.compile(version)
+    cutoff = time.time() - older_than_days * 24 * 3600
+    return [f for f in index if f.name in names and f.ctime <= cutoff and
+            version_re.match(f.version)]
 
-    package_dir = os.path.join('/aptly/public', release, 'pool/main', name[0],
-                               name)
-    package_files = [f for f in os.listdir(package_dir)
-                     if re.match("{}_{}.*.deb".format(name, version), f)]
 
-    package_versions = set()
-    for f in package_files:
-        creation_time = os.path.getctime(os.path.join(package_dir, f))
-        file_age_in_days = (time.time() - creation_time)/(24 * 3600)
-        if file_age_in_days >= older_than_days:
-            package_version = str(f).replace('_amd64.deb', '')\
-                                    .replace('.debian.tar.xz', '')\
-                                    .replace(name+'_', '')
-            package_versions.add(package_version)
+def log_summary(removed):
+    """
+    Logs number and size of removed files per package and in total.
+    """
+
+    sizes = {}
+    for f in removed:
+        count, size = sizes.get(f.name, (0, 0))
+        sizes[f.name] = (count + 1, size + f.size)
 
-    for package_version in package_versions:
-        LOG.info("=== Removing apt package {}_{} ===".format(name, package_version))
-        result = check_output(
-                ['aptly', 'repo', 'remove', '-dry-run=false', release+'-'+repo,
-                    "{} (={})".format(name, package_version)])
-        LOG.info(result)
+    LOG.info("=== Cleanup summary ===")
+    for name, (count, size) in sorted(sizes.items()):
+        LOG.info("{:<30} {:>6} files {:>10.1f} MB".format(
+            name, count, size / (1024.0 * 1024)))
+    LOG.info("Total: {} files, {:.1f} MB freed".format(
+        len(removed), sum(f.size for f in removed) / (1024.0 * 1024)))
 
 
 def apt_clean_packages(release, repo, packages, version, days):
     """
-    Clean specified apt packages
+    Remove all packages (binary and source) of specified packages matching
+    a version (can be wildcarded) in a repo, with a single aptly query.
+
+    Example usage:
+      apt_clean_packages('1902', 'xenial', ['op-panel'], '18.02.0.rc', 7)
     """
 
-    for package in packages:
-        apt_clean_package(release, repo, package, version, days)
+    pool_dir = os.path.join('/aptly/public', release, 'pool/main')
+    removed = select_packages(index_dir(pool_dir, apt_package_entry),
+                              packages, version, days)
+    package_versions = sorted(set((f.name, f.version) for f in removed))
+    if not package_versions:
+        LOG.info("=== No apt packages to remove ===")
+        return
+
+    for name, package_version in package_versions:
+        LOG.info("=== Removing apt package {}_{} ===".format(name,
+                                                            package_version))
+    query = ' | '.join("{} (={})".format(name, package_version)
+                       for name, package_version in package_versions)
+    result = check_output(['aptly', 'repo', 'remove', '-dry-run=false',
+                           release+'-'+repo, query])
+    LOG.info(result)
+    log_summary(removed)
 
 
 def apt_db_update(release, repo):
@@ -82,46 +163,33 @@ def apt_db_update(release, repo):
     LOG.info(result_update)
 
 
-def yum_clean_package(release, repo, name, version, older_than_days):
+def yum_clean_packages(release, repo, packages, version, days):
     """
-    Remove all packages (binary and source) of a specific package
-    identified by name and a version (can be wildcarded) in a repo.
+    Remove all packages (binary and source) of specified packages matching
+    a version (can be wildcarded) in a repo. Files are removed in parallel.
 
     Example usage:
-      yum_clean_package('1902', 'centos/7x', 'op-panel', '18.02.0.rc', 7)
-    """
-
-    bin_package_dir = os.path.join('/var/www/onedata/yum', release, repo, 'x86_64')
-    package_files = [f for f in os.listdir(bin_package_dir)
-                if re.match("onedata{}-{}-{}.*".format(release, name, version), f)]
-
-    for p in package_files:
-        creation_time = os.path.getctime(os.path.join(bin_package_dir, p))
-        file_age_in_days = (time.time() - creation_time)/(24 * 3600)
-        if file_age_in_days >= older_than_days:
-            LOG.info("=== Removing binary yum package {} which is {} days old"
-                     .format(str(p), str(int(file_age_in_days))))
-            os.remove(os.path.join(bin_package_dir, p))
-
-    src_package_dir = os.path.join('/var/www/onedata/yum', release, repo, 'SRPMS')
-    package_files = [f for f in os.listdir(src_package_dir)
-                if re.match("onedata{}-{}-{}.*".format(release, name, version), f)]
-    for p in package_files:
-        creation_time = os.path.getctime(os.path.join(src_package_dir, p))
-        file_age_in_days = (time.time() - creation_time)/(24 * 3600)
-        if file_age_in_days >= older_than_days:
-            LOG.info("=== Removing source yum package {} which is {} days old"
-                     .format(str(p), str(int(file_age_in_days))))
-            os.remove(os.path.join(src_package_dir, p))
-
-
-def yum_clean_packages(release, repo, packages, version, days):
-    """
-    Clean specified yum packages
+      yum_clean_packages('1902', 'centos/7x', ['op-panel'], '18.02.0.rc', 7)
     """
 
-    for package in packages:
-        yum_clean_package(release, repo, package, version, days)
+    repo_dir = os.path.join('/var/www/onedata/yum', release, repo)
+    removed = []
+    for package_dir in ['x86_64', 'SRPMS']:
+        index = index_dir(os.path.join(repo_dir, package_dir),
+                          lambda path: yum_package_entry(release, path))
+        removed += select_packages(index, packages, version, days)
+
+    now = time.time()
+    for f in removed:
+        LOG.info("=== Removing yum package {} which is {} days old".format(
+            f.path, int((now - f.ctime) / (24 * 3600))))
+
+    pool = ThreadPool(UNLINK_THREADS)
+    try:
+        pool.map(lambda f: os.remove(f.path), removed)
+    finally:
+        pool.close()
+    log_summary(removed)
 
 
 def yum_db_update(release, repo):
@@ -9,53 +9,92 @@ This script runs an arbitrary shell command, prints its output to the
 standard system out and generates a surefire XML report with its outcome at
 requested path. The command is considered successful if it ends with 0 exit
 code, otherwise the report will include a single failure and the captured
-output as failure details.
+output (its last part, if it is long) as failure details. The output is
+printed live, as it is produced.
 
 """
 
 import argparse
+import codecs
+import collections
+import os
+import re
 import subprocess
+import sys
 import time
-import unicodedata
-import os
+from xml.sax.saxutils import escape
+
+READ_CHUNK_SIZE = 64 * 1024
+DEFAULT_MAX_CAPTURED_CHARS = 1024 * 1024
+
+# Characters that are not allowed in XML (control characters other than
+# newlines/tabs, surrogates and non-characters). Used to filter out unwanted
+# characters from the output placed inside the surefire XML.
+INVALID_XML_CHARS = re.compile(
+    '[\x00-\x08\x0b\x0c\x0e-\x1f\x7f-\x9f\ud800-\udfff\ufffe\uffff]')
+
 
+def run_and_capture_tail(command, max_captured_chars):
+    # Streams output of the command to the standard out as it is produced,
+    # keeping only its last max_captured_chars characters (sanitized) in
+    # memory. Returns a tuple (exit code, captured tail, omitted chars).
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    tail = collections.deque()
+    tail_length = 0
+    omitted = 0
 
-def should_include_char_in_output(c):
-    # Returns true for printable characters and newlines/tabs. Used to filter
-    # out unwanted characters from a stdout string that is placed inside the
-    # surefire XML.
-    if c == '\n' or c == '\r' or c == '\t':
-        return True
-    else:
-        return not unicodedata.category(c).startswith('C')
+    while True:
+        chunk = process.stdout.read1(READ_CHUNK_SIZE)
+        sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
+
+        text = INVALID_XML_CHARS.sub('', decoder.decode(chunk, final=not chunk))
+        tail.append(text)
+        tail_length += len(text)
+        while tail and tail_length - len(tail[0]) >= max_captured_chars:
+            tail_length -= len(tail[0])
+            omitted += len(tail.popleft())
+
+        if not chunk:
+            break
+
+    captured = ''.join(tail)
+    if len(captured) > max_captured_chars:
+        omitted += len(captured) - max_captured_chars
+        captured = captured[-max_captured_chars:]
+
+    return process.wait(), captured, omitted
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--test-name", help="Display name of test to be included in the surefire report")
 parser.add_argument("--report-path", help="Path where the surefire report file will saved")
+parser.add_argument("--max-captured-chars", type=int, default=DEFAULT_MAX_CAPTURED_CHARS,
+                    help="Number of last characters of the output to be included in the surefire report")
 parser.add_argument("rest", nargs=argparse.REMAINDER, help="Shell command to be run")
 args = parser.parse_args()
+if args.max_captured_chars < 1:
+    parser.error("--max-captured-chars must be at least 1")
 
-execution_time_start = time.time()
-result = subprocess.run(args.rest, stdout=subprocess.PIPE,
-                        stderr=subprocess.STDOUT, universal_newlines=True)
-execution_time = execution_time_start - time.time()
-
-print(result.stdout, end='')
+execution_time_start = time.monotonic()
+returncode, captured_output, omitted_chars = run_and_capture_tail(
+    args.rest, args.max_captured_chars)
+execution_time = time.monotonic() - execution_time_start
 
-if result.returncode == 0:
+if returncode == 0:
     failures = 0
     failure_element = ''
 else:
     failures = 1
 
-    result.stdout = result.stdout.replace(">", "&gt;")
-    result.stdout = result.stdout.replace("<", "&lt;")
-    filtered_stdout = ''.join(
-        c for c in result.stdout if should_include_char_in_output(c))
+    if omitted_chars:
+        captured_output = '[... {0} characters of output omitted ...]\n{1}'.format(
+            omitted_chars, captured_output)
 
     failure_element = '<failure>{stdout}</failure>'.format(
-        stdout=filtered_stdout)
+        stdout=escape(captured_output))
 
 xml_content = '''<?xml version="1.0" encoding="UTF-8" ?>
 <testsuite tests="1" failures="{failures}" errors="0" skipped="0" time="{time}" name="{name}">